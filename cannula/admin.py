@@ -1,28 +1,49 @@
 from django.contrib import admin
+from django.contrib.admin.actions import delete_selected as delete_selected_objects
 
 from mptt.admin import MPTTModelAdmin
 
-from .models import SourceDocument, OrgUnit, DataElement, DataValue, Category, CategoryCombo, ValidationRule, load_excel_to_datavalues, load_excel_to_validations
+from .models import SourceDocument, IngestionJob, IngestionStats, OrgUnit, DataElement, DataValue, Category, CategoryCombo, ValidationRule, aggregate_keys, refresh_aggregates
+from .jobs import queue_job
 
 def load_document_values(modeladmin, request, queryset):
     for doc in queryset:
-        all_values = load_excel_to_datavalues(doc)
-        for site_name, site_vals in all_values.items():
-            DataValue.objects.bulk_create(site_vals)
+        queue_job(doc, 'VALUES')
 
 load_document_values.short_description = 'Load data values from document into DB'
 
+def merge_document_values(modeladmin, request, queryset):
+    for doc in queryset:
+        queue_job(doc, 'UPSERT')
+
+merge_document_values.short_description = 'Merge (corrected) data values from document into DB'
+
 def load_document_validations(modeladmin, request, queryset):
     for doc in queryset:
-        load_excel_to_validations(doc)
+        queue_job(doc, 'VALIDATIONS')
 
 load_document_validations.short_description = 'Load validation rules from document into DB'
 
+def profile_document_values(modeladmin, request, queryset):
+    for doc in queryset:
+        queue_job(doc, 'DRY_RUN')
+
+profile_document_values.short_description = 'Dry run: profile data values in document (no changes to DB)'
+
 class SourceDocumentAdmin(admin.ModelAdmin):
     readonly_fields = ('orig_filename',)
     list_display = ['uploaded_at', 'orig_filename']
     ordering = ['uploaded_at']
-    actions = [load_document_values, load_document_validations]
+    actions = [profile_document_values, load_document_values, merge_document_values, load_document_validations]
+
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ['created_at', 'source_doc', 'kind', 'status', 'phase', 'rows_done', 'rows_total', 'rows_skipped', 'values_done', 'finished_at']
+    list_filter = ('status', 'kind')
+    readonly_fields = ('started_at', 'heartbeat_at', 'finished_at')
+
+class IngestionStatsAdmin(admin.ModelAdmin):
+    list_display = ['recorded_at', 'source_doc', 'job', 'kind', 'phase', 'wall_secs', 'rows', 'values', 'queries', 'peak_rss_kb']
+    list_filter = ('kind', 'phase')
 
 class OrgUnitAdmin(MPTTModelAdmin):
     list_display = ['name', 'level']
@@ -33,16 +54,40 @@ class DataElementAdmin(admin.ModelAdmin):
 class CategoryComboAdmin(admin.ModelAdmin):
     filter_horizontal = ['categories']
 
+def delete_selected(modeladmin, request, queryset):
+    # the admin's own action, followed by a refresh of the aggregates the values were in
+    keys = aggregate_keys(queryset)
+    response = delete_selected_objects(modeladmin, request, queryset)
+    if response is None: # confirmed, and deleted
+        refresh_aggregates(keys)
+    return response
+
+delete_selected.short_description = delete_selected_objects.short_description
+
 class DataValueAdmin(admin.ModelAdmin):
     list_display = ['data_element', 'category_combo', 'site_str', 'org_unit', 'month', 'quarter', 'year', 'numeric_value']
     list_filter = ('data_element__name',)
     search_fields = ['data_element__name', 'category_combo__name', 'site_str']
+    actions = [delete_selected] # replaces the admin's own
+
+    # values edited one at a time, the aggregates of both their old and new org unit and period are refreshed
+    def save_model(self, request, obj, form, change):
+        keys = aggregate_keys(DataValue.objects.filter(id=obj.id)) if change else set()
+        super(DataValueAdmin, self).save_model(request, obj, form, change)
+        refresh_aggregates(keys | aggregate_keys(DataValue.objects.filter(id=obj.id)))
+
+    def delete_model(self, request, obj):
+        keys = aggregate_keys(DataValue.objects.filter(id=obj.id))
+        super(DataValueAdmin, self).delete_model(request, obj)
+        refresh_aggregates(keys)
 
 class ValidationRuleAdmin(admin.ModelAdmin):
     list_display = ['name', 'expression']
     filter_horizontal = ['data_elements']
 
 admin.site.register(SourceDocument, SourceDocumentAdmin)
+admin.site.register(IngestionJob, IngestionJobAdmin)
+admin.site.register(IngestionStats, IngestionStatsAdmin)
 admin.site.register(OrgUnit, OrgUnitAdmin)
 admin.site.register(DataElement, DataElementAdmin)
 admin.site.register(DataValue, DataValueAdmin)
@@ -0,0 +1,208 @@
+"""
+Synthetic data and timing helpers used by the benchmark management commands.
+Everything is written inside a transaction that is rolled back, so a benchmark
+run leaves the database as it found it
+"""
+import calendar
+import os
+import random
+import time
+import timeit
+from collections import OrderedDict
+from decimal import Decimal
+from itertools import islice, product
+
+from django.db import transaction
+
+from . import grabbag
+from .models import SourceDocument, DataValue, DataElementResolver, OrgUnitTreeLoader, fs
+
+def synthetic_datavalues(source_doc, num_values, num_elements=100, num_facilities=500, start_year=2015):
+    """
+    Yield num_values unsaved DataValue instances spread over synthetic data
+    elements, facilities and as many months as needed to keep them unique
+    """
+    resolver = DataElementResolver()
+    elements = resolver.resolve_all('BENCH %03d Synthetic element' % (i,) for i in range(num_elements))
+
+    facility_paths = [('Uganda', 'Benchmark District', 'Benchmark Subcounty %d' % (i//50,), 'Benchmark HC %03d' % (i,)) for i in range(num_facilities)]
+    ou_loader = OrgUnitTreeLoader()
+    ou_ids = ou_loader.resolve_all(facility_paths)
+
+    num_months = -(-num_values // (num_elements*num_facilities)) # ceiling division
+    months = [(start_year + m//12, m%12+1) for m in range(num_months)]
+
+    for (year, month), path, (de, cc) in islice(product(months, facility_paths, elements), num_values):
+        yield DataValue(
+            data_element_id=de.id, site_str=' => '.join(path), org_unit_id=ou_ids[path],
+            district_ou_id=ou_loader.resolved[path[:2]], subcounty_ou_id=ou_loader.resolved[path[:3]], facility_ou_id=ou_ids[path],
+            numeric_value=Decimal(random.randint(0, 500)),
+            year='%d' % (year,), quarter='%d-Q%d' % (year, (month-1)//3+1), month='%d-%02d' % (year, month),
+            year_ord=year, quarter_ord=year*4 + (month-1)//3, month_ord=year*12 + month-1,
+            source_doc=source_doc,
+        )
+
+def time_loader(loader_name, num_values, batch_size=2000):
+    """
+    Write num_values synthetic values with the named loader backend and
+    return the seconds spent in the loader (generating the values is excluded)
+    """
+    from .bulkload import get_loader
+
+    with transaction.atomic():
+        src_doc = SourceDocument.objects.create(file='benchmark/synthetic.xlsx', content_hash='synthetic') # no such file to hash
+        loader = get_loader(loader_name)
+        elapsed = 0.0
+        for dv_batch in grabbag.chunked(synthetic_datavalues(src_doc, num_values), batch_size):
+            start = time.perf_counter()
+            loader.write(dv_batch)
+            elapsed += time.perf_counter() - start
+        start = time.perf_counter()
+        loader.finish()
+        elapsed += time.perf_counter() - start
+
+        transaction.set_rollback(True) # discard everything the benchmark wrote
+
+    return elapsed
+
+def time_period_parsers(num_cells=100000, number=3):
+    """
+    Time parsing a column of num_cells period cells with the period parser
+    (cold cache) against grabbag.period_to_dates() + dates_to_iso_periods().
+    Returns the number of cells and the best of number runs for each parser,
+    in seconds
+    """
+    from .periods import parse_period, parse_periods
+
+    # no abbreviated month names ('Oct 2016'), period_to_dates() fails on those
+    forms = ('%(name)s %(year)d', '%(abbr)s to Dec %(year)d', '%(year)d-%(month)02d', '%(year)d-Q%(quarter)d', '%(year)d')
+    cells = list()
+    for i in range(num_cells):
+        year, month = 2000 + (i//12)%30, i%12+1
+        fields = dict(year=year, month=month, quarter=(month-1)//3+1, name=calendar.month_name[month], abbr=calendar.month_abbr[month])
+        cells.append(forms[i%len(forms)] % fields)
+
+    def old_parser():
+        for c in cells:
+            grabbag.dates_to_iso_periods(*grabbag.period_to_dates(c.strip()))
+
+    def new_parser():
+        parse_period.cache_clear()
+        parse_periods(cells)
+
+    results = dict()
+    for name, func in (('period_to_dates', old_parser), ('parse_periods', new_parser)):
+        results[name] = min(timeit.repeat(func, number=1, repeat=number))
+    return len(cells), results
+
+SYNTHETIC_CATEGORIES = ('', ' Male', ' Female', ' Male 15+', ' Female 15+') # cycled through by the element headers
+
+def synthetic_place_names(num_names, suffix):
+    """Unique place names made up from grabbag.gen_random_names()"""
+    names = list()
+    for i, (first_name, last_name) in enumerate(grabbag.gen_random_names(num_names)):
+        names.append('%s %s %s %d' % (first_name, last_name, suffix, i+1))
+    return names
+
+def write_synthetic_workbook(path, num_districts=4, num_subcounties=5, num_facilities=10, num_elements=50, num_months=12, start_year=2016, seed=0):
+    """
+    Write a workbook in the HMIS layout load_excel_to_datavalues() reads: a
+    period column, the district, subcounty and facility columns, then a column
+    per data element. There are num_subcounties per district and
+    num_facilities per subcounty, each with a row per month.
+    Returns the number of rows and of values written
+    """
+    import openpyxl
+
+    random.seed(seed) # same names and values for the same arguments
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title='Step1')
+    headers = ['January %d BENCH %03d Synthetic element%s' % (start_year, i, SYNTHETIC_CATEGORIES[i%len(SYNTHETIC_CATEGORIES)]) for i in range(num_elements)]
+    ws.append(['Period', 'District', 'Subcounty', 'Health Facility'] + headers)
+
+    districts = synthetic_place_names(num_districts, 'District')
+    num_rows = 0
+    for district in districts:
+        for subcounty in synthetic_place_names(num_subcounties, 'Subcounty'):
+            for facility in synthetic_place_names(num_facilities, 'HC III'):
+                for m in range(num_months):
+                    period = '%s %d' % (calendar.month_name[m%12+1], start_year + m//12)
+                    ws.append([period, district, subcounty, facility] + [random.randint(0, 500) for _ in range(num_elements)])
+                    num_rows += 1
+    wb.save(path)
+    return num_rows, num_rows*num_elements
+
+class PhaseTimer():
+    """
+    Progress callback that adds up the time spent in each ingestion phase,
+    the phases take turns for every chunk of rows
+    """
+    def __init__(self):
+        self.phase_secs = OrderedDict() # phase => seconds, in the order the phases first started
+        self.phase = None
+        self.first_start = None
+
+    def stop(self, end):
+        if self.phase is not None:
+            self.phase_secs[self.phase] += end - self.phase_start
+
+    def __call__(self, phase, **counts):
+        if phase == self.phase:
+            return
+        now = time.perf_counter()
+        self.stop(now)
+        if self.first_start is None:
+            self.first_start = now
+        self.phase, self.phase_start = phase, now
+        self.phase_secs.setdefault(phase, 0.0)
+
+    def durations(self, end):
+        """Seconds spent in each phase, the last one ending at end"""
+        self.stop(end)
+        self.phase = None
+        return list(self.phase_secs.items())
+
+def time_ingestion(num_districts=4, num_subcounties=5, num_facilities=10, num_elements=50, num_months=12, loader_name=None, processes=1, seed=0):
+    """
+    Generate a synthetic workbook and load it with save_excel_datavalues(),
+    timing the parse, resolve and write phases separately (each added up over
+    the chunks of rows, see PhaseTimer). Returns a list
+    of (name, value) results, in a fixed order
+    """
+    from .bulkload import get_loader
+    from .models import save_excel_datavalues
+
+    name = 'benchmark/synthetic_%d_%d_%d_%d_%d.xlsx' % (num_districts, num_subcounties, num_facilities, num_elements, num_months)
+    path = fs.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    start = time.perf_counter()
+    num_rows, num_values = write_synthetic_workbook(path, num_districts, num_subcounties, num_facilities, num_elements, num_months, seed=seed)
+    generate_secs = time.perf_counter() - start
+
+    try:
+        with transaction.atomic():
+            src_doc = SourceDocument.objects.create(file=name)
+            timer = PhaseTimer()
+            num_loaded = save_excel_datavalues(src_doc, loader=get_loader(loader_name), progress=timer, processes=processes)
+            end = time.perf_counter()
+
+            transaction.set_rollback(True) # discard everything the benchmark wrote
+    finally:
+        os.remove(path)
+
+    results = [
+        ('rows', num_rows),
+        ('values', num_loaded),
+        ('generate_secs', generate_secs),
+    ]
+    for phase, elapsed in timer.durations(end):
+        results.append(('%s_secs' % (phase,), elapsed))
+        results.append(('%s_rows_per_sec' % (phase,), num_rows/elapsed if elapsed else 0.0))
+    total = end - timer.first_start
+    results.extend([
+        ('total_secs', total),
+        ('total_rows_per_sec', num_rows/total if total else 0.0),
+        ('total_values_per_sec', num_loaded/total if total else 0.0),
+        ('peak_rss_kb', grabbag.peak_rss_kb()),
+    ])
+    return results
@@ -0,0 +1,303 @@
+"""
+Loader backends that write batches of (unsaved) DataValue instances to the
+database. Use get_loader() to pick the fastest one for the database in use
+"""
+import io
+from collections import defaultdict
+
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from . import grabbag
+from .models import DataValue
+
+import logging
+logger = logging.getLogger(__name__)
+
+DATAVALUE_COLUMNS = ('data_element_id', 'category_combo_id', 'site_str', 'org_unit_id', 'district_ou_id', 'subcounty_ou_id', 'facility_ou_id', 'numeric_value', 'month', 'quarter', 'year', 'year_ord', 'quarter_ord', 'month_ord', 'source_doc_id')
+DATAVALUE_KEY_COLUMNS = ('data_element_id', 'category_combo_id', 'org_unit_id', 'year', 'quarter', 'month') # DataValue.Meta.unique_together
+DATAVALUE_PERIOD_COLUMNS = ('year', 'quarter', 'month') # the nullable key columns
+
+class BulkCreateLoader():
+    """Plain Django bulk_create(), works on any database"""
+    batch_size = 1000 # rows per INSERT statement, keeps the parameter lists manageable
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.num_values = 0
+
+    def write(self, dv_batch):
+        DataValue.objects.using(self.using).bulk_create(dv_batch, batch_size=self.batch_size)
+        self.num_values += len(dv_batch)
+
+    def finish(self):
+        return self.num_values
+
+def copy_escape(value):
+    """
+    Format a value for the PostgreSQL COPY text format
+
+    >>> copy_escape(None), copy_escape(12), copy_escape('Uganda => Kampala\\tHC IV')
+    ('\\\\N', '12', 'Uganda => Kampala\\\\tHC IV')
+
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+class CopyLoader():
+    """
+    PostgreSQL only. Streams each batch into a temporary staging table with
+    COPY, then moves the staged rows into the datavalue table with a single
+    INSERT ... SELECT when finish() is called
+    """
+    staging_table = 'cannula_datavalue_staging'
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.num_values = 0
+        self.staging_created = False
+
+    def create_staging(self, cursor):
+        qn = connections[self.using].ops.quote_name
+        column_list = ', '.join(qn(c) for c in DATAVALUE_COLUMNS)
+        cursor.execute('DROP TABLE IF EXISTS %s' % (qn(self.staging_table),))
+        # same column types as the datavalue table, but none of its constraints or indexes
+        cursor.execute('CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s WITH NO DATA' % (qn(self.staging_table), column_list, qn(DataValue._meta.db_table)))
+        self.staging_created = True
+
+    def write(self, dv_batch):
+        cursor = connections[self.using].cursor()
+        if not self.staging_created:
+            self.create_staging(cursor)
+
+        buf = io.StringIO()
+        for dv in dv_batch:
+            buf.write('\t'.join(copy_escape(getattr(dv, c)) for c in DATAVALUE_COLUMNS))
+            buf.write('\n')
+        buf.seek(0)
+        cursor.copy_from(buf, self.staging_table, columns=DATAVALUE_COLUMNS)
+        self.num_values += len(dv_batch)
+
+    def finish(self):
+        if self.staging_created:
+            qn = connections[self.using].ops.quote_name
+            column_list = ', '.join(qn(c) for c in DATAVALUE_COLUMNS)
+            cursor = connections[self.using].cursor()
+            cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (qn(DataValue._meta.db_table), column_list, column_list, qn(self.staging_table)))
+            cursor.execute('DROP TABLE %s' % (qn(self.staging_table),))
+            self.staging_created = False
+        return self.num_values
+
+class CopyUpsertLoader(CopyLoader):
+    """
+    PostgreSQL only. Like CopyLoader, but merges each staged batch into the
+    datavalue table with ON CONFLICT ... DO UPDATE semantics: values with a new
+    key are inserted, values whose key already exists are updated when the
+    number differs and otherwise only attributed to the document being loaded.
+    The last value wins for keys repeated within a batch.
+
+    The merge is an UPDATE ... FROM followed by an INSERT ... WHERE NOT EXISTS
+    rather than ON CONFLICT itself, because the period columns are nullable and
+    NULLs never conflict in a unique index. Only those are matched with IS NOT
+    DISTINCT FROM, the other key columns with = so the key index (or a hash
+    join) can be used
+    """
+    def __init__(self, using='default'):
+        super(CopyUpsertLoader, self).__init__(using=using)
+        self.num_inserted = self.num_updated = self.num_unchanged = 0
+
+    def write(self, dv_batch):
+        incoming = dict((dv_key(dv), dv) for dv in dv_batch) # the last value wins for duplicated keys
+        super(CopyUpsertLoader, self).write(list(incoming.values()))
+        self.num_values += len(dv_batch) - len(incoming)
+
+        qn = connections[self.using].ops.quote_name
+        dv_table, staging = qn(DataValue._meta.db_table), qn(self.staging_table)
+        key_match = ' AND '.join(('dv.%s IS NOT DISTINCT FROM s.%s' if c in DATAVALUE_PERIOD_COLUMNS else 'dv.%s = s.%s') % (qn(c), qn(c)) for c in DATAVALUE_KEY_COLUMNS)
+        column_list = ', '.join(qn(c) for c in DATAVALUE_COLUMNS)
+        staged_column_list = ', '.join('s.%s' % (qn(c),) for c in DATAVALUE_COLUMNS)
+
+        cursor = connections[self.using].cursor()
+        cursor.execute(
+            'UPDATE %s dv SET numeric_value = s.numeric_value, site_str = s.site_str, source_doc_id = s.source_doc_id FROM %s s WHERE %s AND dv.numeric_value IS DISTINCT FROM s.numeric_value'
+            % (dv_table, staging, key_match)
+        )
+        num_updated = cursor.rowcount
+        cursor.execute(
+            'INSERT INTO %s (%s) SELECT %s FROM %s s WHERE NOT EXISTS (SELECT 1 FROM %s dv WHERE %s)'
+            % (dv_table, column_list, staged_column_list, staging, dv_table, key_match)
+        )
+        num_inserted = cursor.rowcount
+        # the document being loaded has the unchanged values too, they must not go when the one they came from is deleted
+        cursor.execute(
+            'UPDATE %s dv SET source_doc_id = s.source_doc_id FROM %s s WHERE %s AND dv.source_doc_id <> s.source_doc_id'
+            % (dv_table, staging, key_match)
+        )
+        cursor.execute('TRUNCATE %s' % (staging,))
+
+        self.num_updated += num_updated
+        self.num_inserted += num_inserted
+        self.num_unchanged += len(incoming) - num_updated - num_inserted
+
+    def finish(self):
+        if self.staging_created:
+            qn = connections[self.using].ops.quote_name
+            connections[self.using].cursor().execute('DROP TABLE %s' % (qn(self.staging_table),))
+            self.staging_created = False
+        return self.num_values
+
+def dv_key(dv):
+    return tuple(getattr(dv, c) for c in DATAVALUE_KEY_COLUMNS)
+
+def fetch_existing(keys, using='default'):
+    """Return a dict of the stored DataValues (id, numeric_value, source_doc and key fields only) for the given keys"""
+    keys = set(keys)
+    if not keys:
+        return dict()
+    qs = DataValue.objects.using(using).filter(
+        data_element_id__in=set(k[0] for k in keys),
+        org_unit_id__in=set(k[2] for k in keys),
+    ).filter(
+        Q(year__in=set(k[3] for k in keys)) | Q(year__isnull=True)
+    )
+    return dict((k, dv) for k, dv in ((dv_key(dv), dv) for dv in qs.only('id', 'numeric_value', 'source_doc_id', *DATAVALUE_KEY_COLUMNS)) if k in keys)
+
+class BulkUpsertLoader(BulkCreateLoader):
+    """
+    Merges each batch on any database: one query to fetch the rows already
+    stored for the batch's keys, one CASE-based UPDATE for the changed values,
+    one UPDATE attributing the unchanged ones to the document being loaded and
+    a bulk_create() for the new ones
+    """
+    def __init__(self, using='default'):
+        super(BulkUpsertLoader, self).__init__(using=using)
+        self.num_inserted = self.num_updated = self.num_unchanged = 0
+
+    def write(self, dv_batch):
+        incoming = dict((dv_key(dv), dv) for dv in dv_batch) # the last value wins for duplicated keys
+        existing = fetch_existing(incoming, using=self.using)
+
+        new_values, changed_values = list(), list()
+        reassigned_ids = defaultdict(list) # source doc id => ids of unchanged values from other documents
+        for key, dv in incoming.items():
+            if key not in existing:
+                new_values.append(dv)
+            elif existing[key].numeric_value != dv.numeric_value:
+                dv.id = existing[key].id
+                changed_values.append(dv)
+            elif existing[key].source_doc_id != dv.source_doc_id:
+                reassigned_ids[dv.source_doc_id].append(existing[key].id)
+
+        dv_field = DataValue._meta.get_field
+        for dv_chunk in grabbag.chunked(changed_values, self.batch_size):
+            DataValue.objects.using(self.using).filter(id__in=[dv.id for dv in dv_chunk]).update(
+                numeric_value=Case(*[When(id=dv.id, then=Value(dv.numeric_value)) for dv in dv_chunk], output_field=dv_field('numeric_value')),
+                site_str=Case(*[When(id=dv.id, then=Value(dv.site_str)) for dv in dv_chunk], output_field=dv_field('site_str')),
+                source_doc=Case(*[When(id=dv.id, then=Value(dv.source_doc_id)) for dv in dv_chunk], output_field=IntegerField()),
+            )
+        # the document being loaded has the unchanged values too, they must not go when the one they came from is deleted
+        for source_doc_id, dv_ids in reassigned_ids.items():
+            for id_chunk in grabbag.chunked(dv_ids, self.batch_size):
+                DataValue.objects.using(self.using).filter(id__in=id_chunk).update(source_doc=source_doc_id)
+        DataValue.objects.using(self.using).bulk_create(new_values, batch_size=self.batch_size)
+
+        self.num_values += len(dv_batch)
+        self.num_inserted += len(new_values)
+        self.num_updated += len(changed_values)
+        self.num_unchanged += len(incoming) - len(new_values) - len(changed_values)
+
+def str_or_none(value):
+    return None if value is None else str(value)
+
+class DryRunLoader():
+    """
+    Writes nothing, profiles the values instead: keys repeated within the
+    upload, keys already stored (a plain load would fail on those, a merge
+    updates them when the number differs) and values outside their data
+    element's value_min/value_max. Keeps a few samples of each
+    """
+    sample_size = 20
+
+    def __init__(self, using='default'):
+        self.using = using
+        self.num_values = 0
+        self.keys = set()
+        self.num_duplicates = self.num_existing = self.num_existing_changed = self.num_out_of_range = 0
+        self.duplicate_samples, self.existing_samples, self.out_of_range_samples = list(), list(), list()
+        self.default_cat_combo_id = DataValue._meta.get_field('category_combo').default
+
+    def sample(self, dv, **extra):
+        sample = dict(
+            data_element=dv.data_element.name,
+            category_combo=dv.category_combo.name if dv.category_combo_id != self.default_cat_combo_id else None,
+            location=dv.site_str,
+            period=dv.month or dv.quarter or dv.year,
+            value=str(dv.numeric_value),
+        )
+        sample.update(extra)
+        return sample
+
+    def write(self, dv_batch):
+        # made up (negative) ids stand for things a dry run would create, those can't be stored yet
+        existing = fetch_existing((dv_key(dv) for dv in dv_batch if dv.data_element_id > 0 and dv.category_combo_id > 0 and dv.org_unit_id > 0), using=self.using)
+
+        for dv in dv_batch:
+            key = dv_key(dv)
+            if key in self.keys:
+                self.num_duplicates += 1
+                if len(self.duplicate_samples) < self.sample_size:
+                    self.duplicate_samples.append(self.sample(dv))
+            self.keys.add(key)
+
+            if key in existing:
+                self.num_existing += 1
+                if existing[key].numeric_value != dv.numeric_value:
+                    self.num_existing_changed += 1
+                    if len(self.existing_samples) < self.sample_size:
+                        self.existing_samples.append(self.sample(dv, stored_value=str(existing[key].numeric_value)))
+
+            de = dv.data_element
+            if (de.value_min is not None and dv.numeric_value < de.value_min) or (de.value_max is not None and dv.numeric_value > de.value_max):
+                self.num_out_of_range += 1
+                if len(self.out_of_range_samples) < self.sample_size:
+                    self.out_of_range_samples.append(self.sample(dv, value_min=str_or_none(de.value_min), value_max=str_or_none(de.value_max)))
+
+        self.num_values += len(dv_batch)
+
+    def finish(self):
+        return self.num_values
+
+    def profile(self):
+        return dict(
+            num_values=self.num_values,
+            num_keys=len(self.keys),
+            num_duplicates=self.num_duplicates,
+            duplicate_samples=self.duplicate_samples,
+            num_existing=self.num_existing,
+            num_existing_changed=self.num_existing_changed,
+            existing_samples=self.existing_samples,
+            num_out_of_range=self.num_out_of_range,
+            out_of_range_samples=self.out_of_range_samples,
+        )
+
+LOADERS = {
+    'copy': CopyLoader,
+    'bulk_create': BulkCreateLoader,
+    'copy_upsert': CopyUpsertLoader,
+    'bulk_upsert': BulkUpsertLoader,
+}
+
+def get_loader(name=None, using='default', upsert=False):
+    """
+    Return a loader instance, by name, or the fastest one available for the
+    database when no name is given. Upsert loaders merge values into the
+    existing ones instead of failing on a duplicate key
+    """
+    if name is None:
+        if connections[using].vendor == 'postgresql':
+            name = 'copy_upsert' if upsert else 'copy'
+        else:
+            name = 'bulk_upsert' if upsert else 'bulk_create'
+    logger.debug('DataValue loader: %s' % (name,))
+    return LOADERS[name](using=using)
@@ -0,0 +1,205 @@
+"""
+Caching of dashboard values and responses.
+
+Dashboards only change when the data does, so what they compute is cached
+under a key made of the view, its parameters and the data version
+(models.current_data_version(), bumped by every aggregate refresh and data
+element change). Nothing is ever invalidated explicitly: a new version makes
+new keys and the entries of older versions age out of the LRU.
+
+The cache is the DASHBOARD_CACHE alias of settings.CACHES, LRUMemoryCache by
+default so no cache server is needed (any Django backend will do, eg.
+FileBasedCache to share the cache between worker processes).
+
+The same version gives the dashboards an ETag and Last-Modified time, so
+browsers that have a page already get a 304 for the price of one lookup
+(conditional_dashboard)
+"""
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+import logging
+logger = logging.getLogger(__name__)
+
+DASHBOARD_CACHE = 'dashboards'
+
+class LRUMemoryCache(BaseCache):
+    """
+    Process local cache evicting the least recently used entries, once there
+    are more than MAX_ENTRIES of them or their pickled size is over MAX_SIZE
+    bytes (OPTIONS of the cache settings)
+    """
+    def __init__(self, name, params):
+        super(LRUMemoryCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self.max_size = int(options.get('MAX_SIZE', 64*1024*1024))
+        self.entries = OrderedDict() # key => (expiry time or None, pickled value), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _get_entry(self, key):
+        # the caller holds the lock
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expiry, pickled = entry
+        if expiry is not None and expiry <= time.time():
+            self._delete(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _delete(self, key):
+        _, pickled = self.entries.pop(key)
+        self.size -= len(pickled)
+
+    def _set(self, key, value, timeout):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if key in self.entries:
+            self._delete(key)
+        self.entries[key] = (self.get_backend_timeout(timeout), pickled)
+        self.size += len(pickled)
+        while self.entries and (len(self.entries) > self._max_entries or self.size > self.max_size):
+            self._delete(next(iter(self.entries)))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            if self._get_entry(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            entry = self._get_entry(key)
+        if entry is None:
+            return default
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            self._set(key, value, timeout)
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            if key in self.entries:
+                self._delete(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self.lock:
+            return self._get_entry(key) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+def dashboard_cache():
+    from django.core.cache import caches
+
+    return caches[DASHBOARD_CACHE]
+
+def dashboard_cache_key(kind, name, params, version=None):
+    from .models import current_data_version
+
+    if version is None:
+        version = current_data_version()
+    key_src = repr((kind, name, params, version))
+    return 'cannula:%s:%s' % (kind, hashlib.md5(key_src.encode('utf-8')).hexdigest())
+
+def cached_values(request, name, compute, *args):
+    """
+    compute(*args), or what it returned before for the same args and data
+    version (the one the request looked up, see request_data_version()). For
+    the values (template context) of a dashboard, shared by its output formats
+    """
+    cache = dashboard_cache()
+    key = dashboard_cache_key('values', name, args, version=request_data_version(request)[0])
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    values = compute(*args)
+    cache.set(key, values)
+    return values
+
+def cache_dashboard(view_func):
+    """
+    View decorator caching the successful responses to GET requests, keyed
+    by the view, the query string, the view arguments, the day (for views
+    that default to the current period) and the data version
+    """
+    from django.http import HttpResponse
+
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view_func(request, *args, **kwargs)
+
+        from datetime import date
+
+        params = (sorted(request.GET.lists()), args, sorted(kwargs.items()), date.today().isoformat())
+        cache = dashboard_cache()
+        key = dashboard_cache_key('response', view_func.__name__, params, version=request_data_version(request)[0])
+        cached = cache.get(key)
+        if cached is not None:
+            content, headers = cached
+            response = HttpResponse(content)
+            for header, value in headers:
+                response[header] = value
+            return response
+
+        response = view_func(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming:
+            headers = [(header, response[header]) for header in ('Content-Type', 'Content-Disposition') if response.has_header(header)]
+            cache.set(key, (response.content, headers))
+        return response
+    return wrapper
+
+def request_data_version(request):
+    """The (version, changed at) of the data, looked up once per request"""
+    if not hasattr(request, '_data_version'):
+        from .models import data_version_changed
+
+        request._data_version = data_version_changed()
+    return request._data_version
+
+def dashboard_etag(request, *args, **kwargs):
+    from datetime import date
+
+    version, _ = request_data_version(request)
+    etag_src = repr((request.path, sorted(request.GET.lists()), args, sorted(kwargs.items()), date.today().isoformat(), version))
+    return hashlib.md5(etag_src.encode('utf-8')).hexdigest()
+
+def dashboard_last_modified(request, *args, **kwargs):
+    from django.utils import timezone
+
+    _, changed_at = request_data_version(request)
+    # the default period of a dashboard can change overnight, without the data
+    start_of_day = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(changed_at, start_of_day) if changed_at else start_of_day
+
+def conditional_dashboard(view_func):
+    """
+    View decorator answering conditional GETs (If-None-Match,
+    If-Modified-Since) with 304 Not Modified before the view runs, while the
+    data version and the day stay the same
+    """
+    from django.views.decorators.http import condition
+
+    return condition(etag_func=dashboard_etag, last_modified_func=dashboard_last_modified)(view_func)
@@ -0,0 +1,291 @@
+"""
+Declarative dashboards (scorecards).
+
+A Dashboard lists the data element series it reads, how their category
+combos are bucketed, the measures derived from them and the columns shown,
+for every org unit at one level. evaluate() compiles the series into a single
+grouped query on the pre-aggregated values, whatever their period windows
+(the relabelling of elements and category combos is done in SQL with CASE),
+fills a grid.Grid with the rows (in whatever order they come) and computes
+the derived measures as NumPy masked array expressions over all the org
+units at once (a masked value is a missing one).
+
+The result is what the scorecard templates iterate: a list of
+[org unit names, [cell dict, ...]] rows and the (header, category) pairs of
+the columns
+"""
+from itertools import product
+
+from django.db.models import Case, CharField, F, Q, Sum, Value, When
+
+import logging
+logger = logging.getLogger(__name__)
+
+class CategoryBucket():
+    """
+    Category combos that include any of the categories and whose name
+    contains name_contains (or doesn't, with exclude), summed under the label
+    """
+    def __init__(self, label, categories, name_contains=None, exclude=False):
+        self.label = label
+        self.categories = frozenset(categories)
+        self.name_contains = name_contains
+        self.exclude = exclude
+
+    def matches(self, cc_name, cat_names):
+        if not self.categories.intersection(cat_names):
+            return False
+        if self.name_contains is None:
+            return True
+        return (self.name_contains in cc_name) != self.exclude
+
+class Series():
+    """
+    Data elements read together. Their values are summed per element, under
+    one alias for all of them or under aliases[element name]. Category combos
+    are summed away unless buckets (CategoryBucket list) are given, or
+    category_combos lists the category combo names to keep. With period='year'
+    the series takes the whole year of the dashboard period, sums are divided
+    by divisor if there is one (eg. 4 for the quarter's share of a target)
+    """
+    def __init__(self, elements, alias=None, aliases=None, buckets=None, category_combos=None, period=None, divisor=None):
+        self.elements = tuple(elements)
+        self.aliases = dict(aliases or ((de_name, alias) for de_name in self.elements if alias))
+        self.buckets = tuple(buckets or ())
+        self.category_combos = tuple(category_combos or ())
+        self.period = period
+        self.divisor = divisor
+
+    def measures(self):
+        """The measure names, in element order"""
+        names = list()
+        for de_name in self.elements:
+            name = self.aliases.get(de_name, de_name)
+            if name not in names:
+                names.append(name)
+        return names
+
+    def categories(self):
+        if self.buckets:
+            return [b.label for b in self.buckets]
+        if self.category_combos:
+            return list(self.category_combos)
+        return [None]
+
+    def columns(self):
+        return list(product(self.measures(), self.categories()))
+
+    def period_of(self, dashboard_period):
+        if self.period == 'year':
+            return dashboard_period[:4]
+        return dashboard_period
+
+class Col():
+    """A measure (a series column or a derived measure) by name and category"""
+    def __init__(self, measure, category=None):
+        self.key = (measure, category)
+
+    def evaluate(self, grid):
+        return grid.column(self.key)
+
+class Const():
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, grid):
+        import numpy as np
+
+        return np.ma.MaskedArray(np.full(len(grid.rows), self.value, dtype=float), mask=False)
+
+def as_expr(x):
+    return x if hasattr(x, 'evaluate') else Const(x)
+
+class Total():
+    """Sum of the terms, missing values count as zero so there always is one"""
+    def __init__(self, *terms):
+        self.terms = [as_expr(t) for t in terms]
+
+    def evaluate(self, grid):
+        import numpy as np
+
+        total = np.zeros(len(grid.rows))
+        for t in self.terms:
+            total += t.evaluate(grid).filled(0)
+        return np.ma.MaskedArray(total, mask=False)
+
+class Quotient():
+    """numerator*scale/denominator, missing unless both are there and the denominator isn't zero"""
+    def __init__(self, numerator, denominator, scale=1):
+        self.numerator = as_expr(numerator)
+        self.denominator = as_expr(denominator)
+        self.scale = scale
+
+    def evaluate(self, grid):
+        import numpy as np
+
+        num, den = self.numerator.evaluate(grid), self.denominator.evaluate(grid)
+        missing = np.ma.getmaskarray(num) | np.ma.getmaskarray(den) | (den.filled(0) == 0)
+        # divide by 1 where the result is missing anyway, to keep clear of division by zero
+        result = num.filled(0) * self.scale / np.where(missing, 1, den.filled(1))
+        return np.ma.MaskedArray(result, mask=missing)
+
+def Percent(numerator, denominator):
+    return Quotient(numerator, denominator, scale=100)
+
+# org unit levels dashboards are drawn at: (level, grain of the aggregates, the aggregate field the org units are
+# grouped by, names of the label fields, OrgUnit fields of the labels)
+LEVELS = {
+    'district': (1, 'district_years', 'org_unit', ('district',), ('name',)),
+    'subcounty': (2, 'facility_quarters', 'subcounty_ou', ('district', 'subcounty'), ('parent__name', 'name')),
+    'facility': (3, 'facility_quarters', 'org_unit', ('district', 'subcounty', 'facility'), ('parent__parent__name', 'parent__name', 'name')),
+}
+
+def level_org_units(level):
+    """The (id, names) of the org units at a level of LEVELS, in name order"""
+    from .models import OrgUnit
+
+    ou_level, _, _, _, label_fields = LEVELS[level]
+    rows = [(ou_id, tuple(names)) for ou_id, *names in OrgUnit.objects.filter(level=ou_level).values_list('id', *label_fields)]
+    return sorted(rows, key=lambda r: tuple(n or '' for n in r[1]))
+
+class Dashboard():
+    """
+    Series of data elements, measures derived from them (name => expression,
+    evaluated in order so they may refer to each other, a name is either a
+    plain measure name or a (name, category) pair) and the columns shown, as
+    (measure, category) or (measure, category, header) tuples, for each org
+    unit of a level in LEVELS
+    """
+    def __init__(self, level, series, derived=(), columns=()):
+        self.level = level
+        self.series = list(series)
+        self.derived = list(derived)
+        self.columns = [c if len(c) == 3 else (c[0], c[1], c[0]) for c in columns]
+
+    def headers(self):
+        """The (header, category) of each column, as the templates expect them in data_element_names"""
+        return [(header, category) for _, category, header in self.columns]
+
+    def org_units(self):
+        return level_org_units(self.level)
+
+    def category_combo_buckets(self, series):
+        """Category combo id => bucket label for a bucketed series"""
+        from .models import CategoryCombo
+
+        cc_cats = dict()
+        for cc_id, cc_name, cat_name in CategoryCombo.objects.values_list('id', 'name', 'categories__name'):
+            cc_cats.setdefault(cc_id, (cc_name, set()))[1].add(cat_name)
+        buckets = dict()
+        for cc_id, (cc_name, cat_names) in cc_cats.items():
+            for bucket in series.buckets:
+                if bucket.matches(cc_name, cat_names):
+                    buckets[cc_id] = bucket.label
+                    break
+        return buckets
+
+    def query_groups(self):
+        """
+        Split the series into groups read with one query each, all of them
+        unless a data element is read by two series
+        """
+        groups = list()
+        for series in self.series:
+            for group in groups:
+                if not any(set(series.elements).intersection(s.elements) for s in group):
+                    group.append(series)
+                    break
+            else:
+                groups.append([series])
+        return groups
+
+    def query(self, period, group):
+        """
+        One grouped query for a group of series, however many period windows
+        they have: the WHERE clause ORs the (elements, window) pair of each
+        series and CASE maps element ids to measure names and category combos
+        to categories, so the database scans the values once and returns
+        (org unit id, measure, category, sum) rows for all the series, the
+        org unit id under the group field of the level (see LEVELS)
+        """
+        from .models import AggregateValue, DataValueQuerySet, DATA_ELEMENT_REGISTRY
+
+        _, grain, group_field, _, _ = LEVELS[self.level]
+        series_filters, measure_whens, category_whens = None, list(), list()
+        for series in group:
+            window_q = DataValueQuerySet.period_q(series.period_of(period))
+            series_ids = DATA_ELEMENT_REGISTRY.lookup(*series.elements)
+            if window_q is None or not series_ids:
+                continue
+            series_q = Q(data_element_id__in=series_ids) & window_q
+            series_filters = series_filters | series_q if series_filters else series_q
+
+            cc_buckets = self.category_combo_buckets(series) if series.buckets else dict()
+            for de_name in series.elements:
+                de_ids = DATA_ELEMENT_REGISTRY.lookup(de_name)
+                if not de_ids:
+                    continue
+                measure_whens.append(When(data_element_id__in=de_ids, then=Value(series.aliases.get(de_name, de_name))))
+                if series.buckets:
+                    by_label = dict()
+                    for cc_id, label in cc_buckets.items():
+                        by_label.setdefault(label, list()).append(cc_id)
+                    category_whens.extend(When(Q(data_element_id__in=de_ids) & Q(category_combo_id__in=cc_ids), then=Value(label)) for label, cc_ids in by_label.items())
+                elif series.category_combos:
+                    category_whens.append(When(data_element_id__in=de_ids, then=F('category_combo__name')))
+        if series_filters is None:
+            return []
+
+        qs = getattr(AggregateValue.objects, grain)().filter(series_filters)
+        qs = qs.annotate(measure=Case(*measure_whens, output_field=CharField()))
+        if category_whens:
+            qs = qs.annotate(category=Case(*category_whens, default=Value(None), output_field=CharField()))
+        else:
+            qs = qs.annotate(category=Value(None, output_field=CharField()))
+        return qs.order_by().values(group_field, 'measure', 'category').annotate(numeric_sum=Sum('numeric_sum'))
+
+    def fetch(self, period, grid):
+        """
+        Fill the grid (org unit ids by (measure, category)) with the series
+        values, each query's rows are fanned out to the series they belong to
+        """
+        _, _, group_field, _, _ = LEVELS[self.level]
+        for group in self.query_groups():
+            divisors = dict()
+            for series in group:
+                for key in series.columns():
+                    divisors[key] = series.divisor
+
+            def group_values():
+                for row in self.query(period, group):
+                    key = (row['measure'], row['category'])
+                    if key not in divisors:
+                        continue # outside of the buckets or category combos of the series
+                    if row['numeric_sum'] is not None and divisors[key]:
+                        row['numeric_sum'] = row['numeric_sum'] / divisors[key]
+                    yield row
+            grid.fill(group_values(), lambda row: row[group_field], lambda row: (row['measure'], row['category']))
+
+    def evaluate(self, period):
+        """
+        Return the rows ([org unit names, [cell dict, ...]], ...) and the column
+        headers of the dashboard for a period (a quarter or a year, as for when())
+        """
+        from .grid import Grid
+
+        _, _, _, label_names, _ = LEVELS[self.level]
+        org_units = self.org_units()
+        derived_keys = [name if isinstance(name, tuple) else (name, None) for name, _ in self.derived]
+        grid = Grid([ou_id for ou_id, _ in org_units], [key for series in self.series for key in series.columns()] + derived_keys)
+        self.fetch(period, grid)
+        # the derived measures, a whole column at a time
+        for key, (_, expr) in zip(derived_keys, self.derived):
+            grid.set_column(key, expr.evaluate(grid))
+
+        shown = [(measure, category) for measure, category, _ in self.columns]
+        rows = list()
+        for ou_id, labels in org_units:
+            label_dict = dict(zip(label_names, labels))
+            cells = [dict(label_dict, de_name=measure, cat_combo=category, numeric_sum=value) for (measure, category), value in zip(shown, grid.row_values(ou_id, shown))]
+            rows.append([labels, cells])
+        return rows, self.headers()
@@ -78,22 +78,6 @@ def dates_to_iso_periods(ydate, qdate, mdate):
         if ydate:
             return iso_year, None, None
 
-def rasterize(rows, columns, values, row_index_func, col_index_func, default_func=lambda r, c: None):
-    """
-    Take sparse value sequence and go through the coordinate space filling each
-    address with a value from the sequence of values or a computed default
-    """
-    i_values = iter(values)
-    for i, row in enumerate(rows):
-        for j, col in enumerate(columns):
-            if i == 0 and j == 0:
-                curr_val = next(i_values, default_func(row, col))
-            if curr_val is not None and row == row_index_func(curr_val) and col == col_index_func(curr_val):
-                yield curr_val
-                curr_val = next(i_values, default_func(row, col))
-            else:
-                yield default_func(row, col)
-
 def default(*args, fillvalue=None):
     try:
         return next(filter(lambda x: x is not None, args))
@@ -105,3 +89,25 @@ def default_zero(*args):
 
 def all_not_none(*args):
     return all(map(lambda x: x is not None, args))
+
+def chunked(iterable, chunk_size):
+    """
+    Split an iterable into lists of (at most) chunk_size items
+
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+
+    """
+    from itertools import islice
+
+    it = iter(iterable)
+    chunk = list(islice(it, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, chunk_size))
+
+def peak_rss_kb():
+    """Peak resident set size of this process and of its (finished) child processes, in KiB"""
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
@@ -0,0 +1,97 @@
+"""
+Dense grids of dashboard values, addressed by (row key, column key) rather
+than by the order query results come back in.
+
+A Grid holds a NumPy array of values and a mask of the cells that have none,
+it is filled from query results in any order (so dashboard queries need no
+ORDER BY) and read a column (as a masked array, for calculations) or a row
+(as a list, for templates) at a time
+"""
+
+class Grid():
+    """
+    >>> g = Grid(['Kampala', 'Gulu'], [('Tested', None), ('HIV+', None)])
+    >>> g.fill([{'ou': 'Gulu', 'de': 'HIV+', 'n': 3}, {'ou': 'Kampala', 'de': 'Tested', 'n': 10}, {'ou': 'Mbale', 'de': 'Tested', 'n': 1}], lambda v: v['ou'], lambda v: (v['de'], None), 'n')
+    2
+    >>> g.row_values('Kampala'), g.row_values('Gulu')
+    ([10.0, None], [None, 3.0])
+    >>> g.column(('HIV+', None)).tolist()
+    [None, 3.0]
+
+    """
+    def __init__(self, rows, columns, dtype=float):
+        import numpy as np
+
+        self.rows = list(rows)
+        self.columns = list(columns)
+        self.row_index = dict((r, i) for i, r in enumerate(self.rows))
+        self.column_index = dict((c, j) for j, c in enumerate(self.columns))
+        self.values = np.zeros((len(self.rows), len(self.columns)), dtype=dtype)
+        self.mask = np.ones((len(self.rows), len(self.columns)), dtype=bool) # True where there is no value
+
+    def fill(self, values, row_key, column_key, value_key='numeric_sum'):
+        """
+        Set the cells from a sequence of value dicts (eg. query results) in any
+        order. Values outside of the rows and columns are ignored, as are None
+        values. Values for the same cell (eg. of rows grouped finer than the
+        grid) are added up, so is a value for a cell already set. Returns the
+        number of values added
+
+        >>> g = Grid(['Gulu'], ['Tested'])
+        >>> g.fill([{'ou': 'Gulu', 'n': 3}, {'ou': 'Gulu', 'n': 4}], lambda v: v['ou'], lambda v: 'Tested', 'n'), g.get('Gulu', 'Tested')
+        (2, 7.0)
+
+        """
+        num_set = 0
+        for v in values:
+            i = self.row_index.get(row_key(v))
+            j = self.column_index.get(column_key(v))
+            if i is None or j is None or v[value_key] is None:
+                continue
+            if self.mask[i, j]:
+                self.values[i, j] = v[value_key]
+                self.mask[i, j] = False
+            else:
+                self.values[i, j] += self.values.dtype.type(v[value_key]) # eg. Decimal sums don't add to floats
+            num_set += 1
+        return num_set
+
+    def get(self, row, column):
+        i, j = self.row_index[row], self.column_index[column]
+        return None if self.mask[i, j] else self.values[i, j].item()
+
+    def column(self, column):
+        """A masked array (a view, not a copy) of the values of a column over all the rows"""
+        import numpy as np
+
+        j = self.column_index[column]
+        return np.ma.MaskedArray(self.values[:, j], mask=self.mask[:, j])
+
+    def set_column(self, column, values):
+        """Set a whole column from a masked array, or a sequence with None for missing values"""
+        import numpy as np
+
+        j = self.column_index[column]
+        if isinstance(values, np.ma.MaskedArray):
+            self.values[:, j] = values.filled(0)
+            self.mask[:, j] = np.ma.getmaskarray(values)
+        else:
+            self.mask[:, j] = [v is None for v in values]
+            self.values[:, j] = [0 if v is None else v for v in values]
+
+    def column_values(self, column):
+        """The values of a column as a list, with None for the missing ones"""
+        j = self.column_index[column]
+        return [None if m else v for v, m in zip(self.values[:, j].tolist(), self.mask[:, j].tolist())]
+
+    def row_values(self, row, columns=None):
+        """The values of a row (in the order of columns, all of them by default) as a list, with None for the missing ones"""
+        i = self.row_index[row]
+        js = range(len(self.columns)) if columns is None else [self.column_index[c] for c in columns]
+        values, mask = self.values[i].tolist(), self.mask[i].tolist()
+        return [None if mask[j] else values[j] for j in js]
+
+    def iter_rows(self, columns=None):
+        """(row key, row values) for each row, in row order"""
+        for row in self.rows:
+            yield row, self.row_values(row, columns)
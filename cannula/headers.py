@@ -0,0 +1,104 @@
+"""
+Splits worksheet column headers into a data element name and the categories
+the values are disaggregated by, eg. '105-EID Tested Female 15+' into
+('105-EID Tested', ('Female', '15+')).
+
+Categories are found with a longest-match trie walk at each position that
+follows a separator, so overlapping names ('Lost' and 'Lost  to Followup')
+always resolve to the longest one, whatever their order in the list. Results
+are memoized for the life of the process, so headers repeated across
+worksheets and uploads are only parsed once
+"""
+SEPARATORS = frozenset(' \t\r\n\f\v,') # what may come before a category name
+
+class HeaderParser():
+    """
+    >>> p = HeaderParser(['Male', 'Female', 'Lost', 'Lost  to Followup', '15+'], sexless_categories=['Lost', 'Lost  to Followup', '15+'], icky_phrases=['Male partners'])
+    >>> p.parse('105-EID Tested Female, 15+')
+    ('105-EID Tested', ('Female', '15+'))
+    >>> p.parse('106a Cohort  All patients 12 months Lost  to Followup')
+    ('106a Cohort  All patients 12 months', ('Lost  to Followup',))
+    >>> p.parse('105-2.1a Male partners received HIV test results in eMTCT')
+    ('105-2.1a Male partners received HIV test results in eMTCT', ())
+    >>> sorted(p.element_categories['105-EID Tested'])
+    ['15+', 'Female']
+
+    """
+    def __init__(self, categories, sexless_categories=None, icky_phrases=()):
+        self.categories = frozenset(categories)
+        self.trie = self.build_trie(categories)
+        # headers containing one of these phrases name a sex themselves, only match the other categories
+        self.sexless_trie = self.build_trie(categories if sexless_categories is None else sexless_categories)
+        self.icky_phrases = tuple(s.upper() for s in icky_phrases)
+        self.cache = dict() # header => (data element name, category names)
+        self.element_categories = dict() # data element name => set of the category names seen with it
+
+    @staticmethod
+    def build_trie(categories):
+        root = dict()
+        for categ in categories:
+            node = root
+            for ch in categ:
+                node = node.setdefault(ch, dict())
+            node[None] = categ # end of a category name
+        return root
+
+    @staticmethod
+    def longest_match(trie, s, start):
+        """Return the longest category name in the trie that starts at s[start], or None"""
+        node, found = trie, None
+        for ch in s[start:]:
+            node = node.get(ch)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def split(self, header, trie):
+        """
+        Split the header around the categories found in it, the same way
+        re.split() with a separator + (category) pattern would: text and
+        category names alternate, separators before a category are dropped
+        """
+        pieces = list()
+        text_start = i = 0
+        while i < len(header):
+            if header[i] in SEPARATORS:
+                sep_start = i
+                while i < len(header) and header[i] in SEPARATORS:
+                    i += 1
+                categ = self.longest_match(trie, header, i)
+                if categ:
+                    pieces.extend((header[text_start:sep_start], categ))
+                    i += len(categ)
+                    text_start = i
+            else:
+                i += 1
+        pieces.append(header[text_start:])
+        return pieces
+
+    def parse(self, header):
+        """Return (data element name, tuple of category names) for a column header"""
+        try:
+            return self.cache[header]
+        except KeyError:
+            pass
+
+        header_upper = header.upper()
+        if any(s in header_upper for s in self.icky_phrases):
+            pieces = self.split(header, self.sexless_trie)
+        else:
+            pieces = self.split(header, self.trie)
+        # squash list of matches by removing blank entries
+        de_name, *category_list = filter(None, pieces)
+
+        # deals with cases where the data element name includes text that follows a subcategory,
+        # the whole header is taken as the name then (the list is kept as is, existing category combos depend on it)
+        if any(cat not in self.categories for cat in category_list):
+            if ' '.join(category_list) not in self.categories:
+                de_name = header
+
+        parsed = (de_name, tuple(category_list))
+        self.cache[header] = parsed
+        self.element_categories.setdefault(de_name, set()).update(category_list)
+        return parsed
@@ -0,0 +1,248 @@
+"""
+Background ingestion: web requests queue an IngestionJob and return straight
+away, worker processes (manage.py ingest_worker) claim queued jobs and run them
+"""
+import json
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.db.models import Q
+from django.utils import timezone
+
+from . import grabbag
+from .models import IngestionJob, IngestionStats, DataValue, save_source_datavalues, profile_source_datavalues, load_excel_to_validations, aggregate_keys, refresh_document_aggregates
+
+import logging
+logger = logging.getLogger(__name__)
+
+# a second connection to the same database (settings.DATABASES), progress written
+# through it is committed (and visible to the web views) apart from the job's writes
+PROGRESS_DB_ALIAS = 'ingest_progress'
+
+# the fields of a job run_job() sets
+JOB_RESULT_FIELDS = ('status', 'phase', 'rows_total', 'rows_done', 'rows_skipped', 'values_done', 'values_inserted', 'values_updated', 'values_unchanged', 'message', 'report', 'finished_at')
+
+def queue_job(source_doc, kind):
+    return IngestionJob.objects.create(source_doc=source_doc, kind=kind)
+
+class JobProgress():
+    """
+    Progress callback for the ingestion functions, records the phase and counts
+    on the job. The phases take turns for every chunk of rows, so only the first
+    start of a phase is written straight away, the rest at most every
+    min_interval seconds
+    """
+    min_interval = 1.0 # seconds between progress writes
+
+    def __init__(self, job):
+        self.job = job
+        self.last_write = 0.0
+        self.phases_started = set()
+
+    def __call__(self, phase, **counts):
+        self.job.phase = phase
+        for k, v in counts.items():
+            setattr(self.job, k, v) # saved with the job when it ends, if not before
+        now = time.monotonic()
+        if phase in self.phases_started and now - self.last_write < self.min_interval:
+            return
+        self.phases_started.add(phase)
+        IngestionJob.objects.using(PROGRESS_DB_ALIAS).filter(id=self.job.id).update(phase=phase, **counts)
+        self.last_write = now
+
+class CountingCursorWrapper(CursorWrapper):
+    """Cursor wrapper counting the statements executed through it on a PhaseStats"""
+    def __init__(self, cursor, db, counter):
+        super(CountingCursorWrapper, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter.queries += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.queries += 1
+        return self.cursor.executemany(sql, param_list)
+
+class PhaseStats():
+    """
+    Wraps a progress callback to measure each phase of a job: wall time, the
+    last row/value counts reported, queries on the default database and the
+    peak memory of the process. The phases take turns for every chunk of
+    rows, their time and queries are added up into one IngestionStats per
+    phase, which save() stores.
+
+    Queries are counted by wrapping the cursors of the connection (without
+    keeping them, unlike a debug cursor). Only execute() and executemany()
+    are counted, the COPY statements of the copy loaders (cursor.copy_from())
+    are not
+    """
+    def __init__(self, job, progress):
+        self.job = job
+        self.progress = progress
+        self.phase = None
+        self.stats = OrderedDict() # phase => IngestionStats, in the order the phases first started
+        self.queries = 0 # since the current phase last started
+        self.connection = connections['default']
+
+    def start(self):
+        for make_name in ('make_cursor', 'make_debug_cursor'):
+            make_cursor = getattr(self.connection, make_name)
+            setattr(self.connection, make_name, lambda cursor, make_cursor=make_cursor: CountingCursorWrapper(make_cursor(cursor), self.connection, self))
+
+    def end_phase(self):
+        if self.phase is not None:
+            phase_stats = self.stats[self.phase]
+            phase_stats.wall_secs += time.perf_counter() - self.phase_start
+            phase_stats.queries += self.queries
+            phase_stats.peak_rss_kb = grabbag.peak_rss_kb()
+        self.queries = 0
+
+    def __call__(self, phase, **counts):
+        if phase != self.phase:
+            self.end_phase()
+            self.phase, self.phase_start = phase, time.perf_counter()
+            if phase not in self.stats:
+                self.stats[phase] = IngestionStats(source_doc=self.job.source_doc, job=self.job, kind=self.job.kind, phase=phase, wall_secs=0.0, queries=0)
+        phase_stats = self.stats[phase]
+        if 'rows_done' in counts or 'rows_total' in counts:
+            phase_stats.rows = counts.get('rows_done', counts.get('rows_total')) or 0
+        if 'values_done' in counts:
+            phase_stats.values = counts['values_done']
+        self.progress(phase, **counts)
+
+    def finish(self):
+        self.end_phase()
+        self.phase = None
+        for make_name in ('make_cursor', 'make_debug_cursor'):
+            delattr(self.connection, make_name) # back to the methods of the class
+
+    def save(self):
+        IngestionStats.objects.bulk_create(self.stats.values())
+
+class Heartbeat(threading.Thread):
+    """
+    Marks a job as alive every settings.INGEST_JOB_HEARTBEAT_SECS while it
+    runs, even through long statements. The heartbeats stop with the worker,
+    so a job whose worker crashed or was killed can be spotted and requeued
+    """
+    def __init__(self, job):
+        super(Heartbeat, self).__init__(daemon=True)
+        self.job_id = job.id
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.INGEST_JOB_HEARTBEAT_SECS):
+                IngestionJob.objects.using(PROGRESS_DB_ALIAS).filter(id=self.job_id).update(heartbeat_at=timezone.now())
+        finally:
+            connections[PROGRESS_DB_ALIAS].close() # this thread's own connection
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def requeue_stale_jobs():
+    """
+    Put the running jobs without a heartbeat for settings.INGEST_JOB_STALE_SECS
+    back in the queue, their worker is gone. Returns the number of jobs requeued
+    """
+    stale_before = timezone.now() - timedelta(seconds=settings.INGEST_JOB_STALE_SECS)
+    stale_jobs = IngestionJob.objects.filter(status='RUNNING').filter(Q(heartbeat_at__lt=stale_before) | Q(heartbeat_at__isnull=True, started_at__lt=stale_before))
+    num_requeued = stale_jobs.update(status='QUEUED', phase=None, message='Requeued, the worker running it stopped responding')
+    if num_requeued:
+        logger.warning('Requeued %d stale ingestion job(s)' % (num_requeued,))
+    return num_requeued
+
+def claim_next_job():
+    """
+    Mark the oldest queued job as running and return it, or None when the queue
+    is empty. The conditional UPDATE makes this safe with several workers.
+    Stale running jobs are requeued first
+    """
+    requeue_stale_jobs()
+    for job_id in IngestionJob.objects.filter(status='QUEUED').order_by('created_at', 'id').values_list('id', flat=True)[:10]:
+        now = timezone.now()
+        if IngestionJob.objects.filter(id=job_id, status='QUEUED').update(status='RUNNING', started_at=now, heartbeat_at=now):
+            return IngestionJob.objects.get(id=job_id)
+    return None
+
+def run_job(job):
+    """
+    Run a claimed job. The values are committed a batch at a time (see
+    save_source_datavalues()) rather than in one transaction for the whole
+    document, so a job that is run again, eg. after being requeued, starts
+    over: a plain load first deletes the values an earlier run of the same
+    document committed, a merge simply merges them again.
+
+    The results are only saved if the job is still the one claimed, not
+    requeued (and maybe claimed by another worker) while it ran
+    """
+    from .bulkload import get_loader
+
+    claim = dict(status=job.status, started_at=job.started_at) # claim_next_job() sets a new started_at
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    progress = PhaseStats(job, JobProgress(job))
+    progress.start()
+    stale_keys = set() # of the aggregates of values deleted before a reload
+    try:
+        if job.kind == 'VALIDATIONS':
+            load_excel_to_validations(job.source_doc, progress=progress)
+        elif job.kind == 'DRY_RUN':
+            profile = profile_source_datavalues(job.source_doc, progress=progress)
+            job.values_done = profile['num_values']
+            job.report = json.dumps(profile)
+        else:
+            upsert = (job.kind == 'UPSERT')
+            if not upsert:
+                loaded_values = DataValue.objects.filter(source_doc=job.source_doc)
+                stale_keys = aggregate_keys(loaded_values)
+                loaded_values.delete()
+            loader = get_loader(upsert=upsert)
+            # a merge only needs the rows that changed since the previous version of the document
+            job.values_done = save_source_datavalues(job.source_doc, loader=loader, progress=progress, processes=settings.INGEST_PARSE_PROCESSES, skip_unchanged=upsert)
+            if upsert:
+                job.values_inserted, job.values_updated, job.values_unchanged = loader.num_inserted, loader.num_updated, loader.num_unchanged
+            # the dashboards read the pre-aggregated values, bring those the document added to up to date
+            progress('rollup')
+            refresh_document_aggregates(job.source_doc, stale_keys)
+        job.status = 'DONE'
+    except Exception:
+        logger.exception('Ingestion job %d failed' % (job.id,))
+        job.status = 'FAILED'
+        job.message = traceback.format_exc()
+        if job.kind in ('VALUES', 'UPSERT'):
+            # the batches committed before the failure have to add up too
+            try:
+                refresh_document_aggregates(job.source_doc, stale_keys)
+            except Exception:
+                logger.exception('Aggregates of ingestion job %d not refreshed' % (job.id,))
+    progress.finish()
+    heartbeat.stop()
+
+    job.finished_at = timezone.now()
+    results = dict((name, getattr(job, name)) for name in JOB_RESULT_FIELDS)
+    if not IngestionJob.objects.filter(id=job.id, **claim).update(**results):
+        logger.warning('Ingestion job %d was requeued while it ran, its results (%s) are not saved' % (job.id, job.status))
+    progress.save()
+    return job
+
+def work(poll_interval=2.0, once=False):
+    """Run queued jobs one after the other, waiting for new ones unless once is set"""
+    logger.info('Ingestion worker %d started' % (os.getpid(),))
+    while True:
+        job = claim_next_job()
+        if job is not None:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
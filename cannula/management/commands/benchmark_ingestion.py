@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from ...benchmark import time_ingestion
+from ...bulkload import LOADERS
+
+class Command(BaseCommand):
+    help = 'Time the ingestion phases on a generated HMIS workbook (rolled back afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--districts', type=int, default=4)
+        parser.add_argument('--subcounties', type=int, default=5, help='subcounties per district')
+        parser.add_argument('--facilities', type=int, default=10, help='facilities per subcounty')
+        parser.add_argument('--elements', type=int, default=50, help='data element columns')
+        parser.add_argument('--months', type=int, default=12, help='rows per facility, one per month')
+        parser.add_argument('--loader', choices=sorted(LOADERS), help='loader backend, defaults to the fastest for the database')
+        parser.add_argument('--processes', type=int, default=1, help='parse worker processes, 1 parses in this process')
+        parser.add_argument('--seed', type=int, default=0, help='seed for the generated names and values')
+
+    def handle(self, *args, **options):
+        results = time_ingestion(
+            options['districts'], options['subcounties'], options['facilities'], options['elements'], options['months'],
+            loader_name=options['loader'], processes=options['processes'], seed=options['seed'],
+        )
+        # one "name: value" line per result, in a fixed order, so runs can be diffed
+        for name, value in results:
+            if isinstance(value, float):
+                self.stdout.write('%-24s %14.3f' % (name + ':', value))
+            else:
+                self.stdout.write('%-24s %14d' % (name + ':', value))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from ...benchmark import time_loader
+from ...bulkload import LOADERS
+
+class Command(BaseCommand):
+    help = 'Compare the DataValue loader backends on a synthetic upload (rolled back afterwards)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--values', type=int, default=1000000, help='number of synthetic data values to load')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--loader', action='append', choices=sorted(LOADERS), help='loader backend(s) to time, defaults to all of them')
+
+    def handle(self, *args, **options):
+        num_values = options['values']
+        for loader_name in options['loader'] or sorted(LOADERS):
+            elapsed = time_loader(loader_name, num_values, options['batch_size'])
+            self.stdout.write('%-12s %10d values %9.2f s %12.0f values/s' % (loader_name, num_values, elapsed, num_values/elapsed))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ...benchmark import time_period_parsers
+
+class Command(BaseCommand):
+    help = 'Compare the period parser with grabbag.period_to_dates() on a synthetic column of period cells'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cells', type=int, default=100000, help='number of period cells to parse')
+        parser.add_argument('--repeat', type=int, default=3, help='runs per parser, the best one is reported')
+
+    def handle(self, *args, **options):
+        num_cells, results = time_period_parsers(options['cells'], options['repeat'])
+        for name, elapsed in sorted(results.items()):
+            self.stdout.write('%-16s %10d cells %9.3f s %12.0f cells/s' % (name, num_cells, elapsed, num_cells/elapsed))
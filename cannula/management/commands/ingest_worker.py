@@ -0,0 +1,28 @@
+from multiprocessing import Process
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ...jobs import work
+
+class Command(BaseCommand):
+    help = 'Run queued ingestion jobs (document uploads) in the background'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1, help='number of worker processes, each loads one document at a time')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='seconds to wait between checks of an empty queue')
+        parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] <= 1:
+            work(options['poll_interval'], options['once'])
+            return
+
+        # forked workers must not share the parent's database connections
+        for conn in connections.all():
+            conn.close()
+        workers = [Process(target=work, args=(options['poll_interval'], options['once'])) for _ in range(options['concurrency'])]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
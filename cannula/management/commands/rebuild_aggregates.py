@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import AggregateValue, refresh_aggregates
+
+class Command(BaseCommand):
+    help = 'Recompute the pre-aggregated dashboard values from all the stored data values'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            refresh_aggregates()
+        self.stdout.write('%d aggregate values' % (AggregateValue.objects.count(),))
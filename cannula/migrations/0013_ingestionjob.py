@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cannula', '0012_merge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('kind', models.CharField(max_length=16, choices=[('VALUES', 'Load data values'), ('UPSERT', 'Merge corrected data values'), ('VALIDATIONS', 'Load validation rules')])),
+                ('status', models.CharField(max_length=8, default='QUEUED', db_index=True, choices=[('QUEUED', 'Queued'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')])),
+                ('phase', models.CharField(max_length=8, blank=True, null=True, choices=[('parse', 'Parse'), ('resolve', 'Resolve'), ('write', 'Write'), ('validate', 'Validate')])),
+                ('rows_total', models.PositiveIntegerField(blank=True, null=True)),
+                ('rows_done', models.PositiveIntegerField(default=0)),
+                ('values_done', models.PositiveIntegerField(default=0)),
+                ('values_inserted', models.PositiveIntegerField(blank=True, null=True)),
+                ('values_updated', models.PositiveIntegerField(blank=True, null=True)),
+                ('values_unchanged', models.PositiveIntegerField(blank=True, null=True)),
+                ('message', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('source_doc', models.ForeignKey(related_name='ingestion_jobs', to='cannula.SourceDocument')),
+            ],
+        ),
+    ]
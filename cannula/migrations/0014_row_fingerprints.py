@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cannula', '0013_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sourcedocument',
+            name='content_hash',
+            field=models.CharField(max_length=64, blank=True, null=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='rows_skipped',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='SourceRowFingerprint',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('sheet', models.CharField(max_length=64)),
+                ('period', models.CharField(max_length=7)),
+                ('location', models.CharField(max_length=128)),
+                ('fingerprint', models.CharField(max_length=40)),
+                ('source_doc', models.ForeignKey(related_name='row_fingerprints', to='cannula.SourceDocument')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='sourcerowfingerprint',
+            index_together=set([('location', 'period')]),
+        ),
+    ]
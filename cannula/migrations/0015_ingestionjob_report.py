@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cannula', '0014_row_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='report',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='ingestionjob',
+            name='kind',
+            field=models.CharField(max_length=16, choices=[('VALUES', 'Load data values'), ('UPSERT', 'Merge corrected data values'), ('VALIDATIONS', 'Load validation rules'), ('DRY_RUN', 'Dry run (profile data values)')]),
+        ),
+        migrations.AlterField(
+            model_name='ingestionjob',
+            name='phase',
+            field=models.CharField(max_length=8, blank=True, null=True, choices=[('parse', 'Parse'), ('resolve', 'Resolve'), ('write', 'Write'), ('validate', 'Validate'), ('profile', 'Profile')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cannula', '0015_ingestionjob_report'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionStats',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('kind', models.CharField(max_length=16, choices=[('VALUES', 'Load data values'), ('UPSERT', 'Merge corrected data values'), ('VALIDATIONS', 'Load validation rules'), ('DRY_RUN', 'Dry run (profile data values)')])),
+                ('phase', models.CharField(max_length=8, choices=[('parse', 'Parse'), ('resolve', 'Resolve'), ('write', 'Write'), ('validate', 'Validate'), ('profile', 'Profile')])),
+                ('wall_secs', models.FloatField()),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('values', models.PositiveIntegerField(default=0)),
+                ('queries', models.PositiveIntegerField(default=0)),
+                ('peak_rss_kb', models.PositiveIntegerField(blank=True, null=True)),
+                ('recorded_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(related_name='stats', blank=True, null=True, to='cannula.IngestionJob')),
+                ('source_doc', models.ForeignKey(related_name='ingestion_stats', to='cannula.SourceDocument')),
+            ],
+            options={
+                'verbose_name_plural': 'ingestion stats',
+            },
+        ),
+    ]
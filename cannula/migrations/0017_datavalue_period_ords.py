@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cannula', '0016_ingestionstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datavalue',
+            name='year_ord',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='datavalue',
+            name='quarter_ord',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='datavalue',
+            name='month_ord',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        # backfill from the ISO period strings ('2017', '2017-Q3', '2017-09'), same numbering as periods.iso_period_ordinals()
+        migrations.RunSQL(
+            '''
+            UPDATE cannula_datavalue SET
+                year_ord = CAST(year AS INTEGER),
+                quarter_ord = CASE WHEN quarter IS NULL THEN NULL ELSE CAST(SUBSTR(quarter, 1, 4) AS INTEGER)*4 + CAST(SUBSTR(quarter, 7, 1) AS INTEGER) - 1 END,
+                month_ord = CASE WHEN month IS NULL THEN NULL ELSE CAST(SUBSTR(month, 1, 4) AS INTEGER)*12 + CAST(SUBSTR(month, 6, 2) AS INTEGER) - 1 END
+            ''',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterIndexTogether(
+            name='datavalue',
+            index_together=set([('data_element', 'year_ord'), ('data_element', 'quarter_ord'), ('data_element', 'month_ord')]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# the org unit at a tree level above (or at) the value's org unit, found with the MPTT fields
+ANCESTOR_SQL = '''(
+    SELECT a.id FROM cannula_orgunit a, cannula_orgunit n
+    WHERE n.id = cannula_datavalue.org_unit_id AND a.tree_id = n.tree_id AND a.lft <= n.lft AND a.rght >= n.rght AND a.level = %d
+)'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cannula', '0017_datavalue_period_ords'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datavalue',
+            name='district_ou',
+            field=models.ForeignKey(related_name='+', blank=True, null=True, to='cannula.OrgUnit'),
+        ),
+        migrations.AddField(
+            model_name='datavalue',
+            name='subcounty_ou',
+            field=models.ForeignKey(related_name='+', blank=True, null=True, to='cannula.OrgUnit'),
+        ),
+        migrations.AddField(
+            model_name='datavalue',
+            name='facility_ou',
+            field=models.ForeignKey(related_name='+', blank=True, null=True, to='cannula.OrgUnit'),
+        ),
+        migrations.RunSQL(
+            'UPDATE cannula_datavalue SET district_ou_id = %s, subcounty_ou_id = %s, facility_ou_id = %s' % (ANCESTOR_SQL % (1,), ANCESTOR_SQL % (2,), ANCESTOR_SQL % (3,)),
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+PHASES = [('parse', 'Parse'), ('resolve', 'Resolve'), ('write', 'Write'), ('validate', 'Validate'), ('profile', 'Profile'), ('rollup', 'Roll up')]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cannula', '0018_datavalue_ancestry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregateValue',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('grain', models.CharField(max_length=16, choices=[('FACILITY_QUARTER', 'Facility, quarter'), ('DISTRICT_YEAR', 'District, year')])),
+                ('quarter', models.CharField(max_length=7, blank=True, null=True)),
+                ('year', models.CharField(max_length=4)),
+                ('year_ord', models.IntegerField()),
+                ('quarter_ord', models.IntegerField(blank=True, null=True)),
+                ('numeric_sum', models.DecimalField(max_digits=22, decimal_places=4)),
+                ('values_count', models.PositiveIntegerField()),
+                ('category_combo', models.ForeignKey(related_name='+', to='cannula.CategoryCombo')),
+                ('data_element', models.ForeignKey(related_name='+', to='cannula.DataElement')),
+                ('district_ou', models.ForeignKey(related_name='+', blank=True, null=True, to='cannula.OrgUnit')),
+                ('facility_ou', models.ForeignKey(related_name='+', blank=True, null=True, to='cannula.OrgUnit')),
+                ('org_unit', models.ForeignKey(related_name='+', to='cannula.OrgUnit')),
+                ('subcounty_ou', models.ForeignKey(related_name='+', blank=True, null=True, to='cannula.OrgUnit')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='aggregatevalue',
+            unique_together=set([('grain', 'data_element', 'category_combo', 'org_unit', 'year', 'quarter')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='aggregatevalue',
+            index_together=set([('grain', 'data_element', 'year_ord'), ('grain', 'data_element', 'quarter_ord')]),
+        ),
+        migrations.AlterField(
+            model_name='ingestionjob',
+            name='phase',
+            field=models.CharField(max_length=8, choices=PHASES, blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='ingestionstats',
+            name='phase',
+            field=models.CharField(max_length=8, choices=PHASES),
+        ),
+        # initial build, the same as models.refresh_aggregates() without keys
+        migrations.RunSQL(
+            '''
+            INSERT INTO cannula_aggregatevalue (grain, data_element_id, category_combo_id, org_unit_id, district_ou_id, subcounty_ou_id, facility_ou_id, year, quarter, year_ord, quarter_ord, numeric_sum, values_count)
+            SELECT 'FACILITY_QUARTER', data_element_id, category_combo_id, COALESCE(facility_ou_id, subcounty_ou_id, district_ou_id, org_unit_id),
+                district_ou_id, subcounty_ou_id, facility_ou_id, year, quarter, year_ord, quarter_ord, SUM(numeric_value), COUNT(numeric_value)
+            FROM cannula_datavalue WHERE year_ord IS NOT NULL
+            GROUP BY data_element_id, category_combo_id, COALESCE(facility_ou_id, subcounty_ou_id, district_ou_id, org_unit_id),
+                district_ou_id, subcounty_ou_id, facility_ou_id, year, quarter, year_ord, quarter_ord;
+            INSERT INTO cannula_aggregatevalue (grain, data_element_id, category_combo_id, org_unit_id, district_ou_id, subcounty_ou_id, facility_ou_id, year, quarter, year_ord, quarter_ord, numeric_sum, values_count)
+            SELECT 'DISTRICT_YEAR', data_element_id, category_combo_id, COALESCE(district_ou_id, org_unit_id),
+                district_ou_id, NULL, NULL, year, NULL, year_ord, NULL, SUM(numeric_value), COUNT(numeric_value)
+            FROM cannula_datavalue WHERE year_ord IS NOT NULL
+            GROUP BY data_element_id, category_combo_id, COALESCE(district_ou_id, org_unit_id), district_ou_id, year, year_ord;
+            ''',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cannula', '0019_aggregatevalue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID', auto_created=True)),
+                ('version', models.BigIntegerField(default=0)),
+                ('changed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        # the single row bump_data_version() updates
+        migrations.RunSQL(
+            "INSERT INTO cannula_dataversion (id, version, changed_at) VALUES (1, 0, CURRENT_TIMESTAMP)",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.db.models import Avg, Case, Count, F, Max, Min, Prefetch, Q, Sum, When
-from django.db.models.signals import post_init
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete
+from django.dispatch import receiver
 from django.core.files.storage import FileSystemStorage
 from django.core.exceptions import ValidationError
 from django.conf import settings
@@ -9,7 +10,8 @@ import logging
 logger = logging.getLogger(__name__)
 
 import mimetypes
-from functools import lru_cache, partial
+import time
+from functools import partial
 from decimal import Decimal
 
 from mptt.models import MPTTModel, TreeForeignKey
@@ -24,19 +26,148 @@ def make_random_filename(instance, filename):
 
 fs = FileSystemStorage(location=settings.SOURCE_DOC_DIR)
 
+def file_content_hash(f):
+    """
+    SHA-256 hex digest of the contents of an (uploaded) file, read in chunks.
+    A file that was open is left open at its start, one that wasn't is closed
+    """
+    import hashlib
+
+    h = hashlib.sha256()
+    was_closed = f.closed
+    f.open('rb') # rewinds it if it is open already
+    try:
+        for chunk in f.chunks():
+            h.update(chunk)
+    finally:
+        if was_closed:
+            f.close()
+        else:
+            f.seek(0)
+    return h.hexdigest()
+
 class SourceDocument(models.Model):
     orig_filename = models.CharField(max_length=128, blank=True, null=True)
     file = models.FileField(upload_to=make_random_filename, storage=fs)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    content_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True) # sha256 of the file, to spot re-uploads
 
     def save(self, *args, **kwargs):
+        if not self.content_hash and self.file:
+            self.content_hash = file_content_hash(self.file)
         # store the original filename away for later
         self.orig_filename = self.file.name
         super(SourceDocument, self).save(*args, **kwargs)
 
+    def latest_ingestion_stats(self):
+        """The per phase stats of the most recent job, uses prefetched stats when there are any"""
+        stats = sorted(self.ingestion_stats.all(), key=lambda s: (s.job_id or 0, s.id))
+        if not stats:
+            return []
+        return [s for s in stats if s.job_id == stats[-1].job_id]
+
     def __str__(self):
         return '%s: %s' % (self.file, self.orig_filename)
 
+class IngestionJob(models.Model):
+    """A queued request to load a source document, run by the ingest_worker management command"""
+    KINDS = (
+        ('VALUES', 'Load data values'),
+        ('UPSERT', 'Merge corrected data values'),
+        ('VALIDATIONS', 'Load validation rules'),
+        ('DRY_RUN', 'Dry run (profile data values)'),
+    )
+    STATUSES = (
+        ('QUEUED', 'Queued'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    )
+    PHASES = (
+        ('parse', 'Parse'),
+        ('resolve', 'Resolve'),
+        ('write', 'Write'),
+        ('validate', 'Validate'),
+        ('profile', 'Profile'),
+        ('rollup', 'Roll up'),
+    )
+
+    source_doc = models.ForeignKey(SourceDocument, related_name='ingestion_jobs')
+    kind = models.CharField(max_length=16, choices=KINDS)
+    status = models.CharField(max_length=8, choices=STATUSES, default='QUEUED', db_index=True)
+    phase = models.CharField(max_length=8, choices=PHASES, blank=True, null=True)
+    rows_total = models.PositiveIntegerField(blank=True, null=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    rows_skipped = models.PositiveIntegerField(default=0) # rows unchanged since the previous version of the document
+    values_done = models.PositiveIntegerField(default=0)
+    values_inserted = models.PositiveIntegerField(blank=True, null=True)
+    values_updated = models.PositiveIntegerField(blank=True, null=True)
+    values_unchanged = models.PositiveIntegerField(blank=True, null=True)
+    message = models.TextField(blank=True, null=True) # error details for failed jobs
+    report = models.TextField(blank=True, null=True) # JSON data profile of dry runs
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True) # last sign of life of the worker running the job
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def is_active(self):
+        return self.status in ('QUEUED', 'RUNNING')
+
+    def report_data(self):
+        import json
+
+        return json.loads(self.report) if self.report else None
+
+    def percent_done(self):
+        if self.status == 'DONE':
+            return 100
+        if self.rows_total:
+            return min(self.rows_done * 100 // self.rows_total, 100) # some readers only estimate the total
+        return 0
+
+    def __str__(self):
+        return '%s [%s] %s' % (self.get_kind_display(), self.status, self.source_doc)
+
+class IngestionStats(models.Model):
+    """
+    Measurements of one phase of an ingestion job, kept with the document so
+    slow loads can be diagnosed and compared with earlier ones
+    """
+    source_doc = models.ForeignKey(SourceDocument, related_name='ingestion_stats')
+    job = models.ForeignKey(IngestionJob, related_name='stats', blank=True, null=True)
+    kind = models.CharField(max_length=16, choices=IngestionJob.KINDS)
+    phase = models.CharField(max_length=8, choices=IngestionJob.PHASES)
+    wall_secs = models.FloatField()
+    rows = models.PositiveIntegerField(default=0)
+    values = models.PositiveIntegerField(default=0)
+    queries = models.PositiveIntegerField(default=0)
+    peak_rss_kb = models.PositiveIntegerField(blank=True, null=True) # of the worker process so far, not just this phase
+    recorded_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = 'ingestion stats'
+
+    def __str__(self):
+        return '%s %s: %.2fs' % (self.get_kind_display(), self.phase, self.wall_secs)
+
+class SourceRowFingerprint(models.Model):
+    """
+    Hash of the values of one worksheet row (one period at one location) as
+    loaded from a source document. Used to skip the rows that did not change
+    when a corrected version of a document is merged
+    """
+    source_doc = models.ForeignKey(SourceDocument, related_name='row_fingerprints')
+    sheet = models.CharField(max_length=64)
+    period = models.CharField(max_length=7) # iso month, quarter or year
+    location = models.CharField(max_length=128) # same as DataValue.site_str
+    fingerprint = models.CharField(max_length=40)
+
+    class Meta:
+        index_together = (('location', 'period'),)
+
+    def __str__(self):
+        return '%s %s %s' % (self.sheet, self.period, self.location)
+
 class OrgUnit(MPTTModel):
     name = models.CharField(max_length=64)
     parent = TreeForeignKey('self', null=True, blank=True, related_name='children', db_index=True)
@@ -65,7 +196,6 @@ class OrgUnit(MPTTModel):
         return current_node
 
     @classmethod
-    @lru_cache(maxsize=None)
     def from_path_recurse(cls, *path_parts):
         if len(path_parts) == 0:
             return None
@@ -77,9 +207,254 @@ class OrgUnit(MPTTModel):
             ou, created = cls.objects.get_or_create(name=node_name, parent=ou_parent)
         return ou
 
+    def save(self, *args, **kwargs):
+        from django.db import transaction
+
+        # the MPTT fields of other nodes change too, see OrgUnitTreeLoader
+        with transaction.atomic():
+            lock_org_unit_tree()
+            super(OrgUnit, self).save(*args, **kwargs)
+
+    @classmethod
+    def lookup_path(cls, *path_parts):
+        """Return the existing OrgUnit at the path (names from the root down), or None. Unlike from_path() nothing is created"""
+        if not path_parts:
+            return None
+        filters = {'level': len(path_parts)-1}
+        for i, name in enumerate(reversed(path_parts)):
+            filters['__'.join(['parent']*i + ['name'])] = name
+        return cls.objects.filter(**filters).first()
+
     def __str__(self):
         return '%s [parent_id: %s]' % (self.name, str(self.parent_id),)
 
+# tree levels of the org units DataValue keeps denormalized ids of (the root, 'Uganda', is level 0)
+ANCESTRY_LEVELS = (
+    ('district_ou', 1),
+    ('subcounty_ou', 2),
+    ('facility_ou', 3),
+)
+
+def path_ancestry(resolved, path):
+    """The (district, subcounty, facility) ids of a location path, from a dict of resolved path prefixes"""
+    return tuple(resolved[path[:level+1]] if len(path) > level else None for _, level in ANCESTRY_LEVELS)
+
+@receiver(post_init, sender=OrgUnit)
+def remember_org_unit_parent(sender, instance, **kwargs):
+    instance._orig_parent_id = instance.parent_id
+
+@receiver(post_save, sender=OrgUnit)
+def org_unit_moved(sender, instance, created, **kwargs):
+    if not created and instance.parent_id != instance._orig_parent_id:
+        refresh_datavalue_ancestry(instance.id)
+    instance._orig_parent_id = instance.parent_id
+
+def refresh_datavalue_ancestry(org_unit_id):
+    """
+    Recompute the denormalized district/subcounty/facility ids of the values
+    at and below an org unit, eg. after it was moved to another parent, and the
+    aggregates they add up to. Takes one UPDATE per ancestor rather than one
+    per value
+    """
+    from collections import defaultdict
+
+    org_unit = OrgUnit.objects.get(id=org_unit_id) # fresh tree fields
+    tree = dict((ou_id, (parent_id, level)) for ou_id, parent_id, level in org_unit.get_ancestors().values_list('id', 'parent_id', 'level'))
+    tree.update((ou_id, (parent_id, level)) for ou_id, parent_id, level in org_unit.get_descendants(include_self=True).values_list('id', 'parent_id', 'level'))
+
+    def ancestor_at(ou_id, level):
+        while ou_id is not None and tree[ou_id][1] > level:
+            ou_id = tree[ou_id][0]
+        return ou_id if ou_id is not None and tree[ou_id][1] == level else None
+
+    subtree_ids = [ou_id for ou_id, (_, level) in tree.items() if level >= org_unit.level]
+    subtree_values = DataValue.objects.filter(org_unit_id__in=subtree_ids)
+    old_aggregate_keys = aggregate_keys(subtree_values)
+    for field, level in ANCESTRY_LEVELS:
+        by_ancestor = defaultdict(list)
+        for ou_id in subtree_ids:
+            by_ancestor[ancestor_at(ou_id, level)].append(ou_id)
+        for ancestor_id, ou_ids in by_ancestor.items():
+            for ou_chunk in grabbag.chunked(ou_ids, 1000):
+                DataValue.objects.filter(org_unit_id__in=ou_chunk).update(**{'%s_id' % (field,): ancestor_id})
+    # the values now add up under other org units
+    refresh_aggregates(old_aggregate_keys | aggregate_keys(subtree_values))
+
+ORG_UNIT_TREE_LOCK = 0x63616e6e # key of the advisory lock serializing writes to the OrgUnit tree
+
+def lock_org_unit_tree(using='default'):
+    """
+    Serialize writes to the OrgUnit tree (its MPTT fields) until the end of
+    the current transaction. Only PostgreSQL has advisory locks, elsewhere
+    this does nothing
+    """
+    from django.db import connections
+
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute('SELECT pg_advisory_xact_lock(%s)', [ORG_UNIT_TREE_LOCK])
+
+def collation_sorted(names, using='default'):
+    """
+    The names in the order the database sorts them (its collation, eg. 'abc'
+    before 'Abd' in en_US), which order_insertion_by and rebuild() follow.
+    Only PostgreSQL is asked, elsewhere (SQLite's default BINARY collation)
+    it is Python's order
+    """
+    from django.db import connections
+
+    connection = connections[using]
+    if connection.vendor != 'postgresql' or not names:
+        return sorted(set(names))
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT DISTINCT n FROM unnest(%s::varchar[]) AS n ORDER BY n', [list(names)])
+        return [n for n, in cursor.fetchall()]
+
+class OrgUnitTreeLoader():
+    """
+    Resolves location paths (tuples of names from the root down) to OrgUnit ids
+    in bulk.
+
+    Existing nodes are read from a single snapshot query. Missing nodes are
+    inserted with one bulk insert per tree level, with their MPTT fields
+    worked out beforehand: the nodes after each new subtree are moved up by a
+    single UPDATE per tree, rather than the whole tree being rebuilt. The
+    inserts hold the tree lock (lock_org_unit_tree()) until the transaction
+    ends.
+
+    With dry_run nothing is written, missing nodes get (negative) made up ids
+    and are listed in new_paths
+    """
+    def __init__(self, dry_run=False):
+        self.nodes = None # (parent id, name) => orgunit id
+        self.resolved = dict() # path tuple => orgunit id
+        self.num_created = 0
+        self.dry_run = dry_run
+        self.new_paths = list()
+
+    def load(self):
+        self.nodes = {(parent_id, name): ou_id for ou_id, parent_id, name in OrgUnit.objects.values_list('id', 'parent_id', 'name')}
+
+    def resolve_all(self, paths):
+        """
+        Return a dict mapping each of the given paths to an OrgUnit id,
+        creating any missing nodes along the way
+        """
+        if self.nodes is None:
+            self.load()
+
+        paths = set(tuple(p) for p in paths)
+        missing = self.resolve_existing(paths)
+        if missing and self.dry_run:
+            for prefix in sorted(missing, key=len):
+                self.nodes[(self.resolved.get(prefix[:-1]), prefix[-1])] = self.resolved[prefix] = -(len(self.new_paths)+1)
+                self.new_paths.append(prefix)
+        elif missing:
+            from django.db import transaction
+
+            with transaction.atomic():
+                lock_org_unit_tree()
+                # another job may have inserted some of them while we waited for the lock
+                self.load()
+                missing = self.resolve_existing(paths)
+                if missing:
+                    self.insert_missing(missing)
+
+        return {p: self.resolved[p] for p in paths}
+
+    def resolve_existing(self, paths):
+        """Resolve the paths (and their prefixes) that exist, return the set of missing prefixes"""
+        missing = set()
+        for path in paths:
+            for depth in range(1, len(path)+1):
+                prefix = path[:depth]
+                if prefix in self.resolved or prefix in missing:
+                    continue
+                parent_id = self.resolved.get(prefix[:-1]) if depth > 1 else None
+                node_key = (parent_id, prefix[-1])
+                if (depth == 1 or parent_id is not None) and node_key in self.nodes:
+                    self.resolved[prefix] = self.nodes[node_key]
+                else:
+                    missing.add(prefix)
+        return missing
+
+    def insert_missing(self, missing):
+        from collections import defaultdict
+
+        children = defaultdict(list) # parent prefix => missing child prefixes
+        for prefix in missing:
+            children[prefix[:-1]].append(prefix)
+        subtree_sizes = dict() # missing prefix => number of lft/rght values its subtree takes up
+        for prefix in sorted(missing, key=len, reverse=True):
+            subtree_sizes[prefix] = 2 + sum(subtree_sizes[c] for c in children[prefix])
+        # the new subtrees either hang off an existing node or are new trees
+        subtree_roots = [p for p in missing if p[:-1] not in missing]
+
+        parent_ids = set(self.resolved[p[:-1]] for p in subtree_roots if len(p) > 1)
+        parents = dict((ou_id, (tree_id, rght)) for ou_id, tree_id, rght in OrgUnit.objects.filter(id__in=parent_ids).values_list('id', 'tree_id', 'rght'))
+        siblings = defaultdict(list)
+        for parent_id, name, lft in OrgUnit.objects.filter(parent_id__in=parent_ids).values_list('parent_id', 'name', 'lft'):
+            siblings[parent_id].append((name, lft))
+        # siblings are ordered by name the way the database sorts them, not Python
+        name_rank = dict((name, i) for i, name in enumerate(collation_sorted(set(p[-1] for p in missing) | set(name for sibs in siblings.values() for name, _ in sibs))))
+        def by_name(prefix):
+            return name_rank[prefix[-1]]
+
+        # a new subtree opens a gap at the lft of its first sibling by name (order_insertion_by), or at the rght of its parent
+        gaps = defaultdict(list) # (tree id, position) => subtree roots
+        new_trees = list()
+        for prefix in subtree_roots:
+            if len(prefix) == 1:
+                new_trees.append(prefix)
+                continue
+            parent_id = self.resolved[prefix[:-1]]
+            tree_id, parent_rght = parents[parent_id]
+            position = min((lft for name, lft in siblings[parent_id] if name_rank[name] > by_name(prefix)), default=parent_rght)
+            gaps[(tree_id, position)].append(prefix)
+
+        tree_fields = dict() # missing prefix => (tree id, lft, rght)
+        def lay_out(prefix, tree_id, lft):
+            rght = lft + 1
+            for child in sorted(children[prefix], key=by_name):
+                rght = lay_out(child, tree_id, rght) + 1
+            tree_fields[prefix] = (tree_id, lft, rght)
+            return rght
+
+        shifts = defaultdict(list) # tree id => (position, gap size), in order
+        for tree_id, position in sorted(gaps):
+            lft = position + sum(size for _, size in shifts[tree_id]) # where the gaps before this one moved it
+            for prefix in sorted(gaps[(tree_id, position)], key=by_name):
+                lft = lay_out(prefix, tree_id, lft) + 1
+            shifts[tree_id].append((position, sum(subtree_sizes[p] for p in gaps[(tree_id, position)])))
+        next_tree_id = (OrgUnit.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+        for tree_id, prefix in enumerate(sorted(new_trees, key=by_name), start=next_tree_id):
+            lay_out(prefix, tree_id, 1)
+
+        # a value at or after a gap's position moves up by the size of the gap (and of those before it)
+        for tree_id, tree_shifts in shifts.items():
+            moves = list()
+            moved_by = 0
+            for position, size in tree_shifts:
+                moved_by += size
+                moves.append((position, moved_by))
+            def shift(field):
+                return F(field) + Case(*[When(**{'%s__gte' % (field,): position, 'then': moved_by}) for position, moved_by in reversed(moves)], default=0, output_field=models.IntegerField())
+            OrgUnit.objects.filter(tree_id=tree_id, rght__gte=moves[0][0]).update(lft=shift('lft'), rght=shift('rght'))
+
+        for depth in sorted(set(len(p) for p in missing)):
+            level_missing = [p for p in missing if len(p) == depth]
+            new_nodes = list()
+            for prefix in level_missing:
+                tree_id, lft, rght = tree_fields[prefix]
+                new_nodes.append(OrgUnit(name=prefix[-1], parent_id=self.resolved.get(prefix[:-1]), tree_id=tree_id, lft=lft, rght=rght, level=depth-1))
+            OrgUnit.objects.bulk_create(new_nodes)
+            # re-read to pick up the primary keys, bulk_create() doesn't set them
+            qs_new = OrgUnit.objects.filter(level=depth-1, name__in=set(p[-1] for p in level_missing))
+            self.nodes.update(((parent_id, name), ou_id) for ou_id, parent_id, name in qs_new.values_list('id', 'parent_id', 'name'))
+            for prefix in level_missing:
+                self.resolved[prefix] = self.nodes[(self.resolved.get(prefix[:-1]), prefix[-1])]
+        self.num_created += len(missing)
+
 class DataElement(models.Model):
     VALUE_TYPES = (
         ('NUMBER', 'Number'),
@@ -138,11 +513,16 @@ class CategoryCombo(models.Model):
     name = models.CharField(max_length=512)
     categories = models.ManyToManyField(Category)
 
+    @staticmethod
+    def name_from_cat_names(cat_names):
+        sorted_names = sorted(cat_names) #TODO: sort based on the name of the classification the Category belongs to
+        return '(%s)' % ', '.join(sorted_names)
+
     @classmethod
     def from_cat_names(cls, cat_names):
         sorted_names = sorted(cat_names) #TODO: sort based on the name of the classification the Category belongs to
         cat_list = [Category.objects.get_or_create(name=cat_name)[0] for cat_name in sorted_names]
-        cc_name = '(%s)' % ', '.join(sorted_names)
+        cc_name = cls.name_from_cat_names(cat_names)
         cat_combo, created = cls.objects.get_or_create(name=cc_name)
         if created:
             for categ in cat_list:
@@ -155,7 +535,54 @@ class CategoryCombo(models.Model):
         return self.name
 
 
-# TODO: Consider tracking which data element each subcategory is from (reduce false matches and other? benefits)
+class DataElementRegistry():
+    """
+    Process wide map of (upper cased) data element names and aliases to ids,
+    so what() can filter on data_element_id instead of case insensitive joins.
+
+    Invalidated when a DataElement is saved or deleted (or bulk created by
+    ingestion) in this process. Changes made by other processes are picked up
+    when an unknown name is looked up, or after max_age seconds
+    """
+    max_age = 60.0
+    min_reload_interval = 5.0 # don't reload on every lookup of a name that doesn't exist
+
+    def __init__(self):
+        self.ids = None # upper cased name/alias => set of data element ids
+        self.loaded_at = 0.0
+
+    def invalidate(self):
+        self.ids = None
+
+    def load(self):
+        ids = dict()
+        for de_id, name, alias in DataElement.objects.values_list('id', 'name', 'alias'):
+            ids.setdefault(name.upper(), set()).add(de_id)
+            if alias:
+                ids.setdefault(alias.upper(), set()).add(de_id)
+        self.ids = ids
+        self.loaded_at = time.monotonic()
+
+    def lookup(self, *names):
+        """Return the set of ids of the data elements with any of the names (or aliases)"""
+        age = time.monotonic() - self.loaded_at
+        keys = [name.upper() for name in names]
+        if self.ids is None or age > self.max_age:
+            self.load()
+        elif age > self.min_reload_interval and any(k not in self.ids for k in keys):
+            self.load() # may have been created by another process since
+        return set().union(*(self.ids.get(k, ()) for k in keys))
+
+DATA_ELEMENT_REGISTRY = DataElementRegistry()
+
+@receiver(post_save, sender=DataElement)
+@receiver(post_delete, sender=DataElement)
+def invalidate_data_element_registry(sender, **kwargs):
+    DATA_ELEMENT_REGISTRY.invalidate()
+    # the dashboards look data elements up by name and alias
+    bump_data_version()
+
+# the subcategories seen with each data element are tracked in HEADER_PARSER.element_categories
 CATEGORIES = [
     'Male',
     'Female',
@@ -199,32 +626,26 @@ CATEGORIES = [
 ]
 
 import re
-SEP_REGEX = '[\s,]+' # one or more of these characters in sequence
-CATEGORY_REGEX = '|'.join('%s?(%s)' % (SEP_REGEX, re.escape(categ)) for categ in CATEGORIES)
-SEXLESS_CATEGORY_REGEX = '|'.join('%s?(%s)' % (SEP_REGEX, re.escape(categ)) for categ in CATEGORIES[2:]) #TODO: even more horrible a hack
 
+# headers naming a sex themselves are only matched against CATEGORIES[2:]
 ICKY_CATEGS = (
     'Number of Male',
     'Male partners',
 )
 
+from .headers import HeaderParser
+# memoizes across uploads, headers are only ever parsed once per process
+HEADER_PARSER = HeaderParser(CATEGORIES, sexless_categories=CATEGORIES[2:], icky_phrases=ICKY_CATEGS)
+
+def parse_data_element(de_long):
+    """
+    Split a (long) column header into the data element name and the list of
+    category names it is disaggregated by
+    """
+    return HEADER_PARSER.parse(de_long)
+
 def unpack_data_element(de_long):
-    if any([de_long.upper().find(s.upper()) >=0 for s in ICKY_CATEGS]):
-        m = re.split(SEXLESS_CATEGORY_REGEX, de_long)
-    else:
-        m = re.split(CATEGORY_REGEX, de_long)
-    # squash list of matches by removing blank and None entries (and False and numeric zeroes)
-    de_name, *category_list = tuple(filter(None, m))
-    cat_str = ', '.join(category_list)
-
-    # deals with cases where the data element name includes a subcategory ('105-2.1a Male partners received HIV test results in eMTCT')
-    # and matches multiple subcategories ('Lost' and 'Lost  to Followup' in '106a Cohort  All patients 12 months Lost  to Followup')
-    #TODO: reimplement this, it is a really ugly hack
-    if any([cat not in CATEGORIES for cat in category_list]):
-        cat_str = ' '.join(category_list)
-        if cat_str not in CATEGORIES:
-            de_name = de_long
-            cat_str = ''
+    de_name, category_list = parse_data_element(de_long)
 
     de_instance, created = DataElement.objects.get_or_create(name=de_name, value_type='NUMBER', value_min=None, value_max=None, aggregation_method='SUM')
     if len(category_list):
@@ -232,30 +653,207 @@ def unpack_data_element(de_long):
     else:
         return (de_instance, None)
 
+class DataElementResolver():
+    """
+    Resolves column headers to (DataElement, CategoryCombo) pairs in memory.
+
+    The existing data elements and category combos are loaded once, on first
+    use, and only the missing ones are created (in bulk). Keep one resolver per
+    upload so headers repeated across worksheets are only parsed once.
+
+    With dry_run nothing is written, missing data elements and category combos
+    get unsaved instances with (negative) made up ids and are listed in
+    new_elements and new_cat_combos
+    """
+    def __init__(self, dry_run=False):
+        self.elements = None # data element name => DataElement
+        self.cat_combos = None # category combo name => CategoryCombo
+        self.categories = None # category name => Category, only loaded when creating category combos
+        self.resolved = dict() # header => (DataElement, CategoryCombo or None)
+        self.dry_run = dry_run
+        self.new_elements = list()
+        self.new_cat_combos = list()
+
+    def load(self):
+        self.elements = {de.name: de for de in DataElement.objects.all()}
+        self.cat_combos = {cc.name: cc for cc in CategoryCombo.objects.all()}
+
+    def create_elements(self, de_names):
+        # keep the checks DataElement.validate_unique() would have made, bulk_create() skips save()
+        aliases = {de.alias.upper(): de for de in self.elements.values() if de.alias}
+        for de_name in de_names:
+            if de_name.upper() in aliases:
+                raise ValidationError({'name': 'Name already used as an alias: \'%s\'' % (de_name,)})
+
+        if self.dry_run:
+            for de_name in sorted(de_names):
+                self.new_elements.append(DataElement(id=-(len(self.new_elements)+1), name=de_name, value_type='NUMBER', value_min=None, value_max=None, aggregation_method='SUM'))
+                self.elements[de_name] = self.new_elements[-1]
+            return
+
+        DataElement.objects.bulk_create([DataElement(name=de_name, value_type='NUMBER', value_min=None, value_max=None, aggregation_method='SUM') for de_name in de_names])
+        DATA_ELEMENT_REGISTRY.invalidate() # bulk_create() sends no post_save
+        # re-read to pick up the primary keys, bulk_create() doesn't set them
+        self.elements.update((de.name, de) for de in DataElement.objects.filter(name__in=de_names))
+
+    def create_cat_combos(self, cat_combo_cats):
+        if self.dry_run:
+            for cc_name in sorted(cat_combo_cats):
+                self.new_cat_combos.append(CategoryCombo(id=-(len(self.new_cat_combos)+1), name=cc_name))
+                self.cat_combos[cc_name] = self.new_cat_combos[-1]
+            return
+
+        if self.categories is None:
+            self.categories = {categ.name: categ for categ in Category.objects.all()}
+
+        new_cat_names = set(cat_name for cat_names in cat_combo_cats.values() for cat_name in cat_names).difference(self.categories)
+        if new_cat_names:
+            Category.objects.bulk_create([Category(name=cat_name) for cat_name in new_cat_names])
+            self.categories.update((categ.name, categ) for categ in Category.objects.filter(name__in=new_cat_names))
+
+        CategoryCombo.objects.bulk_create([CategoryCombo(name=cc_name) for cc_name in cat_combo_cats])
+        new_cat_combos = CategoryCombo.objects.filter(name__in=list(cat_combo_cats))
+        self.cat_combos.update((cc.name, cc) for cc in new_cat_combos)
+
+        CategoryComboCategories = CategoryCombo.categories.through
+        cc_categs = list()
+        for cc_name, cat_names in cat_combo_cats.items():
+            cat_combo = self.cat_combos[cc_name]
+            for cat_name in set(cat_names):
+                cc_categs.append(CategoryComboCategories(categorycombo_id=cat_combo.id, category_id=self.categories[cat_name].id))
+        CategoryComboCategories.objects.bulk_create(cc_categs)
+
+    def resolve_all(self, headers):
+        """
+        Return a tuple of (DataElement, CategoryCombo or None) pairs, one for
+        each of the given headers
+        """
+        headers = tuple(headers)
+        self.resolve_parsed(dict((h, parse_data_element(h)) for h in headers if h not in self.resolved))
+        return tuple(self.resolved[h] for h in headers)
+
+    def resolve_names(self, names):
+        """
+        Like resolve_all(), for (data element name, category name list) pairs
+        that are already split up
+        """
+        keys = tuple((de_name, tuple(category_list)) for de_name, category_list in names)
+        self.resolve_parsed(dict((k, k) for k in keys if k not in self.resolved))
+        return tuple(self.resolved[k] for k in keys)
+
+    def resolve_parsed(self, parsed_names):
+        """Resolve a dict of key => (data element name, category name list), creating what is missing"""
+        if self.elements is None:
+            self.load()
+
+        parsed = dict()
+        for h, (de_name, category_list) in parsed_names.items():
+            cc_name = CategoryCombo.name_from_cat_names(category_list) if category_list else None
+            parsed[h] = (de_name, cc_name, category_list)
+
+        from django.db import transaction
+
+        # the elements and category combos (with their categories) are created all or nothing
+        with transaction.atomic():
+            new_de_names = set(de_name for de_name, _, _ in parsed.values()).difference(self.elements)
+            if new_de_names:
+                self.create_elements(new_de_names)
+
+            new_cat_combos = dict((cc_name, cat_names) for _, cc_name, cat_names in parsed.values() if cc_name and cc_name not in self.cat_combos)
+            if new_cat_combos:
+                self.create_cat_combos(new_cat_combos)
+
+        for h, (de_name, cc_name, _) in parsed.items():
+            self.resolved[h] = (self.elements[de_name], self.cat_combos[cc_name] if cc_name else None)
+
 class DataValueQuerySet(models.QuerySet):
     """Convenience queryset methods for handling datavalues"""
     def what(self, *names):
-        de_filters = None
-        if names:
-            for de in names:
-                if de is None:
-                    continue # skip any names/uids with value of None
-                if de_filters:
-                    de_filters = de_filters | Q(data_element__name__iexact=de) | Q(data_element__alias__iexact=de)
-                else:
-                    de_filters = Q(data_element__name__iexact=de) | Q(data_element__alias__iexact=de)
+        names = [de for de in names if de is not None] # skip any names/uids with value of None
 
         qs = self.annotate(de_name=F('data_element__name'))
         qs = qs.annotate(de_uid=F('data_element__dhis2_uid'))
-        if de_filters:
-            qs = qs.filter(de_filters)
+        if names:
+            # names and aliases are matched case insensitively, through the registry rather than in SQL
+            qs = qs.filter(data_element_id__in=DATA_ELEMENT_REGISTRY.lookup(*names))
         return qs
 
-    def where(self):
-        raise NotImplementedError()
-
-    def when(self):
-        raise NotImplementedError()
+    def where(self, *org_units):
+        """
+        Restrict to the values of the given org units and of everything below
+        them, with one MPTT range predicate per org unit instead of parent joins.
+        Org units may be OrgUnit instances, ids, path tuples (('Uganda', 'Kampala'))
+        or path strings as in site_str ('Uganda => Kampala'). Unknown ones match nothing
+        """
+        ou_ranges = list()
+        ou_ids = list()
+        for ou in org_units:
+            if ou is None:
+                continue # skip any org units with value of None
+            if isinstance(ou, OrgUnit):
+                ou_ranges.append((ou.tree_id, ou.lft, ou.rght))
+            elif isinstance(ou, int):
+                ou_ids.append(ou)
+            else:
+                path = ou.split(' => ') if isinstance(ou, str) else ou
+                ou = OrgUnit.lookup_path(*path)
+                if ou:
+                    ou_ranges.append((ou.tree_id, ou.lft, ou.rght))
+        if ou_ids:
+            ou_ranges.extend(OrgUnit.objects.filter(id__in=ou_ids).values_list('tree_id', 'lft', 'rght'))
+
+        ou_filters = None
+        for tree_id, lft, rght in ou_ranges:
+            ou_filter = Q(org_unit__tree_id=tree_id, org_unit__lft__gte=lft, org_unit__rght__lte=rght)
+            if ou_filters:
+                ou_filters = ou_filters | ou_filter
+            else:
+                ou_filters = ou_filter
+
+        if ou_filters:
+            return self.filter(ou_filters)
+        if any(ou is not None for ou in org_units):
+            return self.none() # none of them exist
+        return self
+
+    def when(self, *periods):
+        """
+        Restrict to the values in the given periods. Each period is a year,
+        quarter or month in any form periods.parse_period() takes ('2017',
+        '2017-Q3', '2017-09', 'Sep 2017') or a (first, last) tuple of the same
+        kind for a range, eg. ('2017-01', '2017-06') for the first half of
+        2017. A year matches its quarterly and monthly values too, a quarter
+        its monthly values. Filters on the indexed integer period keys
+        """
+        period_filters = self.period_q(*periods)
+        if period_filters:
+            return self.filter(period_filters)
+        if any(p is not None for p in periods):
+            return self.none() # none of them are periods
+        return self
+
+    @staticmethod
+    def period_q(*periods):
+        """The filter when() applies for the periods, as a Q object (None if there are no periods)"""
+        from .periods import period_range
+
+        period_filters = None
+        for period in periods:
+            if period is None:
+                continue # skip any periods with value of None
+            field_range = period_range(period if isinstance(period, (tuple, list)) else [period])
+            if field_range is None:
+                continue
+            field, (first, last) = field_range
+            if first == last:
+                period_filter = Q(**{field: first})
+            else:
+                period_filter = Q(**{'%s__range' % (field,): (first, last)})
+            if period_filters:
+                period_filters = period_filters | period_filter
+            else:
+                period_filters = period_filter
+        return period_filters
 
 class DataValueManager(models.Manager):
     """Attach our custom queryset methods to the model manager"""
@@ -265,11 +863,11 @@ class DataValueManager(models.Manager):
     def what(self, *names):
         return self.get_queryset().what(*names)
 
-    def where(self):
-        raise NotImplementedError()
+    def where(self, *org_units):
+        return self.get_queryset().where(*org_units)
 
-    def when(self):
-        raise NotImplementedError()
+    def when(self, *periods):
+        return self.get_queryset().when(*periods)
 
 def get_default_category_combo():
     return CategoryCombo.objects.get(id=1)
@@ -283,12 +881,35 @@ class DataValue(models.Model):
     month = models.CharField(max_length=7, blank=True, null=True) # ISO 8601 format '2017-09'
     quarter = models.CharField(max_length=7, blank=True, null=True) # ISO 8601 format '2017-Q3'
     year = models.CharField(max_length=4, blank=True, null=True) # ISO 8601 format '2017'
+    # ancestors of org_unit (or org_unit itself) at the district, subcounty and facility levels, to group by without joining up the tree
+    district_ou = models.ForeignKey(OrgUnit, related_name='+', blank=True, null=True)
+    subcounty_ou = models.ForeignKey(OrgUnit, related_name='+', blank=True, null=True)
+    facility_ou = models.ForeignKey(OrgUnit, related_name='+', blank=True, null=True)
+    # integer keys of the periods above (see periods.py) for indexed, range friendly filtering with when()
+    year_ord = models.IntegerField(blank=True, null=True) # year
+    quarter_ord = models.IntegerField(blank=True, null=True) # year*4 + quarter-1
+    month_ord = models.IntegerField(blank=True, null=True) # year*12 + month-1
     source_doc = models.ForeignKey(SourceDocument, related_name='data_values')
 
     objects = DataValueManager() # override the default manager
 
     class Meta():
         unique_together = (('data_element', 'category_combo', 'org_unit', 'year', 'quarter', 'month'),)
+        index_together = (('data_element', 'year_ord'), ('data_element', 'quarter_ord'), ('data_element', 'month_ord'))
+
+    def set_period_ords(self):
+        from .periods import iso_period_ordinals
+        self.year_ord, self.quarter_ord, self.month_ord = iso_period_ordinals(self.year, self.quarter, self.month)
+
+    def set_org_unit_ancestry(self):
+        levels = dict(self.org_unit.get_ancestors(include_self=True).values_list('level', 'id'))
+        for field, level in ANCESTRY_LEVELS:
+            setattr(self, '%s_id' % (field,), levels.get(level))
+
+    def save(self, *args, **kwargs):
+        self.set_period_ords()
+        self.set_org_unit_ancestry()
+        super(DataValue, self).save(*args, **kwargs)
 
     def __repr__(self):
         return 'DataValue<%s [%s], %s, %s, %d>' % (str(self.data_element), self.category_combo, self.site_str,  next(filter(None, (self.month, self.quarter, self.year))), self.numeric_value,)
@@ -296,66 +917,543 @@ class DataValue(models.Model):
     def __str__(self):
         return '%s [%s], %s, %s, %d' % (str(self.data_element), self.category_combo, self.site_str.split(' => ')[-1],  next(filter(None, (self.month, self.quarter, self.year))), self.numeric_value,)
 
-@lru_cache(maxsize=16) # memoize to reduce cost of "parsing"
-def extract_periods(period_str):
-    from .grabbag import period_to_dates, dates_to_iso_periods
-    dates = period_to_dates(period_str)
-    return dates_to_iso_periods(*dates)
+class AggregateValueQuerySet(DataValueQuerySet):
+    """
+    what(), where() and when() on the pre-aggregated values. There are no
+    monthly aggregates, filter months on DataValue
+    """
+    def facility_quarters(self):
+        return self.filter(grain='FACILITY_QUARTER')
 
-def load_excel_to_datavalues(source_doc, max_sheets=4):
+    def district_years(self):
+        return self.filter(grain='DISTRICT_YEAR')
+
+class AggregateValueManager(DataValueManager):
+    def get_queryset(self):
+        return AggregateValueQuerySet(self.model, using=self._db)
+
+    def facility_quarters(self):
+        return self.get_queryset().facility_quarters()
+
+    def district_years(self):
+        return self.get_queryset().district_years()
+
+class AggregateValue(models.Model):
+    """
+    Sums of data values per data element and category combo, at the facility
+    and quarter (FACILITY_QUARTER) or district and year (DISTRICT_YEAR) grain,
+    so the dashboards don't add up the raw values on each request. Values
+    above the grain's org unit level (eg. subcounty values at the facility
+    grain) keep their own org unit, yearly values have no quarter. Kept up to
+    date by refresh_aggregates() as documents are loaded or deleted, and as
+    values are edited in the admin (DataValueAdmin)
+    """
+    GRAINS = (
+        ('FACILITY_QUARTER', 'Facility, quarter'),
+        ('DISTRICT_YEAR', 'District, year'),
+    )
+
+    grain = models.CharField(max_length=16, choices=GRAINS)
+    data_element = models.ForeignKey(DataElement, related_name='+')
+    category_combo = models.ForeignKey(CategoryCombo, related_name='+')
+    org_unit = models.ForeignKey(OrgUnit, related_name='+')
+    district_ou = models.ForeignKey(OrgUnit, related_name='+', blank=True, null=True)
+    subcounty_ou = models.ForeignKey(OrgUnit, related_name='+', blank=True, null=True)
+    facility_ou = models.ForeignKey(OrgUnit, related_name='+', blank=True, null=True)
+    quarter = models.CharField(max_length=7, blank=True, null=True)
+    year = models.CharField(max_length=4)
+    year_ord = models.IntegerField()
+    quarter_ord = models.IntegerField(blank=True, null=True)
+    numeric_sum = models.DecimalField(max_digits=22, decimal_places=4)
+    values_count = models.PositiveIntegerField()
+
+    objects = AggregateValueManager()
+
+    class Meta():
+        unique_together = (('grain', 'data_element', 'category_combo', 'org_unit', 'year', 'quarter'),)
+        index_together = (('grain', 'data_element', 'year_ord'), ('grain', 'data_element', 'quarter_ord'))
+
+    def __str__(self):
+        return '%s [%s], %s, %s, %d' % (str(self.data_element), self.category_combo, self.org_unit, self.quarter or self.year, self.numeric_sum,)
+
+# the org unit a value is summed under at each grain, (org unit, district, subcounty, facility) => grain org unit
+AGGREGATE_GRAIN_ORG_UNIT = {
+    'FACILITY_QUARTER': lambda ou_id, district_id, subcounty_id, facility_id: facility_id or subcounty_id or district_id or ou_id,
+    'DISTRICT_YEAR': lambda ou_id, district_id, subcounty_id, facility_id: district_id or ou_id,
+}
+
+# the same in SQL, with the columns selected and grouped by after it
+AGGREGATE_GRAIN_SQL = {
+    'FACILITY_QUARTER': ('COALESCE(facility_ou_id, subcounty_ou_id, district_ou_id, org_unit_id)', 'district_ou_id, subcounty_ou_id, facility_ou_id, year, quarter, year_ord, quarter_ord', 'district_ou_id, subcounty_ou_id, facility_ou_id, year, quarter, year_ord, quarter_ord'),
+    'DISTRICT_YEAR': ('COALESCE(district_ou_id, org_unit_id)', 'district_ou_id, NULL, NULL, year, NULL, year_ord, NULL', 'district_ou_id, year, year_ord'),
+}
+
+# the ancestry columns of a value by level (district, subcounty, facility) at each grain, a value is summed
+# under the deepest one that is set, see AGGREGATE_GRAIN_ORG_UNIT
+AGGREGATE_GRAIN_COLUMNS = {
+    'FACILITY_QUARTER': ('district_ou_id', 'subcounty_ou_id', 'facility_ou_id'),
+    'DISTRICT_YEAR': ('district_ou_id',),
+}
+
+def aggregate_key_sql(grain, level, key_ou='k.key_ou_id'):
+    """
+    The condition on the values summed under the org unit key_ou at a grain,
+    when that org unit is at level. Unlike comparing the COALESCE() of
+    AGGREGATE_GRAIN_SQL, it can use the indexes of the ancestry columns
+    """
+    columns = AGGREGATE_GRAIN_COLUMNS[grain]
+    if level == 0:
+        return 'org_unit_id = %s AND district_ou_id IS NULL' % (key_ou,)
+    return ' AND '.join(['%s = %s' % (columns[level-1], key_ou)] + ['%s IS NULL' % (column,) for column in columns[level:]])
+
+def aggregate_keys(datavalues):
+    """The (grain, org unit id, year ordinal) keys of the aggregates a queryset of data values adds up to"""
+    keys = set()
+    for *ou_ids, year_ord in datavalues.values_list('org_unit_id', 'district_ou_id', 'subcounty_ou_id', 'facility_ou_id', 'year_ord').distinct().order_by():
+        for grain, grain_org_unit in AGGREGATE_GRAIN_ORG_UNIT.items():
+            keys.add((grain, grain_org_unit(*ou_ids), year_ord))
+    return keys
+
+def refresh_aggregates(keys=None, using='default', chunk_size=500):
+    """
+    Recompute the aggregates with the given (grain, org unit id, year ordinal)
+    keys (see aggregate_keys()) from the stored data values, whole years of an
+    org unit at a time. Without keys the whole table is rebuilt
+
+    On PostgreSQL the keys are joined as a VALUES list, other databases get
+    the same conditions OR'd together
+    """
     from collections import defaultdict
-    import re
-    import calendar
-    import openpyxl
+    from django.db import connections
+
+    use_values_list = connections[using].vendor == 'postgresql'
+    with connections[using].cursor() as cursor:
+        for grain, (grain_ou_sql, select_sql, group_sql) in AGGREGATE_GRAIN_SQL.items():
+            insert_sql = (
+                'INSERT INTO cannula_aggregatevalue (grain, data_element_id, category_combo_id, org_unit_id, district_ou_id, subcounty_ou_id, facility_ou_id, year, quarter, year_ord, quarter_ord, numeric_sum, values_count) '
+                'SELECT %%s, data_element_id, category_combo_id, %s, %s, SUM(numeric_value), COUNT(numeric_value) FROM cannula_datavalue '
+                '%%s GROUP BY data_element_id, category_combo_id, %s, %s'
+            ) % (grain_ou_sql, select_sql, grain_ou_sql, group_sql)
+            if keys is None:
+                cursor.execute('DELETE FROM cannula_aggregatevalue WHERE grain = %s', [grain])
+                cursor.execute(insert_sql % ('%s', 'WHERE year_ord IS NOT NULL'), [grain])
+                continue
+
+            grain_keys = sorted((ou_id, year_ord) for key_grain, ou_id, year_ord in keys if key_grain == grain and year_ord is not None)
+            for key_chunk in grabbag.chunked(grain_keys, chunk_size):
+                params = [p for key in key_chunk for p in key]
+                if use_values_list:
+                    keys_sql = '(org_unit_id, year_ord) IN (VALUES %s)' % (', '.join(['(%s, %s)'] * len(key_chunk)),)
+                else:
+                    keys_sql = '(%s)' % (' OR '.join(['(org_unit_id = %s AND year_ord = %s)'] * len(key_chunk)),)
+                cursor.execute('DELETE FROM cannula_aggregatevalue WHERE grain = %%s AND %s' % (keys_sql,), [grain] + params)
+
+                # the values are matched on the ancestry column of the level of each key's org unit
+                levels = dict(OrgUnit.objects.using(using).filter(id__in=set(ou_id for ou_id, _ in key_chunk)).values_list('id', 'level'))
+                level_params = defaultdict(list)
+                for ou_id, year_ord in key_chunk:
+                    if ou_id in levels and levels[ou_id] <= len(AGGREGATE_GRAIN_COLUMNS[grain]): # gone org units have no values left
+                        level_params[levels[ou_id]].extend((ou_id, year_ord))
+                for level, params in level_params.items():
+                    if use_values_list:
+                        values_sql = 'VALUES %s' % (', '.join(['(%s, %s)'] * (len(params)//2)),)
+                        where_sql = 'JOIN (%s) AS k (key_ou_id, key_year_ord) ON year_ord = k.key_year_ord AND %s' % (values_sql, aggregate_key_sql(grain, level))
+                    else:
+                        key_sql = '(%s AND year_ord = %%s)' % (aggregate_key_sql(grain, level, key_ou='%s'),)
+                        where_sql = 'WHERE %s' % (' OR '.join([key_sql] * (len(params)//2)),)
+                    cursor.execute(insert_sql % ('%s', where_sql), [grain] + params)
+    bump_data_version(using=using)
+
+def refresh_document_aggregates(source_doc, other_keys=frozenset(), using='default'):
+    """
+    Recompute the aggregates a loaded document's values add to, and those
+    with other_keys (eg. of values deleted before the document was reloaded)
+    """
+    keys = aggregate_keys(DataValue.objects.using(using).filter(source_doc=source_doc)) | set(other_keys)
+    refresh_aggregates(keys, using=using)
+    return len(keys)
 
-    MONTH_REGEX = r'[\s]*(%s) [0-9]{4}[\s]*' % ('|'.join(calendar.month_name[1:]),)
-    MONTH_PREFIX_REGEX = r'^[\s]*(%s) ([0-9]{4})?[\s]*' % ('|'.join(calendar.month_name[1:]),)
+@receiver(pre_delete, sender=SourceDocument)
+def remember_document_aggregates(sender, instance, **kwargs):
+    instance._aggregate_keys = aggregate_keys(DataValue.objects.filter(source_doc=instance))
 
-    DE_COLUMN_START = 4 # 0-based index of first dataelement column in worksheet
+@receiver(post_delete, sender=SourceDocument)
+def document_deleted(sender, instance, **kwargs):
+    # the document's values are deleted (cascaded) by now
+    refresh_aggregates(getattr(instance, '_aggregate_keys', set()))
 
-    wb = openpyxl.load_workbook(source_doc.file.path)
-    logger.debug(wb.get_sheet_names())
+class DataVersion(models.Model):
+    """
+    A single row counter of the changes to the data the dashboards show
+    (aggregates refreshed, data elements renamed or aliased), the dashboard
+    cache keys include it so cached dashboards are never stale
+    """
+    version = models.BigIntegerField(default=0)
+    changed_at = models.DateTimeField(auto_now=True)
 
-    wb_loc_values = defaultdict(list) # when a new key is encountered return a new empty list
+    def __str__(self):
+        return '%d (%s)' % (self.version, self.changed_at)
 
+def bump_data_version(using='default'):
+    from django.utils import timezone
+
+    # one UPDATE, concurrent bumps serialize on the row and are committed (or rolled back) with the change
+    DataVersion.objects.using(using).filter(id=1).update(version=F('version')+1, changed_at=timezone.now())
+
+def current_data_version(using='default'):
+    return DataVersion.objects.using(using).filter(id=1).values_list('version', flat=True).first() or 0
+
+def data_version_changed(using='default'):
+    """The (version, time of the last change) of the data, (0, None) before any"""
+    return DataVersion.objects.using(using).filter(id=1).values_list('version', 'changed_at').first() or (0, None)
+
+def extract_periods(period_str):
+    from .periods import iso_periods
+    return iso_periods(period_str) # memoized there
+
+import calendar
+MONTH_PREFIX_REGEX = r'^[\s]*(%s) ([0-9]{4})?[\s]*' % ('|'.join(calendar.month_name[1:]),)
+
+DE_COLUMN_START = 4 # 0-based index of first dataelement column in worksheet
+
+DATAVALUE_BATCH_SIZE = 2000 # number of unsaved data values held in memory before they are handed to the writer
+
+def excel_data_worksheets(wb, max_sheets=4):
+    """Yield (name, worksheet) pairs for the worksheets in a workbook that hold data values"""
     for ws_name in wb.get_sheet_names()[:max_sheets]: #['Step1', 'Targets']:
         if ws_name in ['Validations']:
             continue
-        ws = wb[ws_name]
-        logger.debug((ws_name, ws.max_row, ws.max_column))
+        yield ws_name, wb[ws_name]
 
-        headers = [cell.value for cell in ws.rows[0]]
-        # discard the month (and space) prefix on the data element names
-        clean_headers = (re.sub(MONTH_PREFIX_REGEX, '', h) for h in headers[DE_COLUMN_START:] if h is not None)
-        data_elements = tuple(unpack_data_element(de) for de in clean_headers)
+def excel_sheet_headers(wb, max_sheets=4):
+    """
+    Return a dict of the (cleaned up) data element column headers of each data
+    worksheet, worksheets without a header row are left out
+    """
+    sheet_headers = dict()
+    for ws_name, ws in excel_data_worksheets(wb, max_sheets):
+        header_row = next(ws.iter_rows(), None)
+        if header_row is None:
+            continue # skip empty worksheets
+        sheet_headers[ws_name] = clean_headers(cell.value for cell in header_row)
+    return sheet_headers
+
+def clean_headers(header_values):
+    """Data element column headers of a header row, without the month (and space) prefix"""
+    headers = list(header_values)
+    return [re.sub(MONTH_PREFIX_REGEX, '', h) for h in headers[DE_COLUMN_START:] if h is not None]
+
+def split_row_values(values):
+    """
+    Return the period and location path (with the root OrgUnit prepended) of a
+    row in the worksheet layout, or (None, None) when either is missing (or
+    the row is too short to have them, eg. a blank line of a CSV file)
+    """
+    if len(values) < DE_COLUMN_START:
+        return None, None
+    period, *location_parts = values[:DE_COLUMN_START]
+    if not period or not any(location_parts):
+        return None, None
+    return period, ('Uganda', *filter(None, location_parts)) # turn to tuple and prepend name of root OrgUnit
 
+def split_excel_row(row):
+    return split_row_values([c.value for c in row[:DE_COLUMN_START]])
 
-        for row in ws.rows[1:]: # skip header row
-            period, *location_parts = [c.value for c in row[:DE_COLUMN_START]]
-            if not period or not any(location_parts):
-                continue # ignore rows where period or location is missing
-            iso_year, iso_quarter, iso_month = extract_periods(str(period).strip())
-            location_parts = ('Uganda', *filter(None, location_parts)) # turn to tuple and prepend name of root OrgUnit
-            current_ou = OrgUnit.from_path_recurse(*location_parts)
+def is_blank(cell_value):
+    return cell_value is None or (isinstance(cell_value, str) and cell_value.strip() == '')
+
+def parse_row_values(values):
+    """
+    Parse a row in the worksheet layout into a compact tuple of (iso periods,
+    location path, ((column offset, Decimal value), ...)), or None when the row
+    has no period or location
+    """
+    period, location_parts = split_row_values(values)
+    if not period:
+        return None # ignore rows where period or location is missing
+    site_values = tuple((i, Decimal(v)) for i, v in enumerate(values[DE_COLUMN_START:]) if not is_blank(v))
+    return extract_periods(str(period).strip()), location_parts, site_values
+
+def parse_excel_row(row):
+    return parse_row_values([c.value for c in row])
+
+def row_fingerprint(headers, site_values):
+    """Hash of the non-empty (header, value) pairs of a parsed row"""
+    import hashlib
+
+    h = hashlib.sha1()
+    for i, value in site_values:
+        if i < len(headers):
+            h.update(('%s\t%s\n' % (headers[i], value.normalize())).encode('utf-8'))
+    return h.hexdigest()
+
+def previous_row_fingerprints(source_doc, locations):
+    """
+    Return a dict of the latest (fingerprint, source document id) recorded by
+    the documents uploaded before source_doc for each (sheet, period,
+    location) row at the given locations
+    """
+    qs = SourceRowFingerprint.objects.filter(location__in=set(locations), source_doc__uploaded_at__lt=source_doc.uploaded_at)
+    qs = qs.order_by('source_doc__uploaded_at', 'id') # later documents overwrite earlier ones
+    return dict(((sheet, period, location), (fingerprint, doc_id)) for sheet, period, location, fingerprint, doc_id in qs.values_list('sheet', 'period', 'location', 'fingerprint', 'source_doc_id'))
+
+def iso_period_filter(period):
+    """The DataValue filter for the values of an iso month, quarter or year (and not of the periods in it)"""
+    if '-Q' in period:
+        return {'quarter': period, 'month__isnull': True}
+    if '-' in period:
+        return {'month': period}
+    return {'year': period, 'quarter__isnull': True, 'month__isnull': True}
+
+def reassign_skipped_rows(source_doc, skipped_rows, sheet_elements):
+    """
+    Attribute the stored values of rows skipped as unchanged, given as
+    (previous document id, sheet, period, location), to source_doc: it has
+    them too, they must not go when the previous document is deleted
+    """
+    from collections import defaultdict
+
+    by_period = defaultdict(set)
+    for doc_id, ws_name, period, location in skipped_rows:
+        by_period[(doc_id, ws_name, period)].add(location)
+    for (doc_id, ws_name, period), locations in by_period.items():
+        de_ids = set(de.id for de, _ in sheet_elements[ws_name])
+        qs = DataValue.objects.filter(source_doc_id=doc_id, site_str__in=locations, data_element_id__in=de_ids, **iso_period_filter(period))
+        qs.update(source_doc=source_doc)
+
+def no_progress(phase, **counts):
+    pass
+
+ROW_CHUNK_SIZE = 1000 # rows read before their locations are resolved (and previous fingerprints looked up) together
+
+def iter_parsed_datavalues(source_doc, parsed_rows, sheet_headers, sheet_elements, ou_loader, batch_size=DATAVALUE_BATCH_SIZE, progress=no_progress, skip_unchanged=False, record_fingerprints=False):
+    """
+    Turn parsed rows of (sheet name, iso periods, location path, values) into
+    batches of at most batch_size (unsaved) DataValue instances. The locations
+    are resolved with ou_loader a chunk of rows at a time, as they are read.
+    progress is told of the 'parse', 'resolve' and 'write' phase of each chunk
+    (the batches are written while the 'write' phase lasts).
+
+    With skip_unchanged, rows whose fingerprint matches the one recorded by
+    an earlier document are skipped (their stored values are attributed to
+    source_doc instead), when record_fingerprints is set the fingerprint of
+    every row is stored against source_doc
+    """
+    from .periods import iso_period_ordinals
+
+    batch = list()
+    fingerprints = list()
+    rows_done = rows_skipped = values_done = 0
+    if record_fingerprints:
+        SourceRowFingerprint.objects.filter(source_doc=source_doc).delete() # from an earlier load of the same document
+
+    # the rows are parsed as they are pulled, so the phases take turns for each chunk
+    row_chunks = grabbag.chunked(parsed_rows, ROW_CHUNK_SIZE)
+    while True:
+        progress('parse')
+        row_chunk = next(row_chunks, None)
+        if row_chunk is None:
+            break
+
+        progress('resolve')
+        ou_paths = set(location_parts for _, _, location_parts, _ in row_chunk)
+        ou_loader.resolve_all(ou_paths)
+        previous_fingerprints = None
+        if skip_unchanged:
+            previous_fingerprints = previous_row_fingerprints(source_doc, (' => '.join(p) for p in ou_paths))
+        skipped_rows = list()
+
+        progress('write', rows_done=rows_done, rows_skipped=rows_skipped, values_done=values_done)
+        for ws_name, (iso_year, iso_quarter, iso_month), location_parts, site_values in row_chunk:
             location = ' => '.join(location_parts)
-            logger.debug((period, location))
-
-            site_val_cells = row[DE_COLUMN_START:]
-            site_values = zip(data_elements, (c.value for c in site_val_cells))
-            dv_construct = partial(DataValue, site_str=location, org_unit=current_ou, month=iso_month, quarter=iso_quarter, year=iso_year, source_doc=source_doc)
-            data_values = list()
-            for (de, cc), dv in site_values:
-                if dv is None or (isinstance(dv, str) and dv.strip() == ''):
-                    continue # skip rows with empty values
+            logger.debug((ws_name, iso_year, iso_quarter, iso_month, location))
+            rows_done += 1
+
+            period = iso_month or iso_quarter or iso_year
+            fingerprint = row_fingerprint(sheet_headers[ws_name], site_values)
+            if record_fingerprints:
+                fingerprints.append(SourceRowFingerprint(source_doc=source_doc, sheet=ws_name, period=period, location=location, fingerprint=fingerprint))
+                if len(fingerprints) >= batch_size:
+                    SourceRowFingerprint.objects.bulk_create(fingerprints)
+                    fingerprints = list()
+            previous_fingerprint, previous_doc_id = previous_fingerprints.get((ws_name, period, location), (None, None)) if previous_fingerprints else (None, None)
+            if previous_fingerprint == fingerprint:
+                rows_skipped += 1
+                skipped_rows.append((previous_doc_id, ws_name, period, location))
+                continue # unchanged since the previous version of the document
+
+            data_elements = sheet_elements[ws_name]
+            year_ord, quarter_ord, month_ord = iso_period_ordinals(iso_year, iso_quarter, iso_month)
+            district_id, subcounty_id, facility_id = path_ancestry(ou_loader.resolved, location_parts)
+            dv_construct = partial(
+                DataValue, site_str=location, org_unit_id=ou_loader.resolved[location_parts],
+                district_ou_id=district_id, subcounty_ou_id=subcounty_id, facility_ou_id=facility_id,
+                month=iso_month, quarter=iso_quarter, year=iso_year, year_ord=year_ord, quarter_ord=quarter_ord, month_ord=month_ord,
+                source_doc=source_doc
+            )
+            for i, dv in site_values:
+                if i >= len(data_elements):
+                    break # values without a header
+                de, cc = data_elements[i]
                 if cc:
-                    data_values.append(dv_construct(data_element=de, category_combo=cc, numeric_value=Decimal(dv)))
+                    batch.append(dv_construct(data_element=de, category_combo=cc, numeric_value=dv))
                 else:
-                    data_values.append(dv_construct(data_element=de, numeric_value=Decimal(dv)))
+                    batch.append(dv_construct(data_element=de, numeric_value=dv))
+
+                if len(batch) >= batch_size:
+                    yield batch
+                    values_done += len(batch)
+                    progress('write', rows_done=rows_done, rows_skipped=rows_skipped, values_done=values_done)
+                    batch = list()
+
+        if skipped_rows:
+            reassign_skipped_rows(source_doc, skipped_rows, sheet_elements)
+
+    progress('write', rows_done=rows_done, rows_skipped=rows_skipped, values_done=values_done)
+    if batch:
+        yield batch
+        values_done += len(batch)
+    if fingerprints:
+        SourceRowFingerprint.objects.bulk_create(fingerprints)
+    progress('write', rows_done=rows_done, rows_skipped=rows_skipped, values_done=values_done)
+
+def iter_source_datavalues(source_doc, reader, batch_size=DATAVALUE_BATCH_SIZE, progress=no_progress, skip_unchanged=False, record_fingerprints=False, ou_loader=None, resolver=None):
+    """
+    Stream the data values read by one of the input readers (see readers.py)
+    and yield them as lists of at most batch_size (unsaved) DataValue instances.
+    The rows are read once, their locations are resolved as they come
+
+    progress is called as progress(phase, **counts) when a phase ('parse',
+    'resolve', 'write') starts, again for each chunk of rows as the phases take
+    turns, and as rows are handed to the writer. With
+    skip_unchanged, rows identical to those of the previously loaded version of
+    the same period and location are left out. Pass in the org unit loader and
+    data element resolver to use (eg. dry run ones) to inspect them afterwards
+    """
+    progress('parse')
+    sheet_headers, rows_total = reader.read_headers()
+
+    progress('resolve', rows_total=rows_total)
+    if resolver is None:
+        resolver = DataElementResolver()
+    sheet_elements = reader.resolve_elements(resolver, sheet_headers)
+    if ou_loader is None:
+        ou_loader = OrgUnitTreeLoader()
+
+    yield from iter_parsed_datavalues(source_doc, reader.iter_rows(), sheet_headers, sheet_elements, ou_loader, batch_size, progress, skip_unchanged, record_fingerprints)
+
+def iter_excel_datavalues(source_doc, max_sheets=4, batch_size=DATAVALUE_BATCH_SIZE, progress=no_progress, skip_unchanged=False, record_fingerprints=False):
+    """
+    Stream the data values in a workbook, reading each worksheet row by row in
+    read-only mode, see iter_source_datavalues()
+    """
+    from .readers import ExcelReader
+
+    reader = ExcelReader(source_doc.file.path, max_sheets)
+    yield from iter_source_datavalues(source_doc, reader, batch_size, progress, skip_unchanged, record_fingerprints)
+
+def iter_excel_datavalues_parallel(source_doc, max_sheets=4, batch_size=DATAVALUE_BATCH_SIZE, progress=no_progress, processes=None, skip_unchanged=False, record_fingerprints=False):
+    """
+    Like iter_excel_datavalues(), but the worksheets are parsed in a pool of
+    worker processes, one per worksheet (see readers.ParallelExcelReader)
+    """
+    from .readers import ParallelExcelReader
+
+    reader = ParallelExcelReader(source_doc.file.path, max_sheets, processes)
+    yield from iter_source_datavalues(source_doc, reader, batch_size, progress, skip_unchanged, record_fingerprints)
+
+def load_excel_to_datavalues(source_doc, max_sheets=4):
+    from collections import defaultdict
+
+    wb_loc_values = defaultdict(list) # when a new key is encountered return a new empty list
 
-            wb_loc_values[location].extend(data_values)
+    for dv_batch in iter_excel_datavalues(source_doc, max_sheets):
+        for dv in dv_batch:
+            wb_loc_values[dv.site_str].append(dv)
 
     return dict(wb_loc_values) # convert back to a normal dict for our callers
 
+def write_batches(dv_batches, loader):
+    """
+    Hand the batches to the loader, committing each one (and the loader's
+    finish()) in its own transaction. Returns what finish() does
+    """
+    from django.db import transaction
+
+    for dv_batch in dv_batches:
+        with transaction.atomic(using=loader.using):
+            loader.write(dv_batch)
+    with transaction.atomic(using=loader.using):
+        return loader.finish()
+
+def save_excel_datavalues(source_doc, max_sheets=4, batch_size=DATAVALUE_BATCH_SIZE, loader=None, progress=no_progress, processes=1, skip_unchanged=False):
+    """
+    Stream the data values in a workbook into the database one batch at a time,
+    so memory use is bounded by the batch size rather than the workbook size,
+    and commit each batch as it is written (see write_batches()). Pass an
+    upsert loader (bulkload.get_loader(upsert=True)) to merge the values into
+    those already stored, and processes > 1 (or None for one per CPU) to parse
+    the worksheets in parallel, one process per worksheet. With skip_unchanged only the rows that changed
+    since the previous version of the document are written (use with an
+    upsert loader). Returns the number of values processed
+    """
+    from .bulkload import get_loader
+
+    if loader is None:
+        loader = get_loader()
+    if processes == 1:
+        dv_batches = iter_excel_datavalues(source_doc, max_sheets, batch_size, progress=progress, skip_unchanged=skip_unchanged, record_fingerprints=True)
+    else:
+        dv_batches = iter_excel_datavalues_parallel(source_doc, max_sheets, batch_size, progress=progress, processes=processes, skip_unchanged=skip_unchanged, record_fingerprints=True)
+    return write_batches(dv_batches, loader)
+
+def save_source_datavalues(source_doc, max_sheets=4, batch_size=DATAVALUE_BATCH_SIZE, loader=None, progress=no_progress, processes=1, skip_unchanged=False):
+    """
+    Like save_excel_datavalues(), for any of the input formats in readers.py,
+    picked by the extension of the uploaded file. Only workbooks are parsed in
+    parallel
+    """
+    from .bulkload import get_loader
+    from .readers import ExcelReader, get_reader
+
+    reader = get_reader(source_doc.file.path, max_sheets)
+    if type(reader) is ExcelReader: # not its CsvReader subclass
+        return save_excel_datavalues(source_doc, max_sheets, batch_size, loader, progress, processes, skip_unchanged)
+
+    if loader is None:
+        loader = get_loader()
+    dv_batches = iter_source_datavalues(source_doc, reader, batch_size, progress=progress, skip_unchanged=skip_unchanged, record_fingerprints=True)
+    return write_batches(dv_batches, loader)
+
+def profile_source_datavalues(source_doc, max_sheets=4, batch_size=DATAVALUE_BATCH_SIZE, progress=no_progress):
+    """
+    Dry run of save_source_datavalues(): parse and resolve everything in memory,
+    without writing to the database, and return a profile of what a load would
+    do (new org units, data elements and category combos, repeated and already
+    stored keys, values out of range) as a dict
+    """
+    from .bulkload import DryRunLoader
+    from .readers import get_reader
+
+    def profile_progress(phase, **counts):
+        progress('profile' if phase == 'write' else phase, **counts)
+
+    ou_loader = OrgUnitTreeLoader(dry_run=True)
+    resolver = DataElementResolver(dry_run=True)
+    loader = DryRunLoader()
+    reader = get_reader(source_doc.file.path, max_sheets)
+    for dv_batch in iter_source_datavalues(source_doc, reader, batch_size, progress=profile_progress, ou_loader=ou_loader, resolver=resolver):
+        loader.write(dv_batch)
+    loader.finish()
+
+    profile = loader.profile()
+    profile.update(
+        new_org_units=[' => '.join(p) for p in ou_loader.new_paths],
+        new_data_elements=[de.name for de in resolver.new_elements],
+        new_category_combos=[cc.name for cc in resolver.new_cat_combos],
+    )
+    return profile
+
 def de_pivot_col(de):
     return 'DE_%d' % (de.id,)
 
@@ -373,14 +1471,16 @@ def validation_expr_elements(expr):
     sorted_names = list(sorted(names, reverse=True)) # sort puts longest matches first
     DE_REGEX = '|'.join('%s' % (re.escape(de_name),) for de_name in sorted_names)
     m = re.findall(DE_REGEX, expr, flags=re.IGNORECASE)
-    print(m)
+    logger.debug(m)
     return tuple(filter(None, m))
 
-def load_excel_to_validations(source_doc):
+def load_excel_to_validations(source_doc, progress=no_progress):
     import openpyxl
 
+    progress('parse')
     wb = openpyxl.load_workbook(source_doc.file.path) #TODO: ensure we close the workbook file. use a context manager?
     logger.debug(wb.get_sheet_names())
+    num_rules = 0
 
     for ws_name in wb.get_sheet_names():
         if ws_name != 'Validations':
@@ -388,13 +1488,14 @@ def load_excel_to_validations(source_doc):
 
         ws = wb[ws_name]
         logger.debug((ws_name, ws.max_row, ws.max_column))
+        progress('validate', rows_total=ws.max_row-1)
 
         
         for row in ws.rows[1:]: # skip header row
             validation_name, l_exp, op, r_exp, *_ = [c.value for c in row]
             if not l_exp or not op or not r_exp:
                 continue # ignore rows where any part of the rule is missing
-            print(validation_name, l_exp, op, r_exp)
+            logger.debug((validation_name, l_exp, op, r_exp))
             l_element_names = validation_expr_elements(l_exp)
             r_element_names = validation_expr_elements(r_exp)
             element_names = l_element_names + r_element_names
@@ -406,14 +1507,16 @@ def load_excel_to_validations(source_doc):
                 except ValidationRule.DoesNotExist as e:
                     vr = ValidationRule(name=validation_name, left_expr=l_exp, right_expr=r_exp, operator=op)
                 vr.save()
-                print(vr.view_name())
+                num_rules += 1
+                logger.debug(vr.view_name())
 
+    progress('validate', rows_done=num_rules)
     return
 
     ou_level = month_multiple = None
     search_periods = ['2016']
     de_meta_list = query_de_meta(tt_names)
-    print(de_meta_list)
+    logger.debug(de_meta_list)
     calc_exprs = (
         ('DE_5*100/DE_22', ['DE_22',]),
         ('DE_6*100/DE_22', ['DE_22',]),
@@ -423,7 +1526,7 @@ def load_excel_to_validations(source_doc):
     if month_multiple is None:
         month_multiple = max(map(lambda x: x.month_multiple, de_meta_list))
     calc_query = mk_calculation_sql(calc_exprs, de_meta_list, [], ou_level, search_periods, month_multiple)
-    print(calc_query)
+    logger.debug(calc_query)
 
 def mk_validation_rule_sql(rule_expr, data_elements):
     de_meta_list = query_de_meta(data_elements)
@@ -0,0 +1,363 @@
+"""
+Input readers for the data value ingestion pipeline (iter_source_datavalues()).
+
+Every reader streams its file and provides:
+
+read_headers() -- (sheet headers, number of rows or an estimate of it, or None)
+resolve_elements(resolver, sheet_headers) -- (DataElement, CategoryCombo) pairs for each header, per sheet
+iter_rows() -- the pass over the rows, yielding (sheet name, iso periods, location path, ((column offset, Decimal value), ...))
+
+The locations of the rows are resolved as they are read, workbooks and CSV
+files are only parsed once (DHIS2 JSON exports are read twice, the first pass
+collects the data elements and org units of the export).
+
+Use get_reader() to pick one by file extension
+"""
+import csv
+import json
+import os
+import re
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+
+from . import grabbag
+from .models import OrgUnit, DataElement, DE_COLUMN_START, clean_headers, extract_periods, parse_excel_row, parse_row_values, excel_data_worksheets, excel_sheet_headers
+
+import logging
+logger = logging.getLogger(__name__)
+
+class ExcelReader():
+    """Workbooks with a period column, three location columns and then a column per data element"""
+    def __init__(self, path, max_sheets=4):
+        self.path = path
+        self.max_sheets = max_sheets
+        self.wb = None
+
+    def workbook(self):
+        import openpyxl
+
+        if self.wb is None:
+            self.wb = openpyxl.load_workbook(self.path, read_only=True)
+            logger.debug(self.wb.get_sheet_names())
+        return self.wb
+
+    def read_headers(self):
+        wb = self.workbook()
+        sheet_headers = excel_sheet_headers(wb, self.max_sheets)
+        num_rows = 0
+        for ws_name, ws in excel_data_worksheets(wb, self.max_sheets):
+            if ws_name in sheet_headers:
+                num_rows += max((ws.max_row or 0) - 1, 0) # from the sheet dimensions, blank rows included
+        return sheet_headers, num_rows or None
+
+    def resolve_elements(self, resolver, sheet_headers):
+        return dict((ws_name, resolver.resolve_all(headers)) for ws_name, headers in sheet_headers.items())
+
+    def iter_rows(self):
+        for ws_name, ws in excel_data_worksheets(self.workbook(), self.max_sheets):
+            logger.debug(ws_name)
+            for row in islice(ws.iter_rows(), 1, None): # skip header row
+                parsed = parse_excel_row(row)
+                if parsed:
+                    yield (ws_name, *parsed)
+
+PARSE_CHUNK_ROWS = 1000 # parsed rows a parse worker sends back at a time
+
+parse_queue = None # of a parse worker process, see init_parse_worker()
+
+def init_parse_worker(queue):
+    global parse_queue
+    parse_queue = queue
+
+def parse_worksheet_task(args):
+    """
+    Parse the rows of a worksheet with parse_excel_row(), in a parse worker
+    process (so it must not touch the database). The rows are sent back through
+    the queue in chunks of PARSE_CHUNK_ROWS, followed by None, or the error
+    """
+    import openpyxl
+    import traceback
+
+    path, ws_name = args
+    try:
+        ws = openpyxl.load_workbook(path, read_only=True)[ws_name]
+        parsed_rows = filter(None, (parse_excel_row(row) for row in islice(ws.iter_rows(), 1, None))) # skip header row
+        for row_chunk in grabbag.chunked(parsed_rows, PARSE_CHUNK_ROWS):
+            parse_queue.put((ws_name, row_chunk))
+        parse_queue.put((ws_name, None))
+    except Exception:
+        parse_queue.put((ws_name, traceback.format_exc()))
+
+class ParallelExcelReader(ExcelReader):
+    """
+    Parses the data worksheets of a workbook in a pool of worker processes,
+    one worksheet per process. Each worksheet is read once, its rows are
+    streamed back in chunks (so the rows of the worksheets come interleaved)
+    through a bounded queue, which keeps the workers from running too far
+    ahead of the writer. Workbooks with a single data worksheet are parsed in
+    this process.
+
+    A worker that dies (eg. killed for running out of memory) sends nothing
+    more, after idle_timeout seconds without a chunk the parse fails
+    """
+    idle_timeout = 300 # seconds
+
+    def __init__(self, path, max_sheets=4, processes=None):
+        super(ParallelExcelReader, self).__init__(path, max_sheets)
+        self.processes = processes
+
+    def iter_rows(self):
+        from multiprocessing import Pool, Queue, cpu_count
+        from queue import Empty
+        import time
+
+        ws_names = list(excel_sheet_headers(self.workbook(), self.max_sheets))
+        if len(ws_names) < 2:
+            yield from super(ParallelExcelReader, self).iter_rows()
+            return
+
+        queue = Queue(maxsize=2*len(ws_names))
+        with Pool(min(self.processes or cpu_count(), len(ws_names)), initializer=init_parse_worker, initargs=(queue,)) as pool:
+            result = pool.map_async(parse_worksheet_task, [(self.path, ws_name) for ws_name in ws_names])
+            num_parsing = len(ws_names)
+            last_chunk_at = time.monotonic()
+            while num_parsing:
+                try:
+                    ws_name, row_chunk = queue.get(timeout=1)
+                except Empty:
+                    if result.ready():
+                        result.get() # raises what failed outside of parse_worksheet_task()
+                        raise ValueError('Parsing \'%s\' failed: the parse workers finished without sending all the worksheets' % (self.path,))
+                    if time.monotonic() - last_chunk_at > self.idle_timeout:
+                        raise ValueError('Parsing \'%s\' failed: no rows from the parse workers for %d seconds, one of them may have died' % (self.path, self.idle_timeout))
+                    continue
+                last_chunk_at = time.monotonic()
+                if row_chunk is None:
+                    num_parsing -= 1
+                elif isinstance(row_chunk, str):
+                    raise ValueError('Parsing worksheet \'%s\' failed:\n%s' % (ws_name, row_chunk))
+                else:
+                    for parsed in row_chunk:
+                        yield (ws_name, *parsed)
+
+class CsvReader(ExcelReader):
+    """CSV files in the same layout as a single workbook worksheet"""
+    sheet_name = 'CSV'
+
+    def open_rows(self):
+        with open(self.path, newline='', encoding='utf-8-sig') as f: # Excel saves CSV with a byte order mark
+            yield from csv.reader(f)
+
+    def read_headers(self):
+        header_row = next(self.open_rows(), None)
+        if header_row is None:
+            return dict(), None
+        return {self.sheet_name: clean_headers(h.strip() or None for h in header_row)}, None
+
+    def iter_rows(self):
+        for row in islice(self.open_rows(), 1, None): # skip header row
+            parsed = parse_row_values([v.strip() for v in row[:DE_COLUMN_START]] + row[DE_COLUMN_START:])
+            if parsed:
+                yield (self.sheet_name, *parsed)
+
+def iter_json_array(f, key, chunk_size=64*1024):
+    """
+    Yield the items of the array stored under key in a JSON document, reading
+    the file in chunks instead of loading the whole document
+
+    >>> import io
+    >>> list(iter_json_array(io.StringIO('{"dataSet": "x", "dataValues": [{"value": "1"}, {"value": "2"}]}'), 'dataValues', chunk_size=8))
+    [{'value': '1'}, {'value': '2'}]
+
+    """
+    decoder = json.JSONDecoder()
+    start_regex = re.compile(r'"%s"\s*:\s*\[' % (re.escape(key),))
+    skip_regex = re.compile(r'[\s,]*')
+
+    buf = ''
+    while True:
+        m = start_regex.search(buf)
+        if m:
+            break
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return # no such array
+        buf = buf[-(len(key)+64):] + chunk # keep the tail, the key may straddle two chunks
+
+    pos = m.end()
+    while True:
+        pos = skip_regex.match(buf, pos).end()
+        if buf.startswith(']', pos):
+            return
+        try:
+            item, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise # truncated document
+            buf = buf[pos:] + chunk # only the incomplete item is carried over
+            pos = 0
+            continue
+        yield item
+
+DHIS2_MONTH_REGEX = re.compile(r'^([0-9]{4})([0-9]{2})$')
+
+def dhis2_period(pe):
+    """
+    Convert a DHIS2 period id (monthly, quarterly or yearly) to one extract_periods() understands
+
+    >>> dhis2_period('201802'), dhis2_period('2018Q1'), dhis2_period('2018')
+    ('2018-02', '2018Q1', '2018')
+
+    """
+    m = DHIS2_MONTH_REGEX.match(pe)
+    if m:
+        return '%s-%s' % m.groups()
+    if re.match(r'^[0-9]{4}(Q[1-4])?$', pe):
+        return pe
+    raise ValidationError('Unsupported DHIS2 period: \'%s\'' % (pe,))
+
+class Dhis2JsonReader():
+    """
+    DHIS2 dataValueSets JSON exports. Data elements are matched on
+    DataElement.dhis2_uid where it is set and on the name otherwise. As we
+    don't keep DHIS2 ids for organisation units and category option combos,
+    export those by name (orgUnitIdScheme=NAME, idScheme=NAME); an org unit may
+    also be given as a full location path ('Uganda => ... => facility').
+
+    The values for the same period and org unit make up one row. When they
+    come together (DHIS2 exports them ordered by period and org unit) the
+    rows are streamed, only their keys are kept while reading. Otherwise they
+    are grouped in memory, for at most max_unsorted_values values. Values that
+    aren't numbers (BOOLEAN, TEXT, ... value types) and values of unsupported
+    periods (weekly, ...) are skipped and counted in values_skipped
+    """
+    sheet_name = 'dataValues'
+    max_unsorted_values = 500000 # values grouped into rows in memory, for exports not ordered by period and org unit
+
+    def __init__(self, path, *args):
+        self.path = path
+        self.columns = None # (data element, category option combo) => column offset
+        self.ou_paths = None # org unit in the export => location path
+        self.periods = dict() # DHIS2 period => iso periods, None when unsupported
+        self.grouped = None # whether the values of each row come together
+        self.values_skipped = 0
+
+    def iter_values(self):
+        with open(self.path, encoding='utf-8') as f:
+            for dv in iter_json_array(f, 'dataValues'):
+                if dv.get('value') in (None, ''):
+                    continue
+                yield dv['period'], dv['orgUnit'], dv['dataElement'], dv.get('categoryOptionCombo') or 'default', dv['value']
+
+    def iso_periods(self, pe):
+        if pe not in self.periods:
+            try:
+                self.periods[pe] = extract_periods(dhis2_period(pe))
+            except ValidationError:
+                logger.warning('%s: skipping the values of unsupported period \'%s\'' % (self.path, pe))
+                self.periods[pe] = None
+        return self.periods[pe]
+
+    def iter_numbers(self):
+        """The values as Decimals, without those skipped (counted in values_skipped)"""
+        self.values_skipped = 0
+        for pe, ou, de, coc, value in self.iter_values():
+            try:
+                value = Decimal(value)
+            except (InvalidOperation, TypeError):
+                value = None
+            if value is None or not value.is_finite() or self.iso_periods(pe) is None:
+                self.values_skipped += 1
+                continue
+            yield pe, ou, de, coc, value
+
+    def org_unit_paths(self, org_units):
+        """Map the org unit names (or location paths) in the export to location paths"""
+        ou_paths = dict((ou, tuple(ou.split(' => '))) for ou in org_units if ' => ' in ou)
+        names = set(org_units).difference(ou_paths)
+        if names:
+            tree = dict((ou_id, (parent_id, name)) for ou_id, parent_id, name in OrgUnit.objects.values_list('id', 'parent_id', 'name'))
+            by_name = dict()
+            for ou_id, (_, name) in tree.items():
+                if name in names:
+                    by_name.setdefault(name, list()).append(ou_id)
+            for name in names:
+                if len(by_name.get(name, [])) != 1:
+                    raise ValidationError('Organisation unit \'%s\' is %s' % (name, 'ambiguous' if name in by_name else 'unknown'))
+                path, ou_id = list(), by_name[name][0]
+                while ou_id is not None:
+                    parent_id, ou_name = tree[ou_id]
+                    path.append(ou_name)
+                    ou_id = parent_id
+                ou_paths[name] = tuple(reversed(path))
+        return ou_paths
+
+    def read_headers(self):
+        # a first pass over the values collects the columns and org units, and checks how the rows are ordered
+        self.columns = dict()
+        org_units = set()
+        row_keys, prev_key = set(), None
+        num_values = 0
+        self.grouped = True
+        for pe, ou, de, coc, _ in self.iter_numbers():
+            num_values += 1
+            org_units.add(ou)
+            self.columns.setdefault((de, coc), len(self.columns))
+            if (pe, ou) != prev_key:
+                if (pe, ou) in row_keys:
+                    self.grouped = False # more values for a row read before
+                row_keys.add((pe, ou))
+                prev_key = (pe, ou)
+        if self.values_skipped:
+            logger.warning('%s: skipped %d values that are not numbers or of unsupported periods' % (self.path, self.values_skipped))
+        if not self.grouped and num_values > self.max_unsorted_values:
+            raise ValidationError('The export has %d values and isn\'t ordered by period and organisation unit, at most %d values are grouped into rows in memory: export it ordered, or in parts' % (num_values, self.max_unsorted_values))
+
+        self.ou_paths = self.org_unit_paths(org_units)
+        # headers are only used to fingerprint rows, make them readable anyway
+        headers = ['%s %s' % de_coc for de_coc in sorted(self.columns, key=self.columns.get)]
+        return {self.sheet_name: headers}, len(row_keys)
+
+    def resolve_elements(self, resolver, sheet_headers):
+        uid_names = dict(DataElement.objects.exclude(dhis2_uid=None).values_list('dhis2_uid', 'name'))
+        names = list()
+        for de, coc in sorted(self.columns, key=self.columns.get):
+            category_list = [] if coc == 'default' else coc.split(', ')
+            names.append((uid_names.get(de, de), category_list))
+        return {self.sheet_name: resolver.resolve_names(names)}
+
+    def make_row(self, key, site_values):
+        pe, ou = key
+        return (self.sheet_name, self.periods[pe], self.ou_paths[ou], tuple(sorted(site_values.items())))
+
+    def iter_rows(self):
+        if not self.grouped:
+            rows = dict() # (period, org unit) => {column offset: value}, a repeated value replaces the earlier one
+            for pe, ou, de, coc, value in self.iter_numbers():
+                rows.setdefault((pe, ou), dict())[self.columns[(de, coc)]] = value
+            for key, site_values in rows.items():
+                yield self.make_row(key, site_values)
+            return
+
+        prev_key, site_values = None, dict()
+        for pe, ou, de, coc, value in self.iter_numbers():
+            if (pe, ou) != prev_key:
+                if site_values:
+                    yield self.make_row(prev_key, site_values)
+                prev_key, site_values = (pe, ou), dict()
+            site_values[self.columns[(de, coc)]] = value
+        if site_values:
+            yield self.make_row(prev_key, site_values)
+
+READERS = {
+    '.csv': CsvReader,
+    '.json': Dhis2JsonReader,
+}
+
+def get_reader(path, max_sheets=4):
+    """Return a reader for the file, workbooks are the default"""
+    ext = os.path.splitext(path)[1].lower()
+    return READERS.get(ext, ExcelReader)(path, max_sheets)
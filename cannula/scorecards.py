@@ -0,0 +1,173 @@
+"""
+The scorecard dashboards, as dashboards.Dashboard specs
+"""
+from itertools import product
+
+from .dashboards import CategoryBucket, Col, Dashboard, Percent, Quotient, Series, Total
+
+HTS_DE_NAMES = (
+    '105-4 Number of clients who have been linked to care',
+    '105-4 Number of Individuals who received HIV test results',
+    '105-4 Number of Individuals who tested HIV positive',
+)
+HTS_LINKED, HTS_TESTED, HTS_POSITIVE = HTS_DE_NAMES
+
+AGE_SEX_CATEGORIES = ['(<15, Female)', '(<15, Male)', '(15+, Female)', '(15+, Male)']
+U15_F, U15_M, O15_F, O15_M = AGE_SEX_CATEGORIES
+CC_LT_15 = ['18 Mths-<5 Years', '5-<10 Years', '10-<15 Years']
+CC_GE_15 = ['15-<19 Years', '19-<49 Years', '>49 Years']
+AGE_SEX_BUCKETS = (
+    CategoryBucket(U15_F, CC_LT_15, name_contains='Female'),
+    CategoryBucket(U15_M, CC_LT_15, name_contains='Female', exclude=True),
+    CategoryBucket(O15_F, CC_GE_15, name_contains='Female'),
+    CategoryBucket(O15_M, CC_GE_15, name_contains='Female', exclude=True),
+)
+
+PMTCT_MOTHER_DE_NAMES = (
+    '105-2.1 Pregnant Women newly tested for HIV this pregnancy(TR & TRR)',
+    '105-2.2a Women tested for HIV in labour (1st time this Pregnancy)',
+    '105-2.3a Breastfeeding mothers tested for HIV(1st test)',
+)
+PMTCT_MOTHER_POS_DE_NAMES = (
+    '105-2.1 A19:Pregnant Women testing HIV+ on a retest (TRR+)',
+    '105-2.2a Women testing HIV+ in labour (1st time this Pregnancy)',
+    '105-2.2b Women testing HIV+ in labour (Retest this Pregnancy)',
+    '105-2.3a Breastfeeding mothers newly testing HIV+(1st test)',
+    '105-2.3b Breastfeeding mothers newly testing HIV+(retest)',
+)
+PMTCT_CHILD_DE_NAMES = (
+    '105-2.4a Exposed Infants Tested for HIV Below 18 Months(by 1st PCR) ',
+    '105-2.4b 1st DNA PCR result returned(HIV+)',
+    '105-2.4b 2nd DNA PCR result returned(HIV+)',
+    '105-2.1a Male partners received HIV test results in eMTCT(Total)',
+    '105-2.1b Male partners received HIV test results in eMTCT(HIV+)',
+)
+PMTCT_INFANT_POS, PMTCT_PCR1_POS, PMTCT_PCR2_POS, PMTCT_MALE_PARTNERS_TESTED, PMTCT_MALE_PARTNERS_POS = PMTCT_CHILD_DE_NAMES
+HTS_TARGET_DE_NAMES = (
+    'HTC_TST_TARGET',
+    'HTC_TST_POS_TARGET',
+)
+HTS_TST_TARGET, HTS_POS_TARGET = HTS_TARGET_DE_NAMES
+
+def hts_dashboard(level, target_divisor=None):
+    """HIV testing by age and sex against targets, by site or district"""
+    half_infants = Quotient(Total(Col(PMTCT_INFANT_POS)), 2)
+    half_pcr_pos = Quotient(Total(Col(PMTCT_PCR1_POS), Col(PMTCT_PCR2_POS)), 2)
+    derived = [
+        (('Tested', U15_F), Total(Col(HTS_TESTED, U15_F), half_infants)),
+        (('Tested', U15_M), Total(Col(HTS_TESTED, U15_M), half_infants)),
+        (('Tested', O15_F), Total(Col(HTS_TESTED, O15_F), Col('Pregnant Women tested for HIV'))),
+        (('Tested', O15_M), Total(Col(HTS_TESTED, O15_M), Col(PMTCT_MALE_PARTNERS_TESTED))),
+        (('HIV+', U15_F), Total(Col(HTS_POSITIVE, U15_F), half_pcr_pos)),
+        (('HIV+', U15_M), Total(Col(HTS_POSITIVE, U15_M), half_pcr_pos)),
+        (('HIV+', O15_F), Total(Col(HTS_POSITIVE, O15_F), Col('Pregnant Women testing HIV+'))),
+        (('HIV+', O15_M), Total(Col(HTS_POSITIVE, O15_M), Col(PMTCT_MALE_PARTNERS_POS))),
+        ('Tested', Total(*[Col('Tested', c) for c in AGE_SEX_CATEGORIES])),
+        ('HIV+', Total(*[Col('HIV+', c) for c in AGE_SEX_CATEGORIES])),
+    ]
+    derived += [(('Tested (%)', c), Percent(Col('Tested', c), Col(HTS_TST_TARGET, c))) for c in AGE_SEX_CATEGORIES]
+    derived += [(('HIV+ (%)', c), Percent(Col('HIV+', c), Col(HTS_POS_TARGET, c))) for c in AGE_SEX_CATEGORIES]
+    derived += [(('Linked (%)', c), Percent(Col(HTS_LINKED, c), Col(HTS_POSITIVE, c))) for c in AGE_SEX_CATEGORIES]
+
+    columns = list(product(['Tested', 'HIV+'], AGE_SEX_CATEGORIES))
+    columns += [('Tested', None), ('HIV+', None)]
+    columns += [(HTS_LINKED, c, 'Linked') for c in AGE_SEX_CATEGORIES]
+    columns += list(product(['Tested (%)', 'HIV+ (%)', 'Linked (%)'], AGE_SEX_CATEGORIES))
+
+    return Dashboard(
+        level,
+        series=[
+            Series(HTS_DE_NAMES, buckets=AGE_SEX_BUCKETS),
+            Series(PMTCT_MOTHER_DE_NAMES, alias='Pregnant Women tested for HIV'),
+            Series(PMTCT_MOTHER_POS_DE_NAMES, alias='Pregnant Women testing HIV+'),
+            Series(PMTCT_CHILD_DE_NAMES),
+            # targets are annual
+            Series(HTS_TARGET_DE_NAMES, category_combos=AGE_SEX_CATEGORIES, period='year', divisor=target_divisor),
+        ],
+        derived=derived,
+        columns=columns,
+    )
+
+# by quarter, so a quarter of the annual target
+HTS_BY_SITE = hts_dashboard('facility', target_divisor=4)
+# by year
+HTS_BY_DISTRICT = hts_dashboard('district')
+
+VMMC_TARGET_DE_NAMES = (
+    'VMMC_CIRC_TARGET',
+    'VMMC_DEVICE_TARGET',
+    'VMMC_SURGICAL_TARGET',
+)
+VMMC_CIRC_TARGET, VMMC_DEVICE_TARGET, VMMC_SURGICAL_TARGET = VMMC_TARGET_DE_NAMES
+VMMC_HIV_DE_NAMES = (
+    '105-5 SMC Clients Counseled, Tested and Circumcised for HIV at SMC site HIV Negative',
+    '105-5 SMC Clients Counseled, Tested and Circumcised for HIV at SMC site HIV Positive',
+)
+VMMC_LOCATION_DE_NAMES = (
+    '105-5 Number of Males Circumcised by Age group and Technique Facility, Device Based (DC)',
+    '105-5 Number of Males Circumcised by Age group and Technique Facility, Surgical(SC)',
+    '105-5 Number of Males Circumcised by Age group and Technique Outreach, Device Based (DC)',
+    '105-5 Number of Males Circumcised by Age group and Technique Outreach, Surgical(SC)',
+)
+VMMC_METHOD_DE_NAMES = (
+    '105-5 Clients circumcised by circumcision Technique Device Based (DC)',
+    '105-5 Clients circumcised by circumcision Technique Other VMMC techniques',
+    '105-5 Clients circumcised by circumcision Technique Surgical(SC)',
+)
+VMMC_METHOD_DEVICE, VMMC_METHOD_OTHER, VMMC_METHOD_SURGICAL = VMMC_METHOD_DE_NAMES
+VMMC_FOLLOWUP_DE_NAMES = (
+    '105-5a Number of Clients Circumcised who Returned for Follow Up Visit within 6 weeks of SMC Procedure(Within 48 Hours)',
+    '105-5b Number of Clients Circumcised who Returned for Follow Up Visit within 6 weeks of SMC Procedure(Within 7 Days)',
+    '105-5c Number of Clients Circumcised who Returned for Follow Up Visit within 6 weeks of SMC Procedure(Beyond 7 Days)',
+)
+VMMC_ADVERSE_DE_NAMES = (
+    '105-5 Clients Circumcised who Experienced one or more Adverse Events Moderate',
+    '105-5 Clients Circumcised who Experienced one or more Adverse Events Severe',
+)
+
+def location_alias(de_name):
+    # drop the technique section from the data element name
+    return de_name[:len('105-5 Number of Males Circumcised by Age group and Technique Facility')]
+
+VMMC_CIRCUMCISED = Total(Col(VMMC_METHOD_DEVICE), Col(VMMC_METHOD_SURGICAL), Col(VMMC_METHOD_OTHER))
+
+VMMC_BY_SITE = Dashboard(
+    'facility',
+    series=[
+        Series(VMMC_TARGET_DE_NAMES),
+        Series(VMMC_HIV_DE_NAMES),
+        Series(VMMC_LOCATION_DE_NAMES, aliases=dict((de_name, location_alias(de_name)) for de_name in VMMC_LOCATION_DE_NAMES)),
+        Series(VMMC_METHOD_DE_NAMES),
+        Series(VMMC_FOLLOWUP_DE_NAMES),
+        Series(VMMC_ADVERSE_DE_NAMES),
+    ],
+    derived=[
+        ('Perf% Circumcised', Percent(VMMC_CIRCUMCISED, Col(VMMC_CIRC_TARGET))),
+        ('Perf% Circumcised DC', Percent(Col(VMMC_METHOD_DEVICE), Col(VMMC_DEVICE_TARGET))),
+        ('Perf% Circumcised Surgical', Percent(Col(VMMC_METHOD_SURGICAL), Col(VMMC_SURGICAL_TARGET))),
+        ('% who returned within 48 hours', Percent(Col(VMMC_FOLLOWUP_DE_NAMES[0]), VMMC_CIRCUMCISED)),
+        ('% with at least one adverse event', Percent(Total(*[Col(de_name) for de_name in VMMC_ADVERSE_DE_NAMES]), VMMC_CIRCUMCISED)),
+    ],
+    columns=[
+        (VMMC_CIRC_TARGET, None, 'TARGET: VMMC_CIRC'),
+        (VMMC_DEVICE_TARGET, None, 'TARGET: Device-based'),
+        (VMMC_SURGICAL_TARGET, None, 'TARGET: Surgical'),
+        (VMMC_HIV_DE_NAMES[0], None, 'Circumcised by HIV status - Negative'),
+        (VMMC_HIV_DE_NAMES[1], None, 'Circumcised by HIV status - Positive'),
+        (location_alias(VMMC_LOCATION_DE_NAMES[0]), None, 'Circumcised by site type - Static'),
+        (location_alias(VMMC_LOCATION_DE_NAMES[2]), None, 'Circumcised by site type - Mobile'),
+        (VMMC_METHOD_DEVICE, None, 'Circumcised by technique - Device Based'),
+        (VMMC_METHOD_OTHER, None, 'Circumcised by technique - Other'),
+        (VMMC_METHOD_SURGICAL, None, 'Circumcised by technique - Surgical'),
+        (VMMC_FOLLOWUP_DE_NAMES[0], None, 'Follow up - Within 48 hours'),
+        (VMMC_FOLLOWUP_DE_NAMES[1], None, 'Follow up - Within 7 days'),
+        (VMMC_FOLLOWUP_DE_NAMES[2], None, 'Follow up - Beyond 7 days'),
+        (VMMC_ADVERSE_DE_NAMES[0], None, 'Adverse Events - Moderate'),
+        (VMMC_ADVERSE_DE_NAMES[1], None, 'Adverse Events - Severe'),
+        ('Perf% Circumcised', None),
+        ('Perf% Circumcised DC', None),
+        ('Perf% Circumcised Surgical', None),
+        ('% who returned within 48 hours', None),
+        ('% with at least one adverse event', None),
+    ],
+)
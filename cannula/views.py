@@ -1,7 +1,5 @@
 from django.shortcuts import render, get_object_or_404, render_to_response, redirect
 from django.db.models import Avg, Case, Count, F, Max, Min, Prefetch, Q, Sum, When
-from django.db.models import Value, CharField
-from django.db.models.functions import Substr
 from django.contrib.auth.decorators import login_required
 from django.http import Http404
 from django.template import RequestContext
@@ -12,9 +10,9 @@ from decimal import Decimal
 from itertools import groupby, tee, chain, product
 
 from . import dateutil, grabbag
-from .grabbag import default_zero, all_not_none
+from .cache import cache_dashboard, cached_values, conditional_dashboard
 
-from .models import DataElement, OrgUnit, DataValue, ValidationRule, SourceDocument
+from .models import DataElement, OrgUnit, DataValue, AggregateValue, ValidationRule, SourceDocument, file_content_hash
 from .forms import SourceDocumentForm, DataElementAliasForm
 
 @login_required
@@ -36,86 +34,60 @@ def groupbylist(*args, **kwargs):
 def month2quarter(month_num):
     return ((month_num-1)//3+1)
 
-@login_required
-def ipt_quarterly(request, output_format='HTML'):
+def ipt_quarterly_values(filter_period):
+    """The rows and columns of the IPT scorecard, for a quarter"""
     ipt_de_names = (
         '105-2.1 A6:First dose IPT (IPT1)',
         '105-2.1 A7:Second dose IPT (IPT2)',
     )
 
-    this_day = date.today()
-    this_year = this_day.year
-    PREV_5YR_QTRS = ['%d-Q%d' % (y, q) for y in range(this_year, this_year-6, -1) for q in range(4, 0, -1)]
+    # all subcounties (or equivalent), as grid rows
+    from .dashboards import Col, Percent, level_org_units
+    from .grid import Grid
+    org_units = level_org_units('subcounty')
 
-    if 'period' in request.GET and request.GET['period'] in PREV_5YR_QTRS:
-        filter_period=request.GET['period']
-    else:
-        filter_period = '%d-Q%d' % (this_year, month2quarter(this_day.month))
+    # get list of subcategories for IPT2
+    qs_ipt_subcat = AggregateValue.objects.facility_quarters().what('105-2.1 A7:Second dose IPT (IPT2)').order_by('category_combo__name').values_list('de_name', 'category_combo__name').distinct()
+    subcategory_names = tuple(qs_ipt_subcat)
 
-    period_desc = dateutil.DateSpan.fromquarter(filter_period).format()
+    columns = [('Expected Pregnancies', None)] + [(de_name, None) for de_name in ipt_de_names] + list(subcategory_names)
+    rate_columns = [('IPT rate', de_name) for de_name in ipt_de_names]
+    grid = Grid([ou_id for ou_id, _ in org_units], columns + rate_columns)
 
     # get IPT1 and IPT2 without subcategory disaggregation
-    qs = DataValue.objects.what(*ipt_de_names).filter(quarter=filter_period)
-    # use clearer aliases for the unwieldy names
-    qs = qs.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'))
-    qs = qs.annotate(period=F('quarter')) # TODO: review if this can still work with different periods
-    qs = qs.order_by('district', 'subcounty', 'de_name', 'period')
-    val_dicts = qs.values('district', 'subcounty', 'de_name', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-    
-    # all subcounties (or equivalent)
-    qs_ou = OrgUnit.objects.filter(level=2).annotate(district=F('parent__name'), subcounty=F('name'))
-    ou_list = qs_ou.values_list('district', 'subcounty')
-
-    def val_fun(row, col):
-        return { 'district': row[0], 'subcounty': row[1], 'de_name': col, 'numeric_sum': None }
-    gen_raster = grabbag.rasterize(ou_list, ipt_de_names, val_dicts, lambda x: (x['district'], x['subcounty']), lambda x: x['de_name'], val_fun)
-    val_dicts = list(gen_raster)
-
-    # get list of subcategories for IPT2
-    qs_ipt_subcat = DataValue.objects.what('105-2.1 A7:Second dose IPT (IPT2)').order_by('category_combo__name').values_list('de_name', 'category_combo__name').distinct()
-    subcategory_names = tuple(qs_ipt_subcat)
+    qs = AggregateValue.objects.facility_quarters().what(*ipt_de_names).when(filter_period)
+    val_dicts = qs.order_by().values('subcounty_ou', 'de_name').annotate(numeric_sum=Sum('numeric_sum'))
+    grid.fill(val_dicts, lambda x: x['subcounty_ou'], lambda x: (x['de_name'], None))
 
     # get IPT2 with subcategory disaggregation
-    qs2 = DataValue.objects.what('105-2.1 A7:Second dose IPT (IPT2)').filter(quarter=filter_period)
-    # use clearer aliases for the unwieldy names
-    qs2 = qs2.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'))
-    qs2 = qs2.annotate(period=F('quarter')) # TODO: review if this can still work with different periods
-    qs2 = qs2.annotate(cat_combo=F('category_combo__name'))
-    qs2 = qs2.order_by('district', 'subcounty', 'de_name', 'period', 'cat_combo')
-    val_dicts2 = qs2.values('district', 'subcounty', 'de_name', 'period', 'cat_combo').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    def val_with_subcat_fun(row, col):
-        district, subcounty = row
-        de_name, subcategory = col
-        return { 'district': district, 'subcounty': subcounty, 'cat_combo': subcategory, 'de_name': de_name, 'numeric_sum': None }
-    gen_raster = grabbag.rasterize(ou_list, subcategory_names, val_dicts2, lambda x: (x['district'], x['subcounty']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_dicts2 = list(gen_raster)
-
-    # get expected pregnancies
-    qs3 = DataValue.objects.what('Expected Pregnancies')
-    # use clearer aliases for the unwieldy names
-    qs3 = qs3.annotate(district=F('org_unit__parent__name'), subcounty=F('org_unit__name'))
-    qs3 = qs3.annotate(period=F('year')) # TODO: review if this can still work with different periods
-    qs3 = qs3.order_by('district', 'subcounty', 'de_name', 'period')
-    val_dicts3 = qs3.values('district', 'subcounty', 'de_name', 'period').annotate(numeric_sum=(Sum('numeric_value')/4))
-
-    gen_raster = grabbag.rasterize(ou_list, ('Expected Pregnancies',), val_dicts3, lambda x: (x['district'], x['subcounty']), lambda x: x['de_name'], val_fun)
-    val_dicts3 = list(gen_raster)
-
-    # combine the data and group by district and subcounty
-    grouped_vals = groupbylist(sorted(chain(val_dicts3, val_dicts, val_dicts2), key=lambda x: (x['district'], x['subcounty'])), key=lambda x: (x['district'], x['subcounty']))
-    
-    # calculate the IPT rate for the IPT1/IPT2 values (without subcategories)
-    for _group in grouped_vals:
-        (district_subcounty, (preg_val, *other_vals)) = _group
-        if preg_val['de_name'] == 'Expected Pregnancies':
-            for val in other_vals:
-                if val['de_name'] in ipt_de_names and 'cat_combo' not in val:
-                    pregnancies_per_annum = preg_val['numeric_sum']
-                    if pregnancies_per_annum and pregnancies_per_annum != 0 and val['numeric_sum']:
-                        val['ipt_rate'] = val['numeric_sum']*100/pregnancies_per_annum
-                    else:
-                        val['ipt_rate'] = None
+    qs2 = AggregateValue.objects.facility_quarters().what('105-2.1 A7:Second dose IPT (IPT2)').when(filter_period)
+    val_dicts2 = qs2.order_by().values('subcounty_ou', 'de_name', 'category_combo__name').annotate(numeric_sum=Sum('numeric_sum'))
+    grid.fill(val_dicts2, lambda x: x['subcounty_ou'], lambda x: (x['de_name'], x['category_combo__name']))
+
+    # get expected pregnancies (annual, so a quarter of the year's). NB. only those of the quarter's year, the
+    # hand-coded scorecard this replaces added up the expected pregnancies of every year on record
+    qs3 = AggregateValue.objects.facility_quarters().what('Expected Pregnancies').when(filter_period[:4])
+    val_dicts3 = qs3.order_by().values('subcounty_ou', 'de_name').annotate(numeric_sum=(Sum('numeric_sum')/4))
+    grid.fill(val_dicts3, lambda x: x['subcounty_ou'], lambda x: (x['de_name'], None))
+
+    # calculate the IPT rate for the IPT1/IPT2 values (without subcategories) for all subcounties at once. NB. IPT
+    # reported as 0 makes a rate of 0, the hand-coded scorecard showed none (as it still does when either is missing)
+    for rate_column, de_name in zip(rate_columns, ipt_de_names):
+        grid.set_column(rate_column, Percent(Col(de_name), Col('Expected Pregnancies')).evaluate(grid))
+
+    # one row per district and subcounty, expected pregnancies first
+    grouped_vals = list()
+    for ou_id, (district, subcounty) in org_units:
+        ipt_rates = dict(zip(ipt_de_names, grid.row_values(ou_id, rate_columns)))
+        vals = list()
+        for (de_name, cat_combo), numeric_sum in zip(columns, grid.row_values(ou_id, columns)):
+            val = { 'district': district, 'subcounty': subcounty, 'de_name': de_name, 'numeric_sum': numeric_sum }
+            if cat_combo is not None:
+                val['cat_combo'] = cat_combo
+            elif de_name in ipt_rates:
+                val['ipt_rate'] = ipt_rates[de_name]
+            vals.append(val)
+        grouped_vals.append([(district, subcounty), vals])
 
     data_element_names = list()
     data_element_names.insert(0, ('Expected Pregnancies', None))
@@ -124,6 +96,25 @@ def ipt_quarterly(request, output_format='HTML'):
         data_element_names.append(('%', None))
     data_element_names.extend(subcategory_names)
 
+    return grouped_vals, data_element_names
+
+@login_required
+@conditional_dashboard
+@cache_dashboard
+def ipt_quarterly(request, output_format='HTML'):
+    this_day = date.today()
+    this_year = this_day.year
+    PREV_5YR_QTRS = ['%d-Q%d' % (y, q) for y in range(this_year, this_year-6, -1) for q in range(4, 0, -1)]
+
+    if 'period' in request.GET and request.GET['period'] in PREV_5YR_QTRS:
+        filter_period=request.GET['period']
+    else:
+        filter_period = '%d-Q%d' % (this_year, month2quarter(this_day.month))
+
+    period_desc = dateutil.DateSpan.fromquarter(filter_period).format()
+
+    grouped_vals, data_element_names = cached_values(request, 'ipt_quarterly', ipt_quarterly_values, filter_period)
+
     if output_format == 'EXCEL':
         from django.http import HttpResponse
         import openpyxl
@@ -187,7 +178,6 @@ def ipt_quarterly(request, output_format='HTML'):
         'data_element_names': data_element_names,
         'period_desc': period_desc,
         'period_list': PREV_5YR_QTRS,
-        'level_list': level_list,
     }
 
     if output_format == 'JSON':
@@ -197,13 +187,54 @@ def ipt_quarterly(request, output_format='HTML'):
 
     return render(request, 'cannula/ipt_quarterly.html', context)
 
-@login_required
-def malaria_compliance(request):
+def malaria_compliance_values(start_quarter, end_quarter, periods):
+    """The rows and columns of the malaria compliance scorecard, for the periods (quarters) from start to end"""
     cases_de_names = (
         '105-1.3 OPD Malaria (Total)',
         '105-1.3 OPD Malaria Confirmed (Microscopic & RDT)',
     )
 
+    # all facilities (or equivalent), as grid rows
+    from .dashboards import Col, Percent, level_org_units
+    from .grid import Grid
+    org_units = level_org_units('facility')
+    columns = list(product(cases_de_names, periods))
+    rate_columns = [('rdt_rate', period) for period in periods]
+    grid = Grid([ou_id for ou_id, _ in org_units], columns + rate_columns)
+
+    # get data values without subcategory disaggregation
+    qs = AggregateValue.objects.facility_quarters().what(*cases_de_names)
+    qs = qs.when((start_quarter, end_quarter))
+    val_dicts = qs.order_by().values('org_unit', 'de_name', 'quarter').annotate(numeric_sum=Sum('numeric_sum'))
+    grid.fill(val_dicts, lambda x: x['org_unit'], lambda x: (x['de_name'], x['quarter']))
+
+    # confirmed cases as a percentage of all cases, for each period and all facilities at once. NB. confirmed
+    # cases reported as 0 make a rate of 0, the hand-coded scorecard showed none (as it still does when either is missing)
+    for rate_column, period in zip(rate_columns, periods):
+        grid.set_column(rate_column, Percent(Col(cases_de_names[1], period), Col(cases_de_names[0], period)).evaluate(grid))
+
+    # one row per district, subcounty and facility
+    grouped_vals = list()
+    for ou_id, (district, subcounty, facility) in org_units:
+        rdt_rates = dict(zip(periods, grid.row_values(ou_id, rate_columns)))
+        vals = list()
+        for (de_name, period), numeric_sum in zip(columns, grid.row_values(ou_id, columns)):
+            val = { 'district': district, 'subcounty': subcounty, 'facility': facility, 'period': period, 'de_name': de_name, 'numeric_sum': numeric_sum }
+            if de_name == cases_de_names[1]:
+                val['rdt_rate'] = rdt_rates[period]
+            vals.append(val)
+        grouped_vals.append([(district, subcounty, facility), vals])
+
+    data_element_names = list()
+    for de_n in cases_de_names:
+        data_element_names.append((de_n, None))
+
+    return grouped_vals, data_element_names
+
+@login_required
+@conditional_dashboard
+@cache_dashboard
+def malaria_compliance(request):
     this_day = date.today()
     this_year = this_day.year
     PREV_5YR_QTRS = ['%d-Q%d' % (y, q) for y in range(this_year, this_year-6, -1) for q in range(4, 0, -1)]
@@ -226,48 +257,8 @@ def malaria_compliance(request):
     periods = dateutil.get_quarters(start_quarter, end_quarter)
     if start_quarter == end_quarter:
         periods = periods[:1]
-    
-    # all facilities (or equivalent)
-    qs_ou = OrgUnit.objects.filter(level=3).annotate(district=F('parent__parent__name'), subcounty=F('parent__name'), facility=F('name'))
-    ou_list = qs_ou.values_list('district', 'subcounty', 'facility')
 
-    # get data values without subcategory disaggregation
-    qs = DataValue.objects.what(*cases_de_names)
-    qs = qs.filter(quarter__gte=start_quarter).filter(quarter__lte=end_quarter)
-    # use clearer aliases for the unwieldy names
-    qs = qs.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs = qs.annotate(period=F('quarter')) # TODO: review if this can still work with different periods
-    qs = qs.order_by('district', 'subcounty', 'facility', 'de_name', 'period')
-    val_dicts = qs.values('district', 'subcounty', 'facility', 'de_name', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    def val_with_period_fun(row, col):
-        district, subcounty, facility = row
-        de_name, period = col
-        return { 'district': district, 'subcounty': subcounty, 'facility': facility, 'period': period, 'de_name': de_name, 'numeric_sum': None }
-    gen_raster = grabbag.rasterize(ou_list, tuple(product(cases_de_names, periods)), val_dicts, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['period']), val_with_period_fun)
-    val_dicts = gen_raster
-
-    # combine the data and group by district and subcounty
-    grouped_vals = groupbylist(sorted(val_dicts, key=lambda x: (x['district'], x['subcounty'], x['facility'])), key=lambda x: (x['district'], x['subcounty'], x['facility']))
-
-    for _group in grouped_vals:
-        (district_subcounty_facility, other_vals) = _group
-        malaria_totals = dict()
-        for val in other_vals:
-            if val['de_name'] == cases_de_names[0]:
-                malaria_totals[val['period']] = val['numeric_sum']
-            elif val['de_name'] == cases_de_names[1]:
-                total_cases = malaria_totals.get(val['period'], 0)
-                confirmed_cases = val['numeric_sum']
-                if confirmed_cases and total_cases and total_cases != 0:
-                    confirmed_rate = confirmed_cases * 100 / total_cases
-                    val['rdt_rate'] = confirmed_rate
-                else:
-                    val['rdt_rate'] = None
-
-    data_element_names = list()
-    for de_n in cases_de_names:
-        data_element_names.append((de_n, None))
+    grouped_vals, data_element_names = cached_values(request, 'malaria_compliance', malaria_compliance_values, start_quarter, end_quarter, periods)
 
     context = {
         'grouped_data': grouped_vals,
@@ -286,7 +277,14 @@ def data_workflow_new(request):
     if request.method == 'POST':
         form = SourceDocumentForm(request.POST, request.FILES)
         if form.is_valid():
-            form.save()
+            content_hash = file_content_hash(request.FILES['file'])
+            existing = SourceDocument.objects.filter(content_hash=content_hash).order_by('uploaded_at').first()
+            if existing:
+                # the very same file was uploaded before, send them to its workflow instead of storing a copy
+                return redirect('%s?wf_id=%d' % (reverse('data_workflow_detail'), existing.id))
+            src_doc = form.save(commit=False)
+            src_doc.content_hash = content_hash
+            src_doc.save()
             return redirect('data_workflow_listing')
     else:
         form = SourceDocumentForm()
@@ -299,26 +297,39 @@ def data_workflow_new(request):
 
 @login_required
 def data_workflow_detail(request):
-    from .models import load_excel_to_datavalues, load_excel_to_validations
+    from .jobs import queue_job
 
     if 'wf_id' in request.GET:
         src_doc_id = int(request.GET['wf_id'])
         src_doc = get_object_or_404(SourceDocument, id=src_doc_id)
 
         if request.method == 'POST':
+            # loading runs in the background (manage.py ingest_worker), we only queue it here
             if 'load_values' in request.POST:
-                all_values = load_excel_to_datavalues(src_doc)
-                for site_name, site_vals in all_values.items():
-                    DataValue.objects.bulk_create(site_vals)
+                queue_job(src_doc, 'VALUES')
+            elif 'upsert_values' in request.POST:
+                queue_job(src_doc, 'UPSERT')
             elif 'load_validations' in request.POST:
-                load_excel_to_validations(src_doc)
+                queue_job(src_doc, 'VALIDATIONS')
+            elif 'dry_run' in request.POST:
+                queue_job(src_doc, 'DRY_RUN')
 
-            #TODO: redirect with to detail page?
+            return redirect('%s?wf_id=%d' % (reverse('data_workflow_detail'), src_doc_id))
 
         qs_vals = DataValue.objects.filter(source_doc__id=src_doc_id).values('id')
         doc_elements = DataElement.objects.filter(data_values__id__in=qs_vals).distinct('id')
         doc_rules = ValidationRule.objects.filter(data_elements__data_values__id__in=qs_vals).distinct('id')
         num_values = qs_vals.count()
+        jobs = list(src_doc.ingestion_jobs.order_by('-created_at', '-id'))
+        dry_run = next((j for j in jobs if j.kind == 'DRY_RUN' and j.status == 'DONE'), None) # the latest one
+        profile = dry_run.report_data() if dry_run else None
+        profile_samples = list()
+        if profile:
+            profile_samples = [
+                ('Values repeated in this document', profile['duplicate_samples']),
+                ('Values already stored with a different number', profile['existing_samples']),
+                ('Values outside the data element range', profile['out_of_range_samples']),
+            ]
     else:
         raise Http404("Workflow does not exist or workflow id is missing/invalid")
 
@@ -327,6 +338,11 @@ def data_workflow_detail(request):
         'num_values': num_values,
         'data_elements': doc_elements,
         'validation_rules': doc_rules,
+        'jobs': jobs,
+        'jobs_active': any(j.is_active() for j in jobs),
+        'dry_run': dry_run,
+        'profile': profile,
+        'profile_samples': profile_samples,
     }
 
     return render(request, 'cannula/data_workflow_detail.html', context)
@@ -335,7 +351,7 @@ def data_workflow_detail(request):
 def data_workflow_listing(request):
     # TODO: filter based on user who uploaded file?
     docs = SourceDocument.objects.all().annotate(num_values=Count('data_values'))
-    docs = docs.order_by('uploaded_at')
+    docs = docs.order_by('uploaded_at').prefetch_related('ingestion_stats')
 
     context = {
         'workflows': docs,
@@ -403,7 +419,11 @@ def data_element_alias(request):
     return render_to_response('cannula/data_element_edit_alias.html', context, context_instance=RequestContext(request))
 
 @login_required
+@conditional_dashboard
+@cache_dashboard
 def hts_by_site(request):
+    from .scorecards import HTS_BY_SITE
+
     this_day = date.today()
     this_year = this_day.year
     PREV_5YR_QTRS = ['%d-Q%d' % (y, q) for y in range(this_year, this_year-6, -1) for q in range(4, 0, -1)]
@@ -415,456 +435,10 @@ def hts_by_site(request):
 
     period_desc = dateutil.DateSpan.fromquarter(filter_period).format()
 
-    hts_de_names = (
-        '105-4 Number of clients who have been linked to care',
-        '105-4 Number of Individuals who received HIV test results',
-        '105-4 Number of Individuals who tested HIV positive',
-    )
-    hts_short_names = (
-        'Linked',
-        'Tested',
-        'HIV+',
-    )
-    subcategory_names = ['(<15, Female)', '(<15, Male)', '(15+, Female)', '(15+, Male)']
-    de_positivity_meta = list(product(hts_de_names, subcategory_names))
-
-    qs_positivity = DataValue.objects.what(*hts_de_names).filter(quarter=filter_period)
-
-    cc_lt_15 = ['18 Mths-<5 Years', '5-<10 Years', '10-<15 Years']
-    cc_ge_15 = ['15-<19 Years', '19-<49 Years', '>49 Years']
-    #TODO: cc_lt_15_f = CategoryCombo.from_cat_names(['Female', '<15']) gives a CategoryCombo instance that makes the Case statement clearer/safer
-    qs_positivity = qs_positivity.annotate(
-        cat_combo=Case(
-            When(Q(category_combo__categories__name__in=cc_lt_15) & Q(category_combo__name__contains='Female'), then=Value(subcategory_names[0])),
-            When(Q(category_combo__categories__name__in=cc_lt_15) & ~Q(category_combo__name__contains='Female'), then=Value(subcategory_names[1])),
-            When(Q(category_combo__categories__name__in=cc_ge_15) & Q(category_combo__name__contains='Female'), then=Value(subcategory_names[2])),
-            When(Q(category_combo__categories__name__in=cc_ge_15) & ~Q(category_combo__name__contains='Female'), then=Value(subcategory_names[3])),
-            default=None, output_field=CharField()
-        )
-    )
-    qs_positivity = qs_positivity.exclude(cat_combo__iexact=None)
-
-    qs_positivity = qs_positivity.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_positivity = qs_positivity.annotate(period=F('quarter'))
-    qs_positivity = qs_positivity.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_positivity = qs_positivity.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-    
-    # # all facilities (or equivalent)
-    qs_ou = OrgUnit.objects.filter(level=3).annotate(district=F('parent__parent__name'), subcounty=F('parent__name'), facility=F('name'))
-    ou_list = list(qs_ou.values_list('district', 'subcounty', 'facility'))
-
-    def val_with_subcat_fun(row, col):
-        district, subcounty, facility = row
-        de_name, subcategory = col
-        return { 'district': district, 'subcounty': subcounty, 'facility': facility, 'cat_combo': subcategory, 'de_name': de_name, 'numeric_sum': None }
-    gen_raster = grabbag.rasterize(ou_list, de_positivity_meta, val_positivity, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_positivity2 = list(gen_raster)
-
-    pmtct_mother_de_names = (
-        '105-2.1 Pregnant Women newly tested for HIV this pregnancy(TR & TRR)',
-        '105-2.2a Women tested for HIV in labour (1st time this Pregnancy)',
-        '105-2.3a Breastfeeding mothers tested for HIV(1st test)',
-    )
-    de_pmtct_mother_meta = list(product(('Pregnant Women tested for HIV',), (None,)))
-
-    qs_pmtct_mother = DataValue.objects.what(*pmtct_mother_de_names).filter(quarter=filter_period)
-    qs_pmtct_mother = qs_pmtct_mother.annotate(de_name=Value('Pregnant Women tested for HIV', output_field=CharField()))
-    qs_pmtct_mother = qs_pmtct_mother.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_pmtct_mother = qs_pmtct_mother.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_pmtct_mother = qs_pmtct_mother.annotate(period=F('quarter'))
-    qs_pmtct_mother = qs_pmtct_mother.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_pmtct_mother = qs_pmtct_mother.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_pmtct_mother_meta, val_pmtct_mother, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_pmtct_mother2 = list(gen_raster)
-
-    pmtct_mother_pos_de_names = (
-        '105-2.1 A19:Pregnant Women testing HIV+ on a retest (TRR+)',
-        '105-2.2a Women testing HIV+ in labour (1st time this Pregnancy)',
-        '105-2.2b Women testing HIV+ in labour (Retest this Pregnancy)',
-        '105-2.3a Breastfeeding mothers newly testing HIV+(1st test)',
-        '105-2.3b Breastfeeding mothers newly testing HIV+(retest)',
-    )
-    de_pmtct_mother_pos_meta = list(product(('Pregnant Women testing HIV+',), (None,)))
-
-    qs_pmtct_mother_pos = DataValue.objects.what(*pmtct_mother_pos_de_names).filter(quarter=filter_period)
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.annotate(de_name=Value('Pregnant Women testing HIV+', output_field=CharField()))
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.annotate(period=F('quarter'))
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_pmtct_mother_pos = qs_pmtct_mother_pos.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_pmtct_mother_pos_meta, val_pmtct_mother_pos, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_pmtct_mother_pos2 = list(gen_raster)
-
-    pmtct_child_de_names = (
-        '105-2.4a Exposed Infants Tested for HIV Below 18 Months(by 1st PCR) ',
-        '105-2.4b 1st DNA PCR result returned(HIV+)',
-        '105-2.4b 2nd DNA PCR result returned(HIV+)',
-        '105-2.1a Male partners received HIV test results in eMTCT(Total)',
-        '105-2.1b Male partners received HIV test results in eMTCT(HIV+)',
-    )
-    pmtct_child_short_names = (
-        'PMTCT INFANT HIV+',
-        'PMTCT CHILD PCR1 HIV+',
-        'PMTCT CHILD PCR2 HIV+',
-        'PMTCT MALE PARTNERS TESTED',
-        'PMTCT MALE PARTNERS HIV+',
-    )
-    de_pmtct_child_meta = list(product(pmtct_child_de_names, (None,)))
-
-    qs_pmtct_child = DataValue.objects.what(*pmtct_child_de_names).filter(quarter=filter_period)
-    qs_pmtct_child = qs_pmtct_child.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_pmtct_child = qs_pmtct_child.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_pmtct_child = qs_pmtct_child.annotate(period=F('quarter'))
-    qs_pmtct_child = qs_pmtct_child.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_pmtct_child = qs_pmtct_child.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-    val_pmtct_child = list(val_pmtct_child)
-
-    gen_raster = grabbag.rasterize(ou_list, de_pmtct_child_meta, val_pmtct_child, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_pmtct_child2 = list(gen_raster)
-
-    target_de_names = (
-        'HTC_TST_TARGET',
-        'HTC_TST_POS_TARGET',
-    )
-    de_target_meta = list(product(target_de_names, subcategory_names))
-
-    # targets are annual, so filter by year component of period and divide result by 4 to get quarter
-    qs_target = DataValue.objects.what(*target_de_names).filter(year=filter_period[:4])
-
-    qs_target = qs_target.annotate(cat_combo=F('category_combo__name'))
-    qs_target = qs_target.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_target = qs_target.annotate(period=F('quarter'))
-    qs_target = qs_target.order_by('district', 'subcounty', 'facility', '-de_name', 'cat_combo', 'period') # note reversed order of data element names
-    val_target = qs_target.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value')/4)
-
-    gen_raster = grabbag.rasterize(ou_list, de_target_meta, val_target, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_target2 = list(gen_raster)
-
-    # combine the data and group by district, subcounty and facility
-    grouped_vals = groupbylist(sorted(chain(val_positivity2, val_pmtct_mother2, val_pmtct_mother_pos2, val_pmtct_child2, val_target2), key=lambda x: (x['district'], x['subcounty'], x['facility'])), key=lambda x: (x['district'], x['subcounty'], x['facility']))
-
-    # perform calculations
-    for _group in grouped_vals:
-        (district_subcounty_facility, (linked_under15_f, linked_under15_m, linked_over15_f, linked_over15_m, tst_under15_f, tst_under15_m, tst_over15_f, tst_over15_m, pos_under15_f, pos_under15_m, pos_over15_f, pos_over15_m, tst_pregnant, pos_pregnant, pos_infant, pos_pcr1, pos_pcr2, tst_male_partner, pos_male_partner, *other_vals)) = _group
-        
-        calculated_vals = list()
-
-        under15_f_sum = default_zero(tst_under15_f['numeric_sum']) + Decimal(default_zero(pos_infant['numeric_sum'])/2)
-        under15_f_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': under15_f_sum,
-        }
-        calculated_vals.append(under15_f_val)
-        
-        under15_m_sum = default_zero(tst_under15_m['numeric_sum']) + Decimal(default_zero(pos_infant['numeric_sum'])/2)
-        under15_m_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': under15_m_sum,
-        }
-        calculated_vals.append(under15_m_val)
-        
-        over15_f_sum = default_zero(tst_over15_f['numeric_sum']) + default_zero(tst_pregnant['numeric_sum'])
-        over15_f_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': over15_f_sum,
-        }
-        calculated_vals.append(over15_f_val)
-        
-        over15_m_sum = default_zero(tst_over15_m['numeric_sum']) + default_zero(tst_male_partner['numeric_sum'])
-        over15_m_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': over15_m_sum,
-        }
-        calculated_vals.append(over15_m_val)
-        
-        half_pos_pcr = Decimal(default_zero(pos_pcr1['numeric_sum']) + default_zero(pos_pcr1['numeric_sum']))/2
-        pos_under15_f_sum = default_zero(pos_under15_f['numeric_sum']) + half_pos_pcr
-        pos_under15_f_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': pos_under15_f_sum,
-        }
-        calculated_vals.append(pos_under15_f_val)
-        
-        pos_under15_m_sum = default_zero(pos_under15_m['numeric_sum']) + half_pos_pcr
-        pos_under15_m_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': pos_under15_m_sum,
-        }
-        calculated_vals.append(pos_under15_m_val)
-        
-        pos_over15_f_sum = default_zero(pos_over15_f['numeric_sum']) + Decimal(default_zero(pos_pregnant['numeric_sum']))
-        pos_over15_f_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': pos_over15_f_sum,
-        }
-        calculated_vals.append(pos_over15_f_val)
-        
-        pos_over15_m_sum = default_zero(pos_over15_m['numeric_sum']) + Decimal(default_zero(pos_male_partner['numeric_sum']))
-        pos_over15_m_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': pos_over15_m_sum,
-        }
-        calculated_vals.append(pos_over15_m_val)
-
-        tested_total = sum([under15_f_sum, under15_m_sum, over15_f_sum, over15_m_sum])
-        pos_total = sum([pos_under15_f_sum, pos_under15_m_sum, pos_over15_f_sum, pos_over15_m_sum])
-        tested_total_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested',
-            'cat_combo': None,
-            'numeric_sum': tested_total,
-        }
-        pos_total_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+',
-            'cat_combo': None,
-            'numeric_sum': pos_total,
-        }
-        calculated_vals.append(tested_total_val)
-        calculated_vals.append(pos_total_val)
-
-        # copy linked to care totals over
-        calculated_vals.append(linked_under15_f)
-        calculated_vals.append(linked_under15_m)
-        calculated_vals.append(linked_over15_f)
-        calculated_vals.append(linked_over15_m)
-
-        # calculate the percentages
-        target_under15_f, target_under15_m, target_over15_f, target_over15_m, target_pos_under15_f, target_pos_under15_m, target_pos_over15_f, target_pos_over15_m, *further_vals = other_vals
-
-        if all_not_none(under15_f_sum, target_under15_f['numeric_sum']) and target_under15_f['numeric_sum']:
-            under15_f_percent = (under15_f_sum * 100) / target_under15_f['numeric_sum']
-        else:
-            under15_f_percent = None
-        under15_f_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested (%)',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': under15_f_percent,
-        }
-        calculated_vals.append(under15_f_percent_val)
-
-        if all_not_none(under15_m_sum, target_under15_m['numeric_sum']) and target_under15_m['numeric_sum']:
-            under15_m_percent = (under15_m_sum * 100) / target_under15_m['numeric_sum']
-        else:
-            under15_m_percent = None
-        under15_m_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested (%)',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': under15_m_percent,
-        }
-        calculated_vals.append(under15_m_percent_val)
-
-        if all_not_none(over15_f_sum, target_over15_f['numeric_sum']) and target_over15_f['numeric_sum']:
-            over15_f_percent = (over15_f_sum * 100) / target_over15_f['numeric_sum']
-        else:
-            over15_f_percent = None
-        over15_f_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested (%)',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': over15_f_percent,
-        }
-        calculated_vals.append(over15_f_percent_val)
-
-        if all_not_none(over15_m_sum, target_over15_m['numeric_sum']) and target_over15_m['numeric_sum']:
-            over15_m_percent = (over15_m_sum * 100) / target_over15_m['numeric_sum']
-        else:
-            over15_m_percent = None
-        over15_m_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Tested (%)',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': over15_m_percent,
-        }
-        calculated_vals.append(over15_m_percent_val)
-
-        if all_not_none(pos_under15_f_sum, target_pos_under15_f['numeric_sum']) and target_pos_under15_f['numeric_sum']:
-            pos_under15_f_percent = (pos_under15_f_sum * 100) / target_pos_under15_f['numeric_sum']
-        else:
-            pos_under15_f_percent = None
-        pos_under15_f_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+ (%)',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': pos_under15_f_percent,
-        }
-        calculated_vals.append(pos_under15_f_percent_val)
-
-        if all_not_none(pos_under15_m_sum, target_pos_under15_m['numeric_sum']) and target_pos_under15_m['numeric_sum']:
-            pos_under15_m_percent = (pos_under15_m_sum * 100) / target_pos_under15_m['numeric_sum']
-        else:
-            pos_under15_m_percent = None
-        pos_under15_m_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+ (%)',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': pos_under15_m_percent,
-        }
-        calculated_vals.append(pos_under15_m_percent_val)
-
-        if all_not_none(pos_over15_f_sum, target_pos_over15_f['numeric_sum']) and target_pos_over15_f['numeric_sum']:
-            pos_over15_f_percent = (pos_over15_f_sum * 100) / target_pos_over15_f['numeric_sum']
-        else:
-            pos_over15_f_percent = None
-        pos_over15_f_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+ (%)',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': pos_over15_f_percent,
-        }
-        calculated_vals.append(pos_over15_f_percent_val)
-
-        if all_not_none(pos_over15_m_sum, target_pos_over15_m['numeric_sum']) and target_pos_over15_m['numeric_sum']:
-            pos_over15_m_percent = (pos_over15_m_sum * 100) / target_pos_over15_m['numeric_sum']
-        else:
-            pos_over15_m_percent = None
-        pos_over15_m_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'HIV+ (%)',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': pos_over15_m_percent,
-        }
-        calculated_vals.append(pos_over15_m_percent_val)
-
-        if all_not_none(linked_under15_f['numeric_sum'], pos_under15_f['numeric_sum']) and pos_under15_f['numeric_sum']:
-            linked_under15_f_percent = (linked_under15_f['numeric_sum'] * 100) / pos_under15_f['numeric_sum']
-        else:
-            linked_under15_f_percent = None
-        linked_under15_f_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Linked (%)',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': linked_under15_f_percent,
-        }
-        calculated_vals.append(linked_under15_f_percent_val)
-
-        if all_not_none(linked_under15_m['numeric_sum'], pos_under15_m['numeric_sum']) and pos_under15_m['numeric_sum']:
-            linked_under15_m_percent = (linked_under15_m['numeric_sum'] * 100) / pos_under15_m['numeric_sum']
-        else:
-            linked_under15_m_percent = None
-        linked_under15_m_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Linked (%)',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': linked_under15_m_percent,
-        }
-        calculated_vals.append(linked_under15_m_percent_val)
-
-        if all_not_none(linked_over15_f['numeric_sum'], pos_over15_f['numeric_sum']) and pos_over15_f['numeric_sum']:
-            linked_over15_f_percent = (linked_over15_f['numeric_sum'] * 100) / pos_over15_f['numeric_sum']
-        else:
-            linked_over15_f_percent = None
-        linked_over15_f_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Linked (%)',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': linked_over15_f_percent,
-        }
-        calculated_vals.append(linked_over15_f_percent_val)
-
-        if all_not_none(linked_over15_m['numeric_sum'], pos_over15_m['numeric_sum']) and pos_over15_m['numeric_sum']:
-            linked_over15_m_percent = (linked_over15_m['numeric_sum'] * 100) / pos_over15_m['numeric_sum']
-        else:
-            linked_over15_m_percent = None
-        linked_over15_m_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Linked (%)',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': linked_over15_m_percent,
-        }
-        calculated_vals.append(linked_over15_m_percent_val)
-
-        # _group[1].extend(calculated_vals)
-        _group[1] = calculated_vals
-    
-    data_element_names = list()
-    # data_element_names += list(product(hts_short_names, subcategory_names))
-    # data_element_names += de_pmtct_mother_meta
-    # data_element_names += de_pmtct_mother_pos_meta
-    # data_element_names += list(product(pmtct_child_short_names, (None,)))
-    # data_element_names += de_target_meta
-    data_element_names += list(product(['Tested',], subcategory_names))
-    data_element_names += list(product(['HIV+',], subcategory_names))
-    data_element_names += list(product(['Tested',], [None,]))
-    data_element_names += list(product(['HIV+',], [None,]))
-    data_element_names += list(product(['Linked',], subcategory_names))
-    data_element_names += list(product(['Tested (%)',], subcategory_names))
-    data_element_names += list(product(['HIV+ (%)',], subcategory_names))
-    data_element_names += list(product(['Linked (%)',], subcategory_names))
+    grouped_vals, data_element_names = cached_values(request, 'hts_by_site', HTS_BY_SITE.evaluate, filter_period)
 
     context = {
         'grouped_data': grouped_vals,
-        'val_pmtct_child': list(val_pmtct_child),
-        'val_pmtct_child2': list(val_pmtct_child2),
-        # 'grouped_data_size': len(grouped_vals),
         'data_element_names': data_element_names,
         'period_desc': period_desc,
         'period_list': PREV_5YR_QTRS,
@@ -873,7 +447,11 @@ def hts_by_site(request):
     return render(request, 'cannula/hts_sites.html', context)
 
 @login_required
+@conditional_dashboard
+@cache_dashboard
 def hts_by_district(request):
+    from .scorecards import HTS_BY_DISTRICT
+
     this_day = date.today()
     this_year = this_day.year
     PREV_5YRS = ['%d' % (y,) for y in range(this_year, this_year-6, -1)]
@@ -885,416 +463,10 @@ def hts_by_district(request):
 
     period_desc = filter_period
 
-    hts_de_names = (
-        '105-4 Number of clients who have been linked to care',
-        '105-4 Number of Individuals who received HIV test results',
-        '105-4 Number of Individuals who tested HIV positive',
-    )
-    hts_short_names = (
-        'Linked',
-        'Tested',
-        'HIV+',
-    )
-    subcategory_names = ['(<15, Female)', '(<15, Male)', '(15+, Female)', '(15+, Male)']
-    de_positivity_meta = list(product(hts_de_names, subcategory_names))
-
-    qs_positivity = DataValue.objects.what(*hts_de_names).filter(year=filter_period)
-
-    cc_lt_15 = ['18 Mths-<5 Years', '5-<10 Years', '10-<15 Years']
-    cc_ge_15 = ['15-<19 Years', '19-<49 Years', '>49 Years']
-    #TODO: cc_lt_15_f = CategoryCombo.from_cat_names(['Female', '<15']) gives a CategoryCombo instance that makes the Case statement clearer/safer
-    qs_positivity = qs_positivity.annotate(
-        cat_combo=Case(
-            When(Q(category_combo__categories__name__in=cc_lt_15) & Q(category_combo__name__contains='Female'), then=Value(subcategory_names[0])),
-            When(Q(category_combo__categories__name__in=cc_lt_15) & ~Q(category_combo__name__contains='Female'), then=Value(subcategory_names[1])),
-            When(Q(category_combo__categories__name__in=cc_ge_15) & Q(category_combo__name__contains='Female'), then=Value(subcategory_names[2])),
-            When(Q(category_combo__categories__name__in=cc_ge_15) & ~Q(category_combo__name__contains='Female'), then=Value(subcategory_names[3])),
-            default=None, output_field=CharField()
-        )
-    )
-    qs_positivity = qs_positivity.exclude(cat_combo__iexact=None)
-
-    qs_positivity = qs_positivity.annotate(district=F('org_unit__parent__parent__name'))
-    qs_positivity = qs_positivity.annotate(period=F('year'))
-    qs_positivity = qs_positivity.order_by('district', 'de_name', 'cat_combo', 'period')
-    val_positivity = qs_positivity.values('district', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-    val_positivity = list(val_positivity)
-    
-    # all districts (or equivalent)
-    qs_ou = OrgUnit.objects.filter(level=1).annotate(district=F('name'))
-    ou_list = list(v for v in qs_ou.values_list('district'))
-
-    def val_with_subcat_fun(row, col):
-        district, = row
-        de_name, subcategory = col
-        return { 'district': district, 'cat_combo': subcategory, 'de_name': de_name, 'numeric_sum': None }
-    gen_raster = grabbag.rasterize(ou_list, de_positivity_meta, val_positivity, lambda x: (x['district'],), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_positivity2 = list(gen_raster)
-
-    pmtct_mother_de_names = (
-        '105-2.1 Pregnant Women newly tested for HIV this pregnancy(TR & TRR)',
-        '105-2.2a Women tested for HIV in labour (1st time this Pregnancy)',
-        '105-2.3a Breastfeeding mothers tested for HIV(1st test)',
-    )
-    de_pmtct_mother_meta = list(product(('Pregnant Women tested for HIV',), (None,)))
-
-    qs_pmtct_mother = DataValue.objects.what(*pmtct_mother_de_names).filter(year=filter_period)
-    qs_pmtct_mother = qs_pmtct_mother.annotate(de_name=Value('Pregnant Women tested for HIV', output_field=CharField()))
-    qs_pmtct_mother = qs_pmtct_mother.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_pmtct_mother = qs_pmtct_mother.annotate(district=F('org_unit__parent__parent__name'))
-    qs_pmtct_mother = qs_pmtct_mother.annotate(period=F('year'))
-    qs_pmtct_mother = qs_pmtct_mother.order_by('district', 'de_name', 'cat_combo', 'period')
-    val_pmtct_mother = qs_pmtct_mother.values('district', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_pmtct_mother_meta, val_pmtct_mother, lambda x: (x['district'],), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_pmtct_mother2 = list(gen_raster)
-
-    pmtct_mother_pos_de_names = (
-        '105-2.1 A19:Pregnant Women testing HIV+ on a retest (TRR+)',
-        '105-2.2a Women testing HIV+ in labour (1st time this Pregnancy)',
-        '105-2.2b Women testing HIV+ in labour (Retest this Pregnancy)',
-        '105-2.3a Breastfeeding mothers newly testing HIV+(1st test)',
-        '105-2.3b Breastfeeding mothers newly testing HIV+(retest)',
-    )
-    de_pmtct_mother_pos_meta = list(product(('Pregnant Women testing HIV+',), (None,)))
-
-    qs_pmtct_mother_pos = DataValue.objects.what(*pmtct_mother_pos_de_names).filter(year=filter_period)
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.annotate(de_name=Value('Pregnant Women testing HIV+', output_field=CharField()))
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.annotate(district=F('org_unit__parent__parent__name'))
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.annotate(period=F('year'))
-    qs_pmtct_mother_pos = qs_pmtct_mother_pos.order_by('district', 'de_name', 'cat_combo', 'period')
-    val_pmtct_mother_pos = qs_pmtct_mother_pos.values('district', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_pmtct_mother_pos_meta, val_pmtct_mother_pos, lambda x: (x['district'],), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_pmtct_mother_pos2 = list(gen_raster)
-
-    pmtct_child_de_names = (
-        '105-2.4a Exposed Infants Tested for HIV Below 18 Months(by 1st PCR) ',
-        '105-2.4b 1st DNA PCR result returned(HIV+)',
-        '105-2.4b 2nd DNA PCR result returned(HIV+)',
-        '105-2.1a Male partners received HIV test results in eMTCT(Total)',
-        '105-2.1b Male partners received HIV test results in eMTCT(HIV+)',
-    )
-    pmtct_child_short_names = (
-        'PMTCT INFANT HIV+',
-        'PMTCT CHILD PCR1 HIV+',
-        'PMTCT CHILD PCR2 HIV+',
-        'PMTCT MALE PARTNERS TESTED',
-        'PMTCT MALE PARTNERS HIV+',
-    )
-    de_pmtct_child_meta = list(product(pmtct_child_de_names, (None,)))
-
-    qs_pmtct_child = DataValue.objects.what(*pmtct_child_de_names).filter(year=filter_period)
-    qs_pmtct_child = qs_pmtct_child.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_pmtct_child = qs_pmtct_child.annotate(district=F('org_unit__parent__parent__name'))
-    qs_pmtct_child = qs_pmtct_child.annotate(period=F('year'))
-    qs_pmtct_child = qs_pmtct_child.order_by('district', 'de_name', 'cat_combo', 'period')
-    val_pmtct_child = qs_pmtct_child.values('district', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_pmtct_child_meta, val_pmtct_child, lambda x: (x['district'],), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_pmtct_child2 = list(gen_raster)
-
-    target_de_names = (
-        'HTC_TST_TARGET',
-        'HTC_TST_POS_TARGET',
-    )
-    de_target_meta = list(product(target_de_names, subcategory_names))
-
-    # targets are annual, so filter by year component of period
-    qs_target = DataValue.objects.what(*target_de_names).filter(year=filter_period[:4])
-
-    qs_target = qs_target.annotate(cat_combo=F('category_combo__name'))
-    qs_target = qs_target.annotate(district=F('org_unit__parent__parent__name'))
-    qs_target = qs_target.annotate(period=F('year'))
-    qs_target = qs_target.order_by('district', '-de_name', 'cat_combo', 'period') # note reversed order of data element names
-    val_target = qs_target.values('district', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-    val_target = list(val_target)
-
-    gen_raster = grabbag.rasterize(ou_list, de_target_meta, val_target, lambda x: (x['district'],), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_target2 = list(gen_raster)
-
-    # combine the data and group by district
-    grouped_vals = groupbylist(sorted(chain(val_positivity2, val_pmtct_mother2, val_pmtct_mother_pos2, val_pmtct_child2, val_target2), key=lambda x: (x['district'],)), key=lambda x: (x['district'],))
-
-    # perform calculations
-    for _group in grouped_vals:
-        (ou_path_list, (linked_under15_f, linked_under15_m, linked_over15_f, linked_over15_m, tst_under15_f, tst_under15_m, tst_over15_f, tst_over15_m, pos_under15_f, pos_under15_m, pos_over15_f, pos_over15_m, tst_pregnant, pos_pregnant, pos_infant, pos_pcr1, pos_pcr2, tst_male_partner, pos_male_partner, *other_vals)) = _group
-        
-        calculated_vals = list()
-
-        under15_f_sum = default_zero(tst_under15_f['numeric_sum']) + Decimal(default_zero(pos_infant['numeric_sum'])/2)
-        under15_f_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': under15_f_sum,
-        }
-        calculated_vals.append(under15_f_val)
-        
-        under15_m_sum = default_zero(tst_under15_m['numeric_sum']) + Decimal(default_zero(pos_infant['numeric_sum'])/2)
-        under15_m_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': under15_m_sum,
-        }
-        calculated_vals.append(under15_m_val)
-        
-        over15_f_sum = default_zero(tst_over15_f['numeric_sum']) + default_zero(tst_pregnant['numeric_sum'])
-        over15_f_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': over15_f_sum,
-        }
-        calculated_vals.append(over15_f_val)
-        
-        over15_m_sum = default_zero(tst_over15_m['numeric_sum']) + default_zero(tst_male_partner['numeric_sum'])
-        over15_m_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': over15_m_sum,
-        }
-        calculated_vals.append(over15_m_val)
-        
-        half_pos_pcr = Decimal(default_zero(pos_pcr1['numeric_sum']) + default_zero(pos_pcr1['numeric_sum']))/2
-        pos_under15_f_sum = default_zero(pos_under15_f['numeric_sum']) + half_pos_pcr
-        pos_under15_f_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': pos_under15_f_sum,
-        }
-        calculated_vals.append(pos_under15_f_val)
-        
-        pos_under15_m_sum = default_zero(pos_under15_m['numeric_sum']) + half_pos_pcr
-        pos_under15_m_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': pos_under15_m_sum,
-        }
-        calculated_vals.append(pos_under15_m_val)
-        
-        pos_over15_f_sum = default_zero(pos_over15_f['numeric_sum']) + Decimal(default_zero(pos_pregnant['numeric_sum']))
-        pos_over15_f_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': pos_over15_f_sum,
-        }
-        calculated_vals.append(pos_over15_f_val)
-        
-        pos_over15_m_sum = default_zero(pos_over15_m['numeric_sum']) + Decimal(default_zero(pos_male_partner['numeric_sum']))
-        pos_over15_m_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': pos_over15_m_sum,
-        }
-        calculated_vals.append(pos_over15_m_val)
-
-        tested_total = sum([under15_f_sum, under15_m_sum, over15_f_sum, over15_m_sum])
-        pos_total = sum([pos_under15_f_sum, pos_under15_m_sum, pos_over15_f_sum, pos_over15_m_sum])
-        tested_total_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested',
-            'cat_combo': None,
-            'numeric_sum': tested_total,
-        }
-        pos_total_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+',
-            'cat_combo': None,
-            'numeric_sum': pos_total,
-        }
-        calculated_vals.append(tested_total_val)
-        calculated_vals.append(pos_total_val)
-
-        # copy linked to care totals over
-        calculated_vals.append(linked_under15_f)
-        calculated_vals.append(linked_under15_m)
-        calculated_vals.append(linked_over15_f)
-        calculated_vals.append(linked_over15_m)
-
-        # calculate the percentages
-        target_under15_f, target_under15_m, target_over15_f, target_over15_m, target_pos_under15_f, target_pos_under15_m, target_pos_over15_f, target_pos_over15_m, *further_vals = other_vals
-
-        if all_not_none(under15_f_sum, target_under15_f['numeric_sum']) and target_under15_f['numeric_sum']:
-            under15_f_percent = (under15_f_sum * 100) / target_under15_f['numeric_sum']
-        else:
-            under15_f_percent = None
-        under15_f_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested (%)',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': under15_f_percent,
-        }
-        calculated_vals.append(under15_f_percent_val)
-
-        if all_not_none(under15_m_sum, target_under15_m['numeric_sum']) and target_under15_m['numeric_sum']:
-            under15_m_percent = (under15_m_sum * 100) / target_under15_m['numeric_sum']
-        else:
-            under15_m_percent = None
-        under15_m_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested (%)',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': under15_m_percent,
-        }
-        calculated_vals.append(under15_m_percent_val)
-
-        if all_not_none(over15_f_sum, target_over15_f['numeric_sum']) and target_over15_f['numeric_sum']:
-            over15_f_percent = (over15_f_sum * 100) / target_over15_f['numeric_sum']
-        else:
-            over15_f_percent = None
-        over15_f_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested (%)',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': over15_f_percent,
-        }
-        calculated_vals.append(over15_f_percent_val)
-
-        if all_not_none(over15_m_sum, target_over15_m['numeric_sum']) and target_over15_m['numeric_sum']:
-            over15_m_percent = (over15_m_sum * 100) / target_over15_m['numeric_sum']
-        else:
-            over15_m_percent = None
-        over15_m_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Tested (%)',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': over15_m_percent,
-        }
-        calculated_vals.append(over15_m_percent_val)
-
-        if all_not_none(pos_under15_f_sum, target_pos_under15_f['numeric_sum']) and target_pos_under15_f['numeric_sum']:
-            pos_under15_f_percent = (pos_under15_f_sum * 100) / target_pos_under15_f['numeric_sum']
-        else:
-            pos_under15_f_percent = None
-        pos_under15_f_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+ (%)',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': pos_under15_f_percent,
-        }
-        calculated_vals.append(pos_under15_f_percent_val)
-
-        if all_not_none(pos_under15_m_sum, target_pos_under15_m['numeric_sum']) and target_pos_under15_m['numeric_sum']:
-            pos_under15_m_percent = (pos_under15_m_sum * 100) / target_pos_under15_m['numeric_sum']
-        else:
-            pos_under15_m_percent = None
-        pos_under15_m_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+ (%)',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': pos_under15_m_percent,
-        }
-        calculated_vals.append(pos_under15_m_percent_val)
-
-        if all_not_none(pos_over15_f_sum, target_pos_over15_f['numeric_sum']) and target_pos_over15_f['numeric_sum']:
-            pos_over15_f_percent = (pos_over15_f_sum * 100) / target_pos_over15_f['numeric_sum']
-        else:
-            pos_over15_f_percent = None
-        pos_over15_f_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+ (%)',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': pos_over15_f_percent,
-        }
-        calculated_vals.append(pos_over15_f_percent_val)
-
-        if all_not_none(pos_over15_m_sum, target_pos_over15_m['numeric_sum']) and target_pos_over15_m['numeric_sum']:
-            pos_over15_m_percent = (pos_over15_m_sum * 100) / target_pos_over15_m['numeric_sum']
-        else:
-            pos_over15_m_percent = None
-        pos_over15_m_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'HIV+ (%)',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': pos_over15_m_percent,
-        }
-        calculated_vals.append(pos_over15_m_percent_val)
-
-        if all_not_none(linked_under15_f['numeric_sum'], pos_under15_f['numeric_sum']) and pos_under15_f['numeric_sum']:
-            linked_under15_f_percent = (linked_under15_f['numeric_sum'] * 100) / pos_under15_f['numeric_sum']
-        else:
-            linked_under15_f_percent = None
-        linked_under15_f_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Linked (%)',
-            'cat_combo': '(<15, Female)',
-            'numeric_sum': linked_under15_f_percent,
-        }
-        calculated_vals.append(linked_under15_f_percent_val)
-
-        if all_not_none(linked_under15_m['numeric_sum'], pos_under15_m['numeric_sum']) and pos_under15_m['numeric_sum']:
-            linked_under15_m_percent = (linked_under15_m['numeric_sum'] * 100) / pos_under15_m['numeric_sum']
-        else:
-            linked_under15_m_percent = None
-        linked_under15_m_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Linked (%)',
-            'cat_combo': '(<15, Male)',
-            'numeric_sum': linked_under15_m_percent,
-        }
-        calculated_vals.append(linked_under15_m_percent_val)
-
-        if all_not_none(linked_over15_f['numeric_sum'], pos_over15_f['numeric_sum']) and pos_over15_f['numeric_sum']:
-            linked_over15_f_percent = (linked_over15_f['numeric_sum'] * 100) / pos_over15_f['numeric_sum']
-        else:
-            linked_over15_f_percent = None
-        linked_over15_f_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Linked (%)',
-            'cat_combo': '(15+, Female)',
-            'numeric_sum': linked_over15_f_percent,
-        }
-        calculated_vals.append(linked_over15_f_percent_val)
-
-        if all_not_none(linked_over15_m['numeric_sum'], pos_over15_m['numeric_sum']) and pos_over15_m['numeric_sum']:
-            linked_over15_m_percent = (linked_over15_m['numeric_sum'] * 100) / pos_over15_m['numeric_sum']
-        else:
-            linked_over15_m_percent = None
-        linked_over15_m_percent_val = {
-            'district': ou_path_list[0],
-            'de_name': 'Linked (%)',
-            'cat_combo': '(15+, Male)',
-            'numeric_sum': linked_over15_m_percent,
-        }
-        calculated_vals.append(linked_over15_m_percent_val)
-
-        # _group[1].extend(calculated_vals)
-        _group[1] = calculated_vals
-    
-    data_element_names = list()
-    
-    # data_element_names += list(product(hts_short_names, subcategory_names))
-    # data_element_names += de_pmtct_mother_meta
-    # data_element_names += de_pmtct_mother_pos_meta
-    # data_element_names += list(product(pmtct_child_short_names, (None,)))
-    # data_element_names += de_target_meta
-
-    data_element_names += list(product(['Tested',], subcategory_names))
-    data_element_names += list(product(['HIV+',], subcategory_names))
-    data_element_names += list(product(['Tested',], [None,]))
-    data_element_names += list(product(['HIV+',], [None,]))
-    data_element_names += list(product(['Linked',], subcategory_names))
-    data_element_names += list(product(['Tested (%)',], subcategory_names))
-    data_element_names += list(product(['HIV+ (%)',], subcategory_names))
-    data_element_names += list(product(['Linked (%)',], subcategory_names))
+    grouped_vals, data_element_names = cached_values(request, 'hts_by_district', HTS_BY_DISTRICT.evaluate, filter_period)
 
     context = {
         'grouped_data': grouped_vals,
-        'ou_list': ou_list,
-        'val_target': val_target,
-        'val_target2': val_target2,
-        # 'grouped_data_size': len(grouped_vals),
         'data_element_names': data_element_names,
         'period_desc': period_desc,
         'period_list': PREV_5YRS,
@@ -1303,7 +475,11 @@ def hts_by_district(request):
     return render(request, 'cannula/hts_districts.html', context)
 
 @login_required
+@conditional_dashboard
+@cache_dashboard
 def vmmc_by_site(request):
+    from .scorecards import VMMC_BY_SITE
+
     this_day = date.today()
     this_year = this_day.year
     PREV_5YR_QTRS = ['%d-Q%d' % (y, q) for y in range(this_year, this_year-6, -1) for q in range(4, 0, -1)]
@@ -1315,264 +491,10 @@ def vmmc_by_site(request):
 
     period_desc = dateutil.DateSpan.fromquarter(filter_period).format()
 
-    # # all facilities (or equivalent)
-    qs_ou = OrgUnit.objects.filter(level=3).annotate(district=F('parent__parent__name'), subcounty=F('parent__name'), facility=F('name'))
-    ou_list = list(qs_ou.values_list('district', 'subcounty', 'facility'))
-
-    def val_with_subcat_fun(row, col):
-        district, subcounty, facility = row
-        de_name, subcategory = col
-        return { 'district': district, 'subcounty': subcounty, 'facility': facility, 'cat_combo': subcategory, 'de_name': de_name, 'numeric_sum': None }
-
-    targets_de_names = (
-        'VMMC_CIRC_TARGET',
-        'VMMC_DEVICE_TARGET',
-        'VMMC_SURGICAL_TARGET',
-    )
-    targets_short_names = (
-        'TARGET: VMMC_CIRC',
-        'TARGET: Device-based',
-        'TARGET: Surgical',
-    )
-    de_targets_meta = list(product(targets_de_names, (None,)))
-
-    qs_targets = DataValue.objects.what(*targets_de_names).filter(quarter=filter_period)
-    qs_targets = qs_targets.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_targets = qs_targets.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_targets = qs_targets.annotate(period=F('quarter'))
-    qs_targets = qs_targets.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_targets = qs_targets.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-    val_targets = list(val_targets)
-
-    gen_raster = grabbag.rasterize(ou_list, de_targets_meta, val_targets, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_targets2 = list(gen_raster)
-
-    method_de_names = (
-        '105-5 Clients circumcised by circumcision Technique Device Based (DC)',
-        '105-5 Clients circumcised by circumcision Technique Other VMMC techniques',
-        '105-5 Clients circumcised by circumcision Technique Surgical(SC)',
-    )
-    method_short_names = (
-        'Circumcised by technique - Device Based',
-        'Circumcised by technique - Other',
-        'Circumcised by technique - Surgical',
-    )
-    de_method_meta = list(product(method_de_names, (None,)))
-
-    qs_method = DataValue.objects.what(*method_de_names).filter(quarter=filter_period)
-    qs_method = qs_method.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_method = qs_method.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_method = qs_method.annotate(period=F('quarter'))
-    qs_method = qs_method.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_method = qs_method.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_method_meta, val_method, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_method2 = list(gen_raster)
-
-    hiv_de_names = (
-        '105-5 SMC Clients Counseled, Tested and Circumcised for HIV at SMC site HIV Negative',
-        '105-5 SMC Clients Counseled, Tested and Circumcised for HIV at SMC site HIV Positive',
-    )
-    hiv_short_names = (
-        'Circumcised by HIV status - Negative',
-        'Circumcised by HIV status - Positive',
-    )
-    de_hiv_meta = list(product(hiv_de_names, (None,)))
-
-    qs_hiv = DataValue.objects.what(*hiv_de_names).filter(quarter=filter_period)
-    qs_hiv = qs_hiv.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_hiv = qs_hiv.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_hiv = qs_hiv.annotate(period=F('quarter'))
-    qs_hiv = qs_hiv.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_hiv = qs_hiv.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_hiv_meta, val_hiv, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_hiv2 = list(gen_raster)
-
-    location_de_names = (
-        '105-5 Number of Males Circumcised by Age group and Technique Facility, Device Based (DC)',
-        '105-5 Number of Males Circumcised by Age group and Technique Facility, Surgical(SC)',
-        '105-5 Number of Males Circumcised by Age group and Technique Outreach, Device Based (DC)',
-        '105-5 Number of Males Circumcised by Age group and Technique Outreach, Surgical(SC)',
-    )
-    location_de_names2 = (
-        '105-5 Number of Males Circumcised by Age group and Technique Facility',
-        '105-5 Number of Males Circumcised by Age group and Technique Outreach',
-    )
-    location_prefix_len = len('105-5 Number of Males Circumcised by Age group and Technique Facility')
-    location_short_names = (
-        'Circumcised by site type - Static',
-        'Circumcised by site type - Mobile',
-    )
-    de_location_meta = list(product(location_de_names2, (None,)))
-
-    qs_location = DataValue.objects.what(*location_de_names).filter(quarter=filter_period)
-    qs_location = qs_location.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    # drop the technique section from the returned data element name
-    qs_location = qs_location.annotate(de_name=Substr('data_element__name', 1, location_prefix_len))
-
-    qs_location = qs_location.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_location = qs_location.annotate(period=F('quarter'))
-    qs_location = qs_location.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_location = qs_location.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_location_meta, val_location, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_location2 = list(gen_raster)
-
-    followup_de_names = (
-        '105-5a Number of Clients Circumcised who Returned for Follow Up Visit within 6 weeks of SMC Procedure(Within 48 Hours)',
-        '105-5b Number of Clients Circumcised who Returned for Follow Up Visit within 6 weeks of SMC Procedure(Within 7 Days)',
-        '105-5c Number of Clients Circumcised who Returned for Follow Up Visit within 6 weeks of SMC Procedure(Beyond 7 Days)',
-    )
-    followup_short_names = (
-        'Follow up - Within 48 hours',
-        'Follow up - Within 7 days',
-        'Follow up - Beyond 7 days',
-    )
-    de_followup_meta = list(product(followup_de_names, (None,)))
-
-    qs_followup = DataValue.objects.what(*followup_de_names).filter(quarter=filter_period)
-    qs_followup = qs_followup.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_followup = qs_followup.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_followup = qs_followup.annotate(period=F('quarter'))
-    qs_followup = qs_followup.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_followup = qs_followup.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_followup_meta, val_followup, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_followup2 = list(gen_raster)
-
-    adverse_de_names = (
-        '105-5 Clients Circumcised who Experienced one or more Adverse Events Moderate',
-        '105-5 Clients Circumcised who Experienced one or more Adverse Events Severe',
-    )
-    adverse_short_names = (
-        'Adverse Events - Moderate',
-        'Adverse Events - Severe',
-    )
-    de_adverse_meta = list(product(adverse_de_names, (None,)))
-
-    qs_adverse = DataValue.objects.what(*adverse_de_names).filter(quarter=filter_period)
-    qs_adverse = qs_adverse.annotate(cat_combo=Value(None, output_field=CharField()))
-
-    qs_adverse = qs_adverse.annotate(district=F('org_unit__parent__parent__name'), subcounty=F('org_unit__parent__name'), facility=F('org_unit__name'))
-    qs_adverse = qs_adverse.annotate(period=F('quarter'))
-    qs_adverse = qs_adverse.order_by('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period')
-    val_adverse = qs_adverse.values('district', 'subcounty', 'facility', 'de_name', 'cat_combo', 'period').annotate(values_count=Count('numeric_value'), numeric_sum=Sum('numeric_value'))
-
-    gen_raster = grabbag.rasterize(ou_list, de_adverse_meta, val_adverse, lambda x: (x['district'], x['subcounty'], x['facility']), lambda x: (x['de_name'], x['cat_combo']), val_with_subcat_fun)
-    val_adverse2 = list(gen_raster)
-
-    # combine the data and group by district, subcounty and facility
-    grouped_vals = groupbylist(sorted(chain(val_targets2, val_hiv2, val_location2, val_method2, val_followup2, val_adverse2), key=lambda x: (x['district'], x['subcounty'], x['facility'])), key=lambda x: (x['district'], x['subcounty'], x['facility']))
-
-    # perform calculations
-    for _group in grouped_vals:
-        (district_subcounty_facility, (target_total, target_device, target_surgical, hiv_negative, hiv_positive, location_facility, location_outreach, method_device, method_other, method_surgical, followup_48hrs, followup_7days, followup_plus7days, adverse_moderate, adverse_severe, *other_vals)) = _group
-        
-        calculated_vals = list()
-
-        method_sum = default_zero(method_device['numeric_sum']) + default_zero(method_surgical['numeric_sum']) + default_zero(method_other['numeric_sum'])
-
-        if all_not_none(target_total['numeric_sum'], method_sum) and target_total['numeric_sum']:
-            target_total_percent = (method_sum * 100) / target_total['numeric_sum']
-        else:
-            target_total_percent = None
-        target_total_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Perf% Circumcised',
-            'cat_combo': None,
-            'numeric_sum': target_total_percent,
-        }
-        calculated_vals.append(target_total_percent_val)
-
-        if all_not_none(target_device['numeric_sum'], method_device['numeric_sum']) and target_device['numeric_sum']:
-            if target_device['numeric_sum'] == 4:
-                tt = 1/0
-            target_device_percent = (method_device['numeric_sum'] * 100) / target_device['numeric_sum']
-        else:
-            target_device_percent = None
-        target_device_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Perf% Circumcised DC',
-            'cat_combo': None,
-            'numeric_sum': target_device_percent,
-        }
-        calculated_vals.append(target_device_percent_val)
-
-        if all_not_none(target_surgical['numeric_sum'], method_surgical['numeric_sum']) and target_surgical['numeric_sum']:
-            target_surgical_percent = (method_surgical['numeric_sum'] * 100) / target_surgical['numeric_sum']
-        else:
-            target_surgical_percent = None
-        target_surgical_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': 'Perf% Circumcised Surgical',
-            'cat_combo': None,
-            'numeric_sum': target_surgical_percent,
-        }
-        calculated_vals.append(target_surgical_percent_val)
-
-        if all_not_none(followup_48hrs['numeric_sum'], method_sum) and method_sum:
-            followup_48hrs_percent = (followup_48hrs['numeric_sum'] * 100) / method_sum
-        else:
-            followup_48hrs_percent = None
-        followup_48hrs_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': '% who returned within 48 hours',
-            'cat_combo': None,
-            'numeric_sum': followup_48hrs_percent,
-        }
-        calculated_vals.append(followup_48hrs_percent_val)
-
-        adverse_sum = default_zero(adverse_moderate['numeric_sum']) + default_zero(adverse_severe['numeric_sum'])
-
-        if all_not_none(adverse_sum, method_sum) and method_sum:
-            adverse_percent = (adverse_sum * 100) / method_sum
-        else:
-            adverse_percent = None
-        adverse_percent_val = {
-            'district': district_subcounty_facility[0],
-            'subcounty': district_subcounty_facility[1],
-            'facility': district_subcounty_facility[2],
-            'de_name': '% with at least one adverse event',
-            'cat_combo': None,
-            'numeric_sum': adverse_percent,
-        }
-        calculated_vals.append(adverse_percent_val)
-
-        _group[1].extend(calculated_vals)
-
-    data_element_names = list()
-    data_element_names += list(product(targets_short_names, (None,)))
-    data_element_names += list(product(hiv_short_names, (None,)))
-    data_element_names += list(product(location_short_names, (None,)))
-    data_element_names += list(product(method_short_names, (None,)))
-    data_element_names += list(product(followup_short_names, (None,)))
-    data_element_names += list(product(adverse_short_names, (None,)))
-
-    data_element_names += list(product(['Perf% Circumcised'], (None,)))
-    data_element_names += list(product(['Perf% Circumcised DC'], (None,)))
-    data_element_names += list(product(['Perf% Circumcised Surgical'], (None,)))
-    data_element_names += list(product(['% who returned within 48 hours'], (None,)))
-    data_element_names += list(product(['% with at least one adverse event'], (None,)))
+    grouped_vals, data_element_names = cached_values(request, 'vmmc_by_site', VMMC_BY_SITE.evaluate, filter_period)
 
     context = {
         'grouped_data': grouped_vals,
-        'ou_list': ou_list,
-        'val_targets': val_targets,
-        'val_targets2': val_targets2,
         'data_element_names': data_element_names,
         'period_desc': period_desc,
         'period_list': PREV_5YR_QTRS,
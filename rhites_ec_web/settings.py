@@ -92,6 +92,25 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # computed dashboards, keyed by the data version so they never need invalidating (see cannula/cache.py)
+    'dashboards': {
+        'BACKEND': 'cannula.cache.LRUMemoryCache',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 200,
+            'MAX_SIZE': 128*1024*1024, # bytes, pickled
+        },
+    },
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -116,6 +135,14 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static/")
 
 SOURCE_DOC_DIR = os.path.join(BASE_DIR, 'source_doc_storage')
 
+# worker processes used to parse a workbook, at most one per data worksheet (1 parses in-process; None uses up
+# to one per CPU). Workbooks with a single data worksheet, CSV and JSON uploads are always parsed in-process
+INGEST_PARSE_PROCESSES = None
+
+# seconds between the heartbeats of a running ingestion job, and without one before the job is requeued
+INGEST_JOB_HEARTBEAT_SECS = 30
+INGEST_JOB_STALE_SECS = 300
+
 LOGIN_REDIRECT_URL = '/'
 
 # Import optional settings
@@ -123,3 +150,7 @@ try:
     from .local_settings import *
 except ImportError:
    pass
+
+# a second connection to the default database, ingestion jobs write their
+# progress through it so it is committed apart from the job's own writes
+DATABASES.setdefault('ingest_progress', dict(DATABASES['default'], ATOMIC_REQUESTS=False, TEST={'MIRROR': 'default'}))